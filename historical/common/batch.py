@@ -0,0 +1,132 @@
+"""
+.. module: historical.common.batch
+    :platform: Unix
+    :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import abc
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from historical.common.exceptions import ProducerException
+from historical.common.session import get_client
+from historical.constants import LOGGING_LEVEL, SQS_PRODUCER_RETRIES, SQS_PRODUCER_WORKERS
+
+logging.basicConfig()
+LOG = logging.getLogger('historical')
+LOG.setLevel(LOGGING_LEVEL)
+
+# A single SQS (or SNS) message can be at most 256KB:
+MAX_MESSAGE_BYTES = 262144
+
+# SendMessageBatch and PublishBatch can have at most 10 entries, and at most 256KB of message bodies (in total):
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 262144
+
+
+def pack_batches(records, max_entries=MAX_BATCH_ENTRIES, max_bytes=MAX_BATCH_BYTES, body_field='MessageBody'):
+    """Packs SQS (or SNS) records into batches that fill up both the entry count and the total payload size limits.
+
+    Sizes are the UTF-8 encoded lengths of the message bodies, which is what SQS and SNS count towards the limits.
+    Records are kept in their original order.
+    """
+    batch, batch_bytes = [], 0
+
+    for record in records:
+        size = len(record[body_field].encode('utf-8'))
+        if size > max_bytes:
+            LOG.error(f'[X] Message is too big to send: {size} bytes. It will be rejected.')
+
+        if batch and (len(batch) == max_entries or batch_bytes + size > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+
+        batch.append(record)
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+class BatchProducer(abc.ABC):
+    """Base class for sending batches of events to AWS.
+
+    Batches are sent concurrently with a bounded thread pool, and only the entries that failed to send are retried
+    (with exponential backoff). Subclasses implement `send_entries` to make the API call for a batch.
+    """
+
+    service = None
+
+    def __init__(self, max_workers=SQS_PRODUCER_WORKERS, max_retries=SQS_PRODUCER_RETRIES, backoff=0.1):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    @abc.abstractmethod
+    def send_entries(self, client, entries, destination):
+        """Sends the entries to the destination. Returns the API response (which has the `Failed` entries)."""
+
+    def send_batch(self, entries, destination):
+        """Sends a batch of entries. Entries that fail to send are retried with backoff -- unless the failure
+        is the sender's fault, as those will never succeed.
+
+        :raises ProducerException: if any of the entries could not be sent.
+        """
+        client = get_client(self.service)
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Exponential backoff with jitter:
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))  # nosec
+
+            result = self.send_entries(client, entries, destination)
+            failed = result.get('Failed', [])
+            if not failed:
+                return
+
+            sender_faults = [failure for failure in failed if failure.get('SenderFault')]
+            if sender_faults:
+                raise ProducerException(destination, sender_faults)
+
+            LOG.debug(f'[~] {len(failed)} event(s) failed to send to {self.service.upper()}. Attempt: {attempt + 1}/'
+                      f'{self.max_retries + 1}')
+
+            failed_ids = {failure['Id'] for failure in failed}
+            entries = [entry for entry in entries if entry['Id'] in failed_ids]
+
+        raise ProducerException(destination, failed)
+
+    def run(self, func, items, destination, sequential=False):
+        """Calls `func(item, destination)` for each of the items -- concurrently if there is more than one (and the
+        items don't need to be `sequential`).
+
+        :raises ProducerException: once all of the items have been attempted, with all of the entries that failed.
+        """
+        errors = []
+
+        if sequential or len(items) <= 1 or self.max_workers <= 1:
+            for item in items:
+                try:
+                    func(item, destination)
+                except Exception as exc:  # pylint: disable=W0703
+                    errors.append(exc)
+
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+                futures = [executor.submit(func, item, destination) for item in items]
+
+            errors = [future.exception() for future in futures if future.exception()]
+
+        if not errors:
+            return
+
+        # Other (unexpected) errors are raised as they are -- but only after all of the items have been attempted:
+        for error in errors:
+            if not isinstance(error, ProducerException):
+                LOG.error(f'[X] {len(errors)} batch(es) failed to send to: {destination}.')
+                raise error
+
+        raise ProducerException(destination, [failure for error in errors for failure in error.failed])
@@ -0,0 +1,50 @@
+"""
+.. module: historical.common.claim_check
+    :platform: Unix
+    :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import hashlib
+import json
+import logging
+from functools import lru_cache
+
+from historical.common.session import get_client
+from historical.constants import CLAIM_CHECK_BUCKET, CLAIM_CHECK_FIELD, CLAIM_CHECK_PREFIX, LOGGING_LEVEL
+
+logging.basicConfig()
+LOG = logging.getLogger('historical')
+LOG.setLevel(LOGGING_LEVEL)
+
+
+def is_claim_check(parsed):
+    """Checks if the loaded event is a claim check (a pointer to the event in S3)."""
+    return isinstance(parsed, dict) and CLAIM_CHECK_FIELD in parsed
+
+
+def store_event(blob, bucket=CLAIM_CHECK_BUCKET):
+    """Stores the event blob in S3 and returns a claim check for it.
+
+    The key is the SHA-256 of the blob, so storing the same event twice results in the same object.
+    """
+    key = f'{CLAIM_CHECK_PREFIX}{hashlib.sha256(blob.encode("utf-8")).hexdigest()}.json'
+
+    LOG.debug(f'[-->] Storing event in S3. Bucket: {bucket} Key: {key}')
+    get_client('s3').put_object(Bucket=bucket, Key=key, Body=blob.encode('utf-8'), ContentType='application/json')
+
+    return json.dumps({CLAIM_CHECK_FIELD: {'bucket': bucket, 'key': key}})
+
+
+@lru_cache(maxsize=32)
+def fetch_event(bucket, key):
+    """Fetches the event blob for a claim check from S3. The objects never change (they are content-addressed), so
+    they are cached.
+    """
+    LOG.debug(f'[<--] Fetching event from S3. Bucket: {bucket} Key: {key}')
+    return get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+
+def redeem(parsed):
+    """Gets the event blob that the claim check points to."""
+    return fetch_event(parsed[CLAIM_CHECK_FIELD]['bucket'], parsed[CLAIM_CHECK_FIELD]['key'])
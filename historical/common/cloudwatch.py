@@ -85,3 +85,30 @@ def get_historical_base_info(event):
         data['eventName'] = event['detail']['eventName']
 
     return data
+
+
+def group_records(records, key_func):
+    """Groups a batch of events by the resource that they refer to (with `key_func` -- see `coalesce_records`).
+
+    Returns a dict of key -> the list of events for that resource.
+    """
+    grouped = {}
+    for record in records:
+        grouped.setdefault(key_func(record), []).append(record)
+
+    return grouped
+
+
+def coalesce_records(records, key_func):
+    """Keeps only the newest event (by `eventTime`) for each resource in a batch of events.
+
+    `key_func` maps an event to a key for the resource that it refers to. This allows each resource to only be
+    described and saved once per batch -- regardless of how many events there were for it.
+    """
+    newest = {}
+    for record in records:
+        key = key_func(record)
+        if key not in newest or get_event_time(record) >= get_event_time(newest[key]):
+            newest[key] = record
+
+    return list(newest.values())
@@ -0,0 +1,157 @@
+"""
+.. module: historical.common.diff
+    :platform: Unix
+    :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import copy
+import json
+
+
+NO_DIFF_FIELDS = ('userIdentity', 'principalId', 'userAgent', 'sourceIpAddress', 'requestParameters', 'eventName',
+                  'configHash', 'keyframeEventTime', 'configDelta', 'revisionSequence')
+
+
+def canonicalize(value):
+    """Makes a canonical (order-insensitive) version of a serialized DynamoDB value. Lists are sorted and have their
+    duplicates removed -- just like `DeepDiff(..., ignore_order=True)` treats them."""
+    if isinstance(value, dict):
+        return {key: canonicalize(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return sorted({json.dumps(canonicalize(item), sort_keys=True, default=str) for item in value})
+
+    return value
+
+
+def fingerprint(value):
+    """Gets a canonical (order-insensitive) string for a serialized DynamoDB value. Equal fingerprints mean that the
+    values are the same -- disregarding the order of (and duplicates in) lists."""
+    return json.dumps(canonicalize(value), sort_keys=True, default=str)
+
+
+# The DynamoDB data types (the keys of a serialized DynamoDB value):
+DYNAMODB_TYPES = ('S', 'N', 'B', 'SS', 'NS', 'BS', 'M', 'L', 'NULL', 'BOOL')
+
+
+def _get_dynamodb_type(value):
+    """Gets the DynamoDB data type of a serialized DynamoDB value -- or None if it isn't one."""
+    if isinstance(value, dict) and len(value) == 1:
+        ddb_type = next(iter(value))
+        if ddb_type in DYNAMODB_TYPES:
+            return ddb_type
+
+    return None
+
+
+def _diff_lists(old, new, path, delta):
+    """Diffs two lists without regard to order. Each item is fingerprinted once, so this is linear in the size of the
+    lists. Items that aren't in the other list are reported by their index.
+
+    Unlike DeepDiff, list items are compared whole: an item that changed is reported as removed (at its old index)
+    and added (at its new index), rather than as changes inside of the item.
+    """
+    old_prints = [fingerprint(item) for item in old]
+    new_prints = [fingerprint(item) for item in new]
+
+    for items, prints, others, change in [(old, old_prints, set(new_prints), 'removed'),
+                                          (new, new_prints, set(old_prints), 'added')]:
+        seen = set()
+        for index, (item, item_print) in enumerate(zip(items, prints)):
+            if item_print not in others and item_print not in seen:
+                delta.setdefault(change, {})[f'{path}[{index}]'] = item
+
+            seen.add(item_print)
+
+
+def _diff_values(old, new, path, delta):
+    """Recursively diffs two serialized DynamoDB values into the delta."""
+    if old == new:
+        return
+
+    old_type, new_type = _get_dynamodb_type(old), _get_dynamodb_type(new)
+    if old_type and new_type and old_type != new_type:
+        # A value that changed type (like from NULL to a string) is a single change:
+        delta.setdefault('changed', {})[path] = {'old_value': old, 'new_value': new}
+
+    elif isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                delta.setdefault('removed', {})[f'{path}[{key!r}]'] = old[key]
+
+        for key in new:
+            if key not in old:
+                delta.setdefault('added', {})[f'{path}[{key!r}]'] = new[key]
+
+            else:
+                _diff_values(old[key], new[key], f'{path}[{key!r}]', delta)
+
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_lists(old, new, path, delta)
+
+    else:
+        delta.setdefault('changed', {})[path] = {'old_value': old, 'new_value': new}
+
+
+def diff(latest_config, current_config):
+    """Determine if two revisions have actually changed -- a faster alternative to `default_diff`.
+
+    This takes the serialized attributes of the revisions (from `_get_json()`), and returns a compact delta of the paths
+    that were `added`, `removed`, and `changed`. It is empty if (and only if) `DeepDiff(..., ignore_order=True)` finds
+    no difference. The order of items in lists doesn't matter. The paths look like DeepDiff's, e.g.:
+    `root['configuration']['M']['Rules']['L'][2]` -- but changed list items are reported whole (see `_diff_lists`).
+
+    This can be passed in as the `diff_func` to the Differ. The inputs are not modified.
+    """
+    delta = {}
+    _diff_values({key: value for key, value in latest_config.items() if key not in NO_DIFF_FIELDS},
+                 {key: value for key, value in current_config.items() if key not in NO_DIFF_FIELDS},
+                 'root', delta)
+
+    return delta
+
+
+def _delta_maps(base, target, path, delta):
+    for key in base:
+        if key not in target:
+            delta['unset'].append(path + [key])
+
+    for key, value in target.items():
+        if key in base and isinstance(base[key], dict) and isinstance(value, dict):
+            _delta_maps(base[key], value, path + [key], delta)
+
+        elif key not in base or base[key] != value:
+            delta['set'].append([path + [key], value])
+
+
+def make_delta(base, target):
+    """Gets a compact forward delta that turns the `base` (plain) `dict` into the `target`. Maps are diffed key by key,
+    and everything else (including lists) is replaced whole. The delta is JSON serializable:
+    `{'set': [[path, value], ...], 'unset': [path, ...]}` -- where the paths are lists of keys.
+    """
+    delta = {'set': [], 'unset': []}
+    _delta_maps(base, target, [], delta)
+
+    return delta
+
+
+def apply_delta(base, delta):
+    """Applies a delta (from `make_delta`) to the `base` `dict`. The base is not modified."""
+    result = copy.deepcopy(base)
+
+    for path in delta['unset']:
+        parent = result
+        for key in path[:-1]:
+            parent = parent[key]
+
+        parent.pop(path[-1], None)
+
+    for path, value in delta['set']:
+        parent = result
+        for key in path[:-1]:
+            parent = parent[key]
+
+        parent[path[-1]] = value
+
+    return result
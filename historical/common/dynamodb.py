@@ -6,14 +6,28 @@
 .. author:: Kevin Glisson <kglisson@netflix.com>
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import hashlib
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import lru_cache
 
 from deepdiff import DeepDiff
 from boto3.dynamodb.types import TypeDeserializer
+from pynamodb.attributes import BooleanAttribute, MapAttribute, NumberAttribute, UnicodeAttribute
+from pynamodb.exceptions import DoesNotExist, UpdateError
 
+from historical.attributes import EventTimeAttribute, HistoricalDecimalAttribute
+
+from historical.common.diff import apply_delta, canonicalize, make_delta, NO_DIFF_FIELDS
 from historical.common.exceptions import DurableItemIsMissingException
-from historical.constants import EVENT_TOO_BIG_FLAG
+from historical.constants import DIFFER_CACHE_MAX_AGE, DIFFER_CACHE_SIZE, DIFFER_USE_OLD_IMAGE, DIFFER_WORKERS, \
+    DURABLE_KEYFRAME_INTERVAL, EVENT_TOO_BIG_FLAG, TTL_EXPIRY
+from historical.models import default_ttl, EPHEMERAL_PATHS
 
 DESER = TypeDeserializer()
 
@@ -45,11 +59,279 @@ def default_diff(latest_config, current_config):
 
 def pop_no_diff_fields(latest_config, current_config):
     """Pops off fields that should not be included in the diff."""
-    for field in ['userIdentity', 'principalId', 'userAgent', 'sourceIpAddress', 'requestParameters', 'eventName']:
+    for field in NO_DIFF_FIELDS:
         latest_config.pop(field, None)
         current_config.pop(field, None)
 
 
+# Marks the end of an ephemeral path in a compiled path tree:
+PATH_END = None
+
+
+@lru_cache(maxsize=None)
+def compile_paths(paths):
+    """Compiles dotted paths (like `configuration.Rules.*.LastUpdated`) into a tree of path segments, so that all the
+    paths can be stripped in a single walk. A `*` segment matches every key of a map, or every item of a list."""
+    tree = {}
+    for path in paths:
+        node = tree
+        for segment in path.split('.'):
+            node = node.setdefault(segment, {})
+
+        node[PATH_END] = True
+
+    return tree
+
+
+def get_ephemeral_paths(model):
+    """Gets the compiled ephemeral paths for a model. These are set on the model's `Meta` as `ephemeral_paths`
+    (`historical.models.EPHEMERAL_PATHS` are used for all models)."""
+    return compile_paths(tuple(EPHEMERAL_PATHS) + tuple(getattr(model.Meta, 'ephemeral_paths', [])))
+
+
+def _strip_map(mapping, tree, typed):
+    result = mapping
+    for segment, subtree in tree.items():
+        for key in (list(mapping) if segment == '*' else [segment]):
+            if key not in result:
+                continue
+
+            if PATH_END in subtree:
+                value = None
+            else:
+                value = _strip_value(result[key], subtree, typed)
+                if value is result[key]:
+                    continue
+
+            # Only the containers along the paths are copied:
+            if result is mapping:
+                result = dict(mapping)
+
+            if PATH_END in subtree:
+                result.pop(key)
+            else:
+                result[key] = value
+
+    return result
+
+
+def _strip_list(items, tree, typed):
+    subtree = tree.get('*')
+    if not subtree:
+        return items
+
+    if PATH_END in subtree:
+        return []
+
+    result = [_strip_value(item, subtree, typed) for item in items]
+    return items if all(new is old for new, old in zip(result, items)) else result
+
+
+def _strip_value(value, tree, typed):
+    if typed:
+        for ddb_type, strip in [('M', _strip_map), ('L', _strip_list)]:
+            if isinstance(value, dict) and ddb_type in value:
+                inner = strip(value[ddb_type], tree, typed)
+                return value if inner is value[ddb_type] else {ddb_type: inner}
+
+        return value
+
+    if isinstance(value, dict):
+        return _strip_map(value, tree, typed)
+
+    if isinstance(value, list):
+        return _strip_list(value, tree, typed)
+
+    return value
+
+
+def strip_paths(attributes, tree, typed=True):
+    """Gets the attributes without the (compiled) paths. This works on both serialized DynamoDB attributes (from
+    `_get_json()`) and on plain `dict`s (`typed=False`). The attributes are not modified."""
+    if not tree:
+        return attributes
+
+    return _strip_map(attributes, tree, typed)
+
+
+def get_revision_hash(attributes):
+    """Gets a canonical hash of the serialized attributes of a revision (from `_get_json()`) that matter for diffing.
+
+    Two revisions that `default_diff` considers to be the same will have the same hash.
+    """
+    canonical = canonicalize({key: value for key, value in attributes.items() if key not in NO_DIFF_FIELDS})
+    blob = json.dumps(canonical, sort_keys=True, default=str)
+
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def get_revision_config(revision):
+    """Gets the serialized attributes of a revision -- without its ephemeral paths."""
+    return strip_paths(revision._get_json()[1]['attributes'],  # pylint: disable=W0212
+                       get_ephemeral_paths(type(revision)))
+
+
+def set_revision_hash(revision):
+    """Sets the `configHash` on a Durable revision (before it is saved)."""
+    revision.configHash = get_revision_hash(get_revision_config(revision))
+    return revision
+
+
+# Used to make the event times comparable:
+EVENT_TIME = EventTimeAttribute()
+
+
+class LatestRevisionCache:
+    """A bounded LRU of ARN -> (eventTime, configHash) of the latest Durable table revisions that this Lambda container
+    has read or saved. This lives at the module level so that it survives across warm Lambda invocations.
+
+    This is only safe if a given ARN is never processed by more than one Lambda container at a time (such as with a
+    FIFO Differ queue) -- otherwise, another container could save a newer revision that this one doesn't know about.
+    Entries are ignored after `max_age` seconds to limit the damage if that happens.
+    """
+
+    def __init__(self, max_size, max_age):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.revisions = OrderedDict()  # ARN -> (eventTime, configHash, time cached)
+        self.lock = threading.Lock()
+
+    def get(self, arn, event_time):
+        """Gets the `configHash` of the latest revision at or before the event time -- if it is known."""
+        event_time = EVENT_TIME.serialize(event_time)
+
+        with self.lock:
+            cached = self.revisions.get(arn)
+            if not cached:
+                return None
+
+            # The revision is stale, or is newer than the event (the event is out of order):
+            if cached[2] + self.max_age < time.time() or cached[0] > event_time:
+                return None
+
+            self.revisions.move_to_end(arn)
+            return cached[1]
+
+    def put(self, arn, event_time, config_hash):
+        """Records the latest revision for the ARN -- unless a newer revision is already known."""
+        if not self.max_size:
+            return
+
+        event_time = EVENT_TIME.serialize(event_time)
+
+        with self.lock:
+            cached = self.revisions.get(arn)
+            if cached and cached[0] > event_time and cached[2] + self.max_age >= time.time():
+                return
+
+            self.revisions[arn] = (event_time, config_hash, time.time())
+            self.revisions.move_to_end(arn)
+
+            while len(self.revisions) > self.max_size:
+                self.revisions.popitem(last=False)
+
+    def clear(self):
+        """Empties out the cache."""
+        with self.lock:
+            self.revisions.clear()
+
+
+LATEST_REVISIONS = LatestRevisionCache(DIFFER_CACHE_SIZE, DIFFER_CACHE_MAX_AGE)
+
+
+# The fields that make up a delta-encoded revision:
+DELTA_FIELDS = ('keyframeEventTime', 'configDelta', 'revisionSequence')
+
+
+def get_keyframe(revision, durable_model):
+    """Gets the keyframe revision (with the full `configuration`) for a delta-encoded revision."""
+    try:
+        return durable_model.get(revision.arn, revision.keyframeEventTime, consistent_read=True)
+
+    except DoesNotExist:
+        LOG.error(f'[?] Keyframe with ARN/Event Time: {revision.arn}/{revision.keyframeEventTime} was NOT found in the '
+                  f'Durable table...')
+        raise DurableItemIsMissingException({"item_arn": revision.arn, "event_time": revision.keyframeEventTime})
+
+
+def reconstruct_revision(revision, durable_model=None):
+    """Rebuilds the full revision for a delta-encoded Durable table revision by applying its delta to its keyframe.
+    Revisions that are not delta-encoded are returned as-is.
+
+    :raises DurableItemIsMissingException: if the keyframe doesn't exist.
+    """
+    if not revision.keyframeEventTime:
+        return revision
+
+    durable_model = durable_model or type(revision)
+    keyframe = get_keyframe(revision, durable_model)
+
+    data = dict(revision)
+    data['configuration'] = apply_delta(dict(keyframe)['configuration'], json.loads(revision.configDelta))
+    for field in DELTA_FIELDS:
+        data.pop(field)
+
+    return durable_model(**data)
+
+
+def encode_revision(revision, latest_revision=None):
+    """Gets the revision to store in the Durable table when delta-encoding is enabled (`DURABLE_KEYFRAME_INTERVAL`).
+
+    This is either a keyframe (the full revision), or a delta from the keyframe of the previous revision -- which has
+    no `configuration`, so it must go through `reconstruct_revision` before it is used. A keyframe is
+    stored every `DURABLE_KEYFRAME_INTERVAL` revisions, after deletions, and if the delta isn't smaller than the full
+    `configuration`. The `latest_revision` is the revision before this one (it is fetched if not provided).
+    """
+    durable_model = type(revision)
+    config = dict(revision)['configuration']
+
+    # Deletion markers are always stored in full:
+    if not config:
+        return revision
+
+    if not latest_revision or latest_revision.eventTime >= revision.eventTime:
+        latest_revision = next(iter(durable_model.query(
+            revision.arn,
+            (durable_model.eventTime < revision.eventTime),
+            scan_index_forward=False,
+            limit=1,
+            consistent_read=True)), None)
+
+    sequence = (latest_revision.revisionSequence or 0) + 1 if latest_revision else 0
+    if not sequence or sequence >= DURABLE_KEYFRAME_INTERVAL:
+        revision.revisionSequence = 0
+        return revision
+
+    keyframe = get_keyframe(latest_revision, durable_model) if latest_revision.keyframeEventTime else latest_revision
+    keyframe_config = dict(keyframe)['configuration']
+
+    delta = json.dumps(make_delta(keyframe_config, config), default=str)
+    if not keyframe_config or len(delta) >= len(json.dumps(config, default=str)):
+        revision.revisionSequence = 0
+        return revision
+
+    data = dict(revision)
+    data.update(configuration=None, keyframeEventTime=keyframe.eventTime, configDelta=delta, revisionSequence=sequence)
+
+    return durable_model(**data)
+
+
+def save_durable_revision(revision, latest_revision=None):
+    """Saves a revision to the Durable table (with its `configHash`), and remembers it as the latest for its ARN.
+
+    If `DURABLE_KEYFRAME_INTERVAL` is set, then the revision is delta-encoded (see `encode_revision`).
+    """
+    if not revision.configHash:
+        set_revision_hash(revision)
+
+    if DURABLE_KEYFRAME_INTERVAL:
+        encode_revision(revision, latest_revision=latest_revision).save()
+    else:
+        revision.save()
+
+    LATEST_REVISIONS.put(revision.arn, revision.eventTime, revision.configHash)
+
+
 def remove_global_dynamo_specific_fields(obj):
     """Remove all fields that are placed in by DynamoDB for global tables"""
     # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/globaltables_HowItWorks.html
@@ -60,12 +342,114 @@ def remove_global_dynamo_specific_fields(obj):
     return obj
 
 
+GLOBAL_TABLE_FIELDS = ('aws:rep:deleting', 'aws:rep:updatetime', 'aws:rep:updateregion')
+
+
+def _plain_number(value):
+    """Converts a DynamoDB number string into an int (if it is a whole number) or a float -- just like `fix_decimals`.
+    This only makes a Decimal for numbers that aren't plain integers.
+    """
+    try:
+        return int(value)
+
+    except ValueError:
+        number = Decimal(value)
+        return int(number) if number % 1 == 0 else float(number)
+
+
+def _plain_value(value):
+    """Converts a DynamoDB JSON value (like `{'S': 'some string'}`) into a plain JSON value."""
+    (ddb_type, data), = value.items()
+
+    if ddb_type == 'S':
+        return data.replace('<empty>', '')
+
+    if ddb_type == 'BOOL':
+        return data
+
+    if ddb_type == 'N':
+        return _plain_number(data)
+
+    if ddb_type == 'M':
+        return {key: _plain_value(item) for key, item in data.items()}
+
+    if ddb_type == 'L':
+        return [_plain_value(item) for item in data]
+
+    if ddb_type == 'NULL':
+        return None
+
+    raise ValueError(f'[X] Unsupported DynamoDB type: {ddb_type}')
+
+
+def strip_empty_placeholders(value):
+    """Replaces the `<empty>` placeholders in all of the strings of a plain JSON value with empty strings."""
+    if isinstance(value, str):
+        return value.replace('<empty>', '')
+
+    if isinstance(value, dict):
+        return {key: strip_empty_placeholders(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [strip_empty_placeholders(item) for item in value]
+
+    return value
+
+
+def image_to_dict(image, model):
+    """Converts a DynamoDB stream image directly into the same `dict` that `dict(model(**deserialized_image))` makes
+    (with the `<empty>` placeholders stripped out), without making the PynamoDB object (or Decimals).
+
+    :raises ValueError: if the image has something that this doesn't support. Use the model for those.
+    """
+    attributes = model.get_attributes()
+
+    unknown = set(image) - set(attributes) - set(GLOBAL_TABLE_FIELDS)
+    if unknown:
+        raise ValueError(f'[X] Fields: {unknown} are not in the model.')
+
+    result = {}
+    for name, attr in attributes.items():
+        if name not in image and attr.default is not None:
+            raise ValueError(f'[X] {name} is missing -- the model would fill in its default value.')
+
+        value = image.get(name, {'NULL': True})
+        ddb_type = next(iter(value))
+
+        if type(attr) is MapAttribute and ddb_type in ('M', 'NULL'):  # pylint: disable=C0123
+            result[name] = _plain_value(value)
+
+        elif isinstance(attr, HistoricalDecimalAttribute) and ddb_type == 'N':
+            result[name] = _plain_number(value['N'])
+            if not isinstance(result[name], int):
+                raise ValueError(f'[X] {name} is not a whole number.')
+
+        elif isinstance(attr, NumberAttribute) and ddb_type in ('N', 'NULL'):
+            result[name] = int(_plain_number(value['N'])) if ddb_type == 'N' else None
+
+        elif isinstance(attr, BooleanAttribute) and ddb_type in ('BOOL', 'NULL'):
+            result[name] = value.get('BOOL')
+
+        elif isinstance(attr, UnicodeAttribute) and ddb_type in ('S', 'NULL'):
+            # (Empty strings are serialized as None by PynamoDB):
+            result[name] = value['S'].replace('<empty>', '') if value.get('S') else None
+
+        elif isinstance(attr, EventTimeAttribute) and ddb_type in ('S', 'NULL'):
+            result[name] = value.get('S')
+
+        else:
+            raise ValueError(f'[X] Unsupported field: {name} with DynamoDB type: {ddb_type}')
+
+    return result
+
+
 def remove_current_specific_fields(obj):
     """Remove all fields that belong to the Current table -- that don't belong in the Durable table"""
     obj = remove_global_dynamo_specific_fields(obj)
 
     obj.pop("ttl", None)
     obj.pop("eventSource", None)
+    obj.pop("configFingerprint", None)
 
     return obj
 
@@ -74,37 +458,140 @@ def remove_durable_specific_fields(obj):
     """Remove all fields that belong to the Durable table -- that don't belong in the Durable table"""
     obj = remove_global_dynamo_specific_fields(obj)
 
-    # Add here if any are required in the future.
+    obj.pop('configHash', None)
+    for field in DELTA_FIELDS:
+        obj.pop(field, None)
 
     return obj
 
 
-def modify_record(durable_model, current_revision, arn, event_time, diff_func):
-    """Handles a DynamoDB MODIFY event type."""
-    # We want the newest items first.
-    # See: http://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.html
-    items = list(durable_model.query(
-        arn,
-        (durable_model.eventTime <= event_time),
-        scan_index_forward=False,
-        limit=1,
-        consistent_read=True))
+def get_config_fingerprint(data, ephemeral_paths=None):
+    """Gets a stable fingerprint of the parts of a Current table item that describe the resource:
+    the `configuration`, `Tags`, and `version` -- without the (compiled) ephemeral paths."""
+    blob = json.dumps(strip_paths({
+        'configuration': data.get('configuration'),
+        'Tags': data.get('Tags'),
+        'version': data.get('version')
+    }, ephemeral_paths, typed=False), sort_keys=True, default=str)
+
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def save_current_revision(current_model, data, condition=None):
+    """Saves a collected revision to the Current table -- but only if it differs from what is already there.
+
+    Every write to the Current table results in a DynamoDB stream event that the Differ has to process. If the
+    fingerprint of the configuration is unchanged, then the full write is skipped. To keep the item from expiring,
+    the `ttl` and `eventTime` are refreshed via a small UpdateItem once the `ttl` is halfway to expiring.
+
+    The full write is made with the optional `condition`. A `PutError` is raised if it isn't met.
+
+    Returns the saved revision, or None if the write was skipped.
+    """
+    data['configFingerprint'] = get_config_fingerprint(data, get_ephemeral_paths(current_model))
+    current_revision = current_model(**data)
+
+    # This is read consistently -- a stale fingerprint could match an out of date revision, and skip a needed write:
+    try:
+        existing = current_model.get(data['arn'], consistent_read=True, attributes_to_get=['configFingerprint', 'ttl'])
+    except DoesNotExist:
+        existing = None
+
+    if existing and existing.configFingerprint == data['configFingerprint']:
+        if existing.ttl and existing.ttl > time.time() + TTL_EXPIRY / 2:
+            LOG.debug(f"[@] Item with ARN: {data['arn']} is unchanged. Skipping the write to the Current table.")
+            return None
+
+        try:
+            current_revision.update(
+                actions=[
+                    current_model.ttl.set(default_ttl()),
+                    current_model.eventTime.set(current_revision.eventTime)
+                ],
+                condition=(current_model.configFingerprint == data['configFingerprint'])
+            )
+            LOG.debug(f"[~] Item with ARN: {data['arn']} is unchanged. Refreshed the TTL in the Current table.")
+            return current_revision
+
+        # The item changed since it was fetched -- just save the whole thing:
+        except UpdateError:
+            pass
+
+    current_revision.save(condition=condition)
+    return current_revision
+
+
+def modify_record(durable_model, current_revision, arn, event_time, diff_func, previous_revision=None,
+                  use_cache=False):
+    """Handles a DynamoDB MODIFY event type.
+
+    The current revision is diffed against the `previous_revision` (from the stream record's OldImage) if it is
+    provided. Otherwise, it is diffed against the latest revision in the Durable table -- which is only fetched if it
+    isn't already cached (see `LatestRevisionCache`). The cache is only used if `use_cache` is set.
+
+    The revisions are compared by their `configHash` first. If they differ, the revision is saved -- unless a
+    `diff_func` is provided, in which case it has the final say.
+    """
+    # The ephemeral paths are never diffed:
+    current_config = get_revision_config(current_revision)
+    current_revision.configHash = get_revision_hash(current_config)
+
+    if previous_revision is None and use_cache:
+        latest_hash = LATEST_REVISIONS.get(arn, event_time)
+
+        if latest_hash == current_revision.configHash:
+            LOG.debug(f'[@] No difference found with the cached latest revision. Arn: {arn}')
+            return
+
+        # A custom diff needs the full latest revision:
+        if latest_hash and not diff_func:
+            LOG.debug(f'[~] Difference found with the cached latest revision. Arn: {arn}')
+            save_durable_revision(current_revision)
+            return
+
+    if previous_revision is not None:
+        items = [previous_revision]
+
+    else:
+        # We want the newest items first.
+        # See: http://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.html
+        items = list(durable_model.query(
+            arn,
+            (durable_model.eventTime <= event_time),
+            scan_index_forward=False,
+            limit=1,
+            consistent_read=True))
 
     if items:
         latest_revision = items[0]
 
-        latest_config = latest_revision._get_json()[1]['attributes']    # pylint: disable=W0212
-        current_config = current_revision._get_json()[1]['attributes']  # pylint: disable=W0212
+        # Revisions saved before `configHash` was added (and OldImages) need to have theirs calculated. A saved hash
+        # could be from before the ephemeral paths changed -- so it is only trusted if it matches:
+        latest_hash = getattr(latest_revision, 'configHash', None)
+        if latest_hash != current_revision.configHash:
+            # (Delta-encoded revisions need their full configuration for this):
+            latest_config = get_revision_config(reconstruct_revision(latest_revision, durable_model))
+            latest_hash = get_revision_hash(latest_config)
+
+        if previous_revision is None:
+            LATEST_REVISIONS.put(arn, latest_revision.eventTime, latest_hash)
+
+        if latest_hash == current_revision.configHash:
+            LOG.debug(f'[@] No difference found. Arn: {arn}')
+            return
 
         # Determine if there is truly a difference, disregarding Ephemeral Paths
-        diff = diff_func(latest_config, current_config)
-        if diff:
+        if diff_func and not diff_func(latest_config, current_config):
+            return
+
+        if LOG.isEnabledFor(logging.DEBUG):
             LOG.debug(
                 f'[~] Difference found saving new revision to durable table. Arn: {arn} LatestConfig: {latest_config} '
                 f'CurrentConfig: {json.dumps(current_config)}')
-            current_revision.save()
+        save_durable_revision(current_revision,
+                              latest_revision=latest_revision if previous_revision is None else None)
     else:
-        current_revision.save()
+        save_durable_revision(current_revision)
         LOG.info(f'[?] Got modify event but no current revision found. Arn: {arn}')
 
 
@@ -117,7 +604,7 @@ def delete_differ_record(old_image, durable_model):
     data['configuration'] = {}
     # we give our own timestamps for TTL deletions
     del data['eventTime']
-    durable_model(**data).save()
+    save_durable_revision(durable_model(**data))
     LOG.debug('[+] Adding deletion marker.')
 
 
@@ -162,7 +649,7 @@ def get_full_durable_object(arn, event_time, durable_model):
 
     # We need to place the real configuration data into the record so it can be deserialized into
     # the durable model correctly:
-    return item[0]
+    return reconstruct_revision(item[0], durable_model)
 
 
 def deserialize_current_record_to_durable_model(record, current_model, durable_model):
@@ -248,7 +735,8 @@ def deserialize_durable_record_to_durable_model(record, durable_model):
         # This could end up as loss of precision
         data[item] = DESER.deserialize(value)
 
-    return durable_model(**data)
+    # Delta-encoded revisions (that weren't expanded by the Proxy) need their full configuration:
+    return reconstruct_revision(durable_model(**data), durable_model)
 
 
 def deserialize_durable_record_to_current_model(record, current_model):
@@ -261,7 +749,8 @@ def deserialize_durable_record_to_current_model(record, current_model):
     :return:
     """
     # Was the item in question too big for SNS? If so, then we need to fetch the item from the current Dynamo table:
-    if record.get(EVENT_TOO_BIG_FLAG):
+    # Delta-encoded revisions (that weren't expanded by the Proxy) don't have the configuration either:
+    if record.get(EVENT_TOO_BIG_FLAG) or record['dynamodb']['NewImage'].get('configDelta'):
         # Try to get the data from the current table vs. grabbing the data from the Durable table:
         return get_full_current_object(record['dynamodb']['Keys']['arn']['S'], current_model)
 
@@ -275,15 +764,32 @@ def deserialize_durable_record_to_current_model(record, current_model):
     return current_model(**data)
 
 
-def process_dynamodb_differ_record(record, current_model, durable_model, diff_func=None):
+def deserialize_old_image_to_durable_model(record, durable_model):
+    """Turns the OldImage of a Current table stream record into a durable pynamo object.
+
+    Returns None if the OldImage can't be used: if it is missing, or if it was shrunk by the Proxy (no configuration).
+    """
+    old_image = record['dynamodb'].get('OldImage')
+    if record.get(EVENT_TOO_BIG_FLAG) or not old_image or 'configuration' not in old_image:
+        return None
+
+    old_image = remove_current_specific_fields(dict(old_image))
+    data = {}
+
+    for item, value in old_image.items():
+        # This could end up as loss of precision
+        data[item] = DESER.deserialize(value)
+
+    return durable_model(**data)
+
+
+def process_dynamodb_differ_record(record, current_model, durable_model, diff_func=None, use_cache=False):
     """
     Processes a DynamoDB NewImage record (for Differ events).
 
     This will ONLY process the record if the record exists in one of the regions defined by the PROXY_REGIONS of
-    the current Proxy function.
+    the current Proxy function. See `modify_record` for `use_cache`.
     """
-    diff_func = diff_func or default_diff
-
     # Nothing special needs to be done for deletions as far as items that are too big for SNS are concerned.
     # This is because the deletion will remove the `configuration` field and save the item without it.
     if record['eventName'] == 'REMOVE':
@@ -310,8 +816,80 @@ def process_dynamodb_differ_record(record, current_model, durable_model, diff_fu
             return
 
         if record['eventName'] == 'INSERT':
-            current_revision.save()
+            save_durable_revision(current_revision)
             LOG.debug('[+] Saving new revision to durable table.')
 
         elif record['eventName'] == 'MODIFY':
-            modify_record(durable_model, current_revision, arn, current_revision.eventTime, diff_func)
+            previous_revision = None
+            if DIFFER_USE_OLD_IMAGE:
+                previous_revision = deserialize_old_image_to_durable_model(record, durable_model)
+
+                if previous_revision is None:
+                    LOG.debug(f'[?] No usable OldImage for ARN: {arn}. Fetching the latest revision from the Durable '
+                              f'table instead.')
+
+            modify_record(durable_model, current_revision, arn, current_revision.eventTime, diff_func,
+                          previous_revision=previous_revision, use_cache=use_cache)
+
+
+def process_arn_records(records, current_model, durable_model, diff_func=None, use_cache=False):
+    """Processes the (index, record) pairs for a single ARN in order. Once a record fails, the later records are not
+    processed. Returns the (index, exception, record) for each of the records that failed or were skipped.
+    """
+    failed = []
+    for index, record in records:
+        if failed:
+            LOG.debug(f'[X] Skipping record #{index} in the batch because an earlier record for the same ARN failed.')
+            failed.append((index, failed[0][1], record))
+            continue
+
+        try:
+            process_dynamodb_differ_record(record, current_model, durable_model, diff_func=diff_func,
+                                           use_cache=use_cache)
+
+        except Exception as exc:  # pylint: disable=W0703
+            failed.append((index, exc, record))
+
+    return failed
+
+
+def process_differ_records(records, current_model, durable_model, failures, diff_func=None, workers=None,
+                           fifo=False):
+    """Processes a batch of Differ records.
+
+    The batch is partitioned by ARN. The records for each ARN are processed in order, and the ARNs are processed
+    concurrently (up to `DIFFER_WORKERS` at a time).
+
+    If a record fails, then the later records for the same ARN are not processed -- they are marked as failures too.
+    This keeps the revisions for each ARN in order when they are retried (which is what allows the Differ to run with
+    high concurrency off of a FIFO queue, with the ARNs as the message groups).
+
+    The latest revision cache (see `LatestRevisionCache`) is only used if the records came from a `fifo` queue, since
+    that is what keeps an ARN from being processed by more than one Differ at a time.
+    """
+    workers = workers or DIFFER_WORKERS
+
+    if DIFFER_CACHE_SIZE and not fifo:
+        LOG.debug('[?] The Differ queue is not a FIFO queue. The latest revision cache will not be used.')
+
+    partitions = OrderedDict()
+    for index, record in enumerate(records):
+        arn = (record.get('dynamodb', {}).get('Keys', {}).get('arn') or {}).get('S')
+        partitions.setdefault(arn, []).append((index, record))
+
+    if workers > 1 and len(partitions) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(partitions))) as executor:
+            results = list(executor.map(
+                lambda partition: process_arn_records(partition, current_model, durable_model, diff_func=diff_func,
+                                                      use_cache=fifo),
+                partitions.values()
+            ))
+
+    else:
+        results = [process_arn_records(partition, current_model, durable_model, diff_func=diff_func,
+                                       use_cache=fifo)
+                   for partition in partitions.values()]
+
+    # Report the failures in the order of the batch:
+    for _, exc, record in sorted((failure for result in results for failure in result), key=lambda item: item[0]):
+        failures.add(exc, record)
@@ -17,3 +17,13 @@ class MissingProxyConfigurationException(Exception):
     """Exception if the Proxy is missing the proper configuration on how to operate."""
 
     pass
+
+
+class ProducerException(Exception):
+    """Exception for if events could not be sent to SQS or SNS."""
+
+    def __init__(self, destination, failed):
+        self.destination = destination
+        self.failed = failed
+        super(ProducerException, self).__init__(f'[X] Failed to send {len(failed)} event(s) to: {destination}. '
+                                                f'Failures: {failed}')
@@ -7,28 +7,43 @@
 """
 import logging
 import json
-import math
 import os
-import sys
-
-import boto3
-from retrying import retry
 
 from raven_python_lambda import RavenLambdaWrapper
 
-from historical.common.dynamodb import DESER, remove_global_dynamo_specific_fields
+from historical.common.dynamodb import DESER, image_to_dict, reconstruct_revision, remove_durable_specific_fields, \
+    remove_global_dynamo_specific_fields, strip_empty_placeholders
+from historical.common.claim_check import store_event
 from historical.common.exceptions import MissingProxyConfigurationException
+from historical.common.sns import publish_events
 from historical.common.sqs import produce_events
-from historical.constants import CURRENT_REGION, EVENT_TOO_BIG_FLAG, PROXY_REGIONS, REGION_ATTR, SIMPLE_DURABLE_PROXY
+from historical.common.util import compress_event
+from historical.constants import CLAIM_CHECK_BUCKET, COMPRESS_EVENTS, DIFFER_USE_OLD_IMAGE, EVENT_TOO_BIG_FLAG, \
+    PROXY_COALESCE_RECORDS, PROXY_REGIONS, REGION_ATTR, SIMPLE_DURABLE_PROXY
 
 from historical.mapping import DURABLE_MAPPING, HISTORICAL_TECHNOLOGY
 
 LOG = logging.getLogger('historical')
 
+# Events that are this big (or bigger) are too big to send through SNS/SQS as-is:
+MAX_EVENT_BYTES = 200 * 1024
+
+# The fields that are removed from the images when shrinking a DynamoDB stream record:
+SHRINK_FIELDS = ('configuration', 'requestParameters')
 
-@retry(stop_max_attempt_number=4, wait_exponential_multiplier=1000, wait_exponential_max=1000)
-def _publish_sns_message(client, blob, topic_arn):
-    client.publish(TopicArn=topic_arn, Message=blob)
+
+def encode_object(fragments):
+    """Joins (key, already JSON encoded value) pairs into a JSON object. This gives the same output as `json.dumps`,
+    but allows parts of an object to be encoded once and then re-used (or left out) without re-encoding them.
+    """
+    return '{' + ', '.join(f'{json.dumps(key)}: {value}' for key, value in fragments) + '}'
+
+
+def get_event_size(blob):
+    """Gets the size of the event blob in bytes. `json.dumps` escapes all non-ASCII characters, so the number of
+    characters is the number of UTF-8 bytes.
+    """
+    return len(blob)
 
 
 def shrink_blob(record, deletion):
@@ -64,6 +79,64 @@ def shrink_blob(record, deletion):
     return item
 
 
+def is_collapsible(record):
+    """Checks if the stream record can be replaced by a newer record for the same ARN. Only INSERTs and MODIFYs of
+    existing items can be -- deletion revisions (empty configurations) and REMOVEs (like TTL expirations) can't be.
+
+    Only Current table records (which always have a `ttl`) can be: the Differ only needs the latest state of each
+    resource, but every Durable table revision needs to be sent to the downstream consumers.
+    """
+    if record['eventName'] not in ['INSERT', 'MODIFY']:
+        return False
+
+    if 'ttl' not in record['dynamodb']['NewImage']:
+        return False
+
+    return bool((record['dynamodb']['NewImage'].get('configuration', {}) or {}).get('M'))
+
+
+def carry_old_image(replaced, record):
+    """Gets a copy of the stream record with the OldImage of the record that it replaces. If the replaced record
+    doesn't have an OldImage (an INSERT), then neither does the copy.
+    """
+    record = dict(record, dynamodb=dict(record['dynamodb']))
+    record['dynamodb'].pop('OldImage', None)
+
+    if replaced['dynamodb'].get('OldImage'):
+        record['dynamodb']['OldImage'] = replaced['dynamodb']['OldImage']
+
+    return record
+
+
+def coalesce_stream_records(records):
+    """Keeps only the latest image for each ARN in a batch of DynamoDB stream records.
+
+    Deletion revisions and REMOVEs are always kept, and records are never collapsed across them -- so a resource
+    that was deleted and then re-created within the batch still gets both revisions. The records for each ARN stay in
+    order.
+    """
+    kept = []
+    latest = {}  # ARN -> index (in `kept`) of the latest record that can still be replaced
+    for record in records:
+        arn = record['dynamodb']['Keys']['arn']['S']
+
+        if is_collapsible(record):
+            if arn in latest:
+                # The OldImage needs to be from *before* the replaced record -- otherwise the Differ (when diffing
+                # against the OldImage) would miss the change in the replaced record:
+                record = carry_old_image(kept[latest[arn]], record)
+                kept[latest[arn]] = None
+
+            latest[arn] = len(kept)
+
+        else:
+            latest.pop(arn, None)
+
+        kept.append(record)
+
+    return [record for record in kept if record]
+
+
 @RavenLambdaWrapper()
 def handler(event, context):  # pylint: disable=W0613
     """Historical S3 DynamoDB Stream Forwarder (the 'Proxy').
@@ -79,10 +152,7 @@ def handler(event, context):  # pylint: disable=W0613
     if not queue_url and not topic_arn:
         raise MissingProxyConfigurationException('[X] Must set the `PROXY_QUEUE_URL` or the `PROXY_TOPIC_ARN` vars.')
 
-    items_to_ship = []
-
-    # Must ALWAYS shrink for SQS because of 256KB limit of sending batched messages
-    force_shrink = True if queue_url else False
+    records = []
 
     # Is this a "Simple Durable Proxy" -- that is -- are we stripping out all of the DynamoDB data from
     # the Differ?
@@ -109,18 +179,47 @@ def handler(event, context):  # pylint: disable=W0613
         if detect_global_table_updates(record):
             continue
 
-        items_to_ship.append(record_maker(record, force_shrink=force_shrink))
+        # (This needs to happen before anything looks at the configuration -- delta-encoded revisions don't have one):
+        records.append(expand_delta_record(record))
+
+    # Only forward the latest image for each ARN to the Differ? (Not for the Durable table Proxy -- the consumers of
+    # that want every revision. See `is_collapsible`):
+    if PROXY_COALESCE_RECORDS and not SIMPLE_DURABLE_PROXY:
+        total = len(records)
+        records = coalesce_stream_records(records)
+        LOG.info(f'[@] Coalesced {total} stream records into {len(records)} records. Collapsed: {total - len(records)}')
+
+    items_to_ship = [record_maker(record) for record in records]
 
     if items_to_ship:
         # SQS:
         if queue_url:
-            produce_events(items_to_ship, queue_url, batch_size=int(os.environ.get('PROXY_BATCH_SIZE', 10)))
+            # (The events are packed into batches that fit under the SQS size limits). For FIFO queues, the events for
+            # each ARN are delivered in order:
+            produce_events(items_to_ship, queue_url, batch_size=int(os.environ.get('PROXY_BATCH_SIZE', 10)),
+                           group_ids=[record['dynamodb']['Keys']['arn']['S'] for record in records])
 
         # SNS:
         else:
-            client = boto3.client("sns", region_name=CURRENT_REGION)
-            for i in items_to_ship:
-                _publish_sns_message(client, i, topic_arn)
+            publish_events(items_to_ship, topic_arn)
+
+
+def expand_delta_record(record):
+    """Replaces the NewImage of a delta-encoded Durable table revision with the full revision, so that the consumers of
+    the Durable table stream don't need to know about keyframes. Other records are returned as-is.
+
+    :param record:
+    :return:
+    """
+    image = record['dynamodb'].get('NewImage')
+    if not image or not image.get('configDelta'):
+        return record
+
+    durable_model = DURABLE_MAPPING.get(HISTORICAL_TECHNOLOGY)
+    revision = reconstruct_revision(_get_durable_pynamo_obj(dict(image), durable_model), durable_model)
+
+    new_image = revision._serialize(attr_map=True)['attributes']  # pylint: disable=W0212
+    return dict(record, dynamodb=dict(record['dynamodb'], NewImage=new_image))
 
 
 def detect_global_table_updates(record):
@@ -145,17 +244,39 @@ def detect_global_table_updates(record):
 def make_proper_dynamodb_record(record, force_shrink=False):
     """Prepares and ships an individual DynamoDB record over to SNS/SQS for future processing.
 
+    The images are encoded once (field by field), so that a shrunken blob can be made without encoding them again.
+
     :param record:
     :param force_shrink:
     :return:
     """
+    images = {img: [(field, json.dumps(value)) for field, value in record['dynamodb'][img].items()]
+              for img in ['NewImage', 'OldImage'] if record['dynamodb'].get(img)}
+
+    def encode_dynamodb(drop_fields):
+        return encode_object(
+            (key, encode_object((field, value) for field, value in images[key] if field not in drop_fields.get(key, []))
+             if key in images else json.dumps(value))
+            for key, value in record['dynamodb'].items()
+        )
+
     # Get the initial blob and determine if it is too big for SNS/SQS:
-    blob = json.dumps(record)
-    size = math.ceil(sys.getsizeof(blob) / 1024)
+    blob = encode_object((key, encode_dynamodb({}) if key == 'dynamodb' else json.dumps(value))
+                         for key, value in record.items())
 
     # If it is too big, then we need to send over a smaller blob to inform the recipient that it needs to go out and
     # fetch the item from the Historical table!
-    if size >= 200 or force_shrink:
+    if get_event_size(blob) >= MAX_EVENT_BYTES or force_shrink:
+        # ...unless it fits when compressed:
+        if COMPRESS_EVENTS and not force_shrink:
+            compressed = compress_event(blob)
+            if get_event_size(compressed) < MAX_EVENT_BYTES:
+                return compressed
+
+        # ...or send a claim check for the full record:
+        if CLAIM_CHECK_BUCKET and not force_shrink:
+            return store_event(blob, bucket=CLAIM_CHECK_BUCKET)
+
         deletion = False
         # ^^ However -- deletions need to be handled differently, because the Differ won't be able to find a
         # deleted record. For deletions, we will only shrink the 'OldImage', but preserve the 'NewImage' since that is
@@ -165,7 +286,27 @@ def make_proper_dynamodb_record(record, force_shrink=False):
             if not (record['dynamodb']['NewImage'].get('configuration', {}) or {}).get('M'):
                 deletion = True
 
-        blob = json.dumps(shrink_blob(record, deletion))
+        # If the Differ diffs against the OldImage, then try to keep the NewImage intact by only shrinking the
+        # OldImage (the Differ will look up the previous revision in the Durable table instead):
+        if DIFFER_USE_OLD_IMAGE and images.get('OldImage') and not force_shrink:
+            shrunk = encode_object((key, encode_dynamodb({'OldImage': SHRINK_FIELDS}) if key == 'dynamodb'
+                                    else json.dumps(value)) for key, value in record.items())
+            if get_event_size(shrunk) < MAX_EVENT_BYTES:
+                return shrunk
+
+        # This is the same as `shrink_blob` -- but with the already encoded image fields:
+        fragments = [('eventName', json.dumps(record['eventName'])), (EVENT_TOO_BIG_FLAG, json.dumps(not deletion))]
+
+        # To handle TTLs (if they happen)
+        if record.get('userIdentity'):
+            fragments.append(('userIdentity', json.dumps(record['userIdentity'])))
+
+        drop_fields = {'OldImage': SHRINK_FIELDS}
+        if not deletion:
+            drop_fields['NewImage'] = SHRINK_FIELDS
+
+        fragments.append(('dynamodb', encode_dynamodb(drop_fields)))
+        blob = encode_object(fragments)
 
     return blob
 
@@ -195,23 +336,38 @@ def make_proper_simple_record(record, force_shrink=False):
         'tech': HISTORICAL_TECHNOLOGY
     }
 
-    # We need to de-serialize the raw DynamoDB object into the proper PynamoDB obj:
-    prepped_new_record = _get_durable_pynamo_obj(record['dynamodb']['NewImage'],
-                                                 DURABLE_MAPPING.get(HISTORICAL_TECHNOLOGY))
+    # Convert the raw DynamoDB image directly into a dict. Anything that isn't supported by this needs to be
+    # de-serialized into the proper PynamoDB obj:
+    durable_model = DURABLE_MAPPING.get(HISTORICAL_TECHNOLOGY)
+    try:
+        prepped_new_record = image_to_dict(record['dynamodb']['NewImage'], durable_model)
+    except ValueError as exc:
+        LOG.debug(f'[~] Unable to directly convert the image. Using the model instead. Reason: {exc}')
+        prepped_new_record = strip_empty_placeholders(
+            dict(_get_durable_pynamo_obj(record['dynamodb']['NewImage'], durable_model)))
 
-    item['item'] = dict(prepped_new_record)
+    # The internal Durable table fields (like the delta-encoding ones) are not part of the simple durable schema:
+    prepped_new_record = remove_durable_specific_fields(prepped_new_record)
 
     # Get the initial blob and determine if it is too big for SNS/SQS:
-    blob = json.dumps(item)
-    size = math.ceil(sys.getsizeof(blob) / 1024)
+    item_blob = json.dumps(prepped_new_record)
+    blob = encode_object([(key, json.dumps(value)) for key, value in item.items()] + [('item', item_blob)])
 
     # If it is too big, then we need to send over a smaller blob to inform the recipient that it needs to go out and
     # fetch the item from the Historical table!
-    if size >= 200 or force_shrink:
-        del item['item']
+    if get_event_size(blob) >= MAX_EVENT_BYTES or force_shrink:
+        # ...unless it fits when compressed:
+        if COMPRESS_EVENTS and not force_shrink:
+            compressed = compress_event(blob)
+            if get_event_size(compressed) < MAX_EVENT_BYTES:
+                return compressed
+
+        # ...or send a claim check for the full record:
+        if CLAIM_CHECK_BUCKET and not force_shrink:
+            return store_event(blob, bucket=CLAIM_CHECK_BUCKET)
 
         item[EVENT_TOO_BIG_FLAG] = True
 
         blob = json.dumps(item)
 
-    return blob.replace('<empty>', '')
+    return blob
@@ -0,0 +1,157 @@
+"""
+.. module: historical.common.session
+    :platform: Unix
+    :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import datetime
+import logging
+import threading
+
+import boto3
+from botocore.config import Config
+from dateutil.tz import tzutc
+
+from historical.constants import CLIENT_MAX_ATTEMPTS, CURRENT_REGION, LOGGING_LEVEL
+
+logging.basicConfig()
+LOG = logging.getLogger('historical')
+LOG.setLevel(LOGGING_LEVEL)
+
+# Assumed role credentials are refreshed once they are within this amount of time of expiring:
+CREDENTIAL_EXPIRY_MARGIN = datetime.timedelta(minutes=15)
+
+# Only override botocore's retry behavior if asked to:
+CLIENT_CONFIG = Config(retries={'max_attempts': CLIENT_MAX_ATTEMPTS}) if CLIENT_MAX_ATTEMPTS else None
+
+# These live at the module level so that they survive across warm Lambda invocations:
+# (account, role, session name) -> assumed role credentials:
+CREDENTIALS = {}
+
+# (account, role, session name, region, service) -> (client, the credentials the client was made with):
+CLIENTS = {}
+
+STATS = {
+    'credential_hits': 0,
+    'credential_misses': 0,
+    'client_hits': 0,
+    'client_misses': 0
+}
+
+# botocore clients are thread safe -- but making them (and Sessions) is not. This also guards the dicts above:
+LOCK = threading.RLock()
+
+# (account, role, session name) -> the lock that is held while assuming that role. STS is called with only that lock
+# held, so assuming one role doesn't hold up the threads that need other roles (or cached clients):
+CREDENTIAL_LOCKS = {}
+
+
+def credentials_expiring(credentials):
+    """Checks if assumed role credentials have expired (or are about to)."""
+    return credentials['Expiration'] <= datetime.datetime.now(tzutc()) + CREDENTIAL_EXPIRY_MARGIN
+
+
+def get_cached_credentials(key):
+    """Gets the cached credentials for the (account, role, session name) -- if they aren't about to expire.
+
+    This must be called with the `LOCK` held.
+    """
+    credentials = CREDENTIALS.get(key)
+    if credentials and not credentials_expiring(credentials):
+        STATS['credential_hits'] += 1
+        return credentials
+
+    return None
+
+
+def get_credentials(account_number, assume_role, session_name='historical'):
+    """Gets credentials for the role in the given account. This will only call STS AssumeRole if there are no
+    cached credentials for the account/role/session name, or if the cached credentials are about to expire.
+    """
+    key = (account_number, assume_role, session_name)
+
+    with LOCK:
+        credentials = get_cached_credentials(key)
+        if credentials:
+            return credentials
+
+        key_lock = CREDENTIAL_LOCKS.setdefault(key, threading.Lock())
+
+    # Only one thread assumes the role -- the others wait for it, and then use its credentials:
+    with key_lock:
+        with LOCK:
+            credentials = get_cached_credentials(key)
+            if credentials:
+                return credentials
+
+            STATS['credential_misses'] += 1
+
+        LOG.debug(f'[~] Assuming role: {assume_role} in account: {account_number}.')
+
+        sts = get_client('sts')
+        credentials = sts.assume_role(RoleArn=f'arn:aws:iam::{account_number}:role/{assume_role}',
+                                      RoleSessionName=session_name)['Credentials']
+
+        with LOCK:
+            CREDENTIALS[key] = credentials
+
+        return credentials
+
+
+def get_client(service, account_number=None, assume_role=None, region=CURRENT_REGION, session_name='historical'):
+    """Gets a boto3 client for the given service. Clients are cached and reused until the credentials they were
+    made with are about to expire.
+
+    For cross account clients, provide both `account_number` and `assume_role`. The resulting client can be passed
+    into CloudAux functions via the `force_client` keyword argument.
+    """
+    if assume_role and not account_number:
+        raise ValueError('[X] Both an account number and a role to assume are required for cross account clients.')
+
+    # (The session name only matters for assumed role clients):
+    key = (account_number, assume_role, session_name if assume_role else None, region, service)
+    credentials = get_credentials(account_number, assume_role, session_name=session_name) if assume_role else None
+
+    with LOCK:
+        cached = CLIENTS.get(key)
+        if cached and cached[1] is credentials:
+            STATS['client_hits'] += 1
+            return cached[0]
+
+        STATS['client_misses'] += 1
+
+        client_kwargs = {}
+        if credentials:
+            client_kwargs = {
+                'aws_access_key_id': credentials['AccessKeyId'],
+                'aws_secret_access_key': credentials['SecretAccessKey'],
+                'aws_session_token': credentials['SessionToken']
+            }
+
+        client = boto3.session.Session().client(service, region_name=region, config=CLIENT_CONFIG, **client_kwargs)
+        CLIENTS[key] = (client, credentials)
+
+        return client
+
+
+def get_stats():
+    """Gets a copy of the cache hit/miss counters."""
+    with LOCK:
+        return dict(STATS)
+
+
+def log_stats():
+    """Logs the cache hit/miss counters. Call this once at the end of each invocation."""
+    LOG.info(f'[@] Credential and client cache stats: {get_stats()}')
+
+
+def clear():
+    """Empties out all of the cached credentials and clients, and resets the counters."""
+    with LOCK:
+        CREDENTIALS.clear()
+        CREDENTIAL_LOCKS.clear()
+        CLIENTS.clear()
+
+        for stat in STATS:
+            STATS[stat] = 0
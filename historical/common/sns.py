@@ -0,0 +1,76 @@
+"""
+.. module: historical.common.sns
+    :platform: Unix
+    :copyright: (c) 2018 by Netflix Inc., see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. author:: Mike Grima <mgrima@netflix.com>
+"""
+import logging
+import uuid
+
+from retrying import retry
+
+from historical.common.batch import BatchProducer, MAX_BATCH_BYTES, MAX_BATCH_ENTRIES, pack_batches
+from historical.common.session import get_client
+from historical.constants import LOGGING_LEVEL, SNS_PUBLISHER_RETRIES, SNS_PUBLISHER_WORKERS
+
+logging.basicConfig()
+LOG = logging.getLogger('historical')
+LOG.setLevel(LOGGING_LEVEL)
+
+
+@retry(stop_max_attempt_number=4, wait_exponential_multiplier=1000, wait_exponential_max=1000)
+def _publish_sns_message(client, blob, topic_arn):
+    client.publish(TopicArn=topic_arn, Message=blob)
+
+
+def make_sns_record(event):
+    """Get a dict with the components required for an SNS PublishBatch entry."""
+    return {
+        'Id': uuid.uuid4().hex,
+        'Message': event
+    }
+
+
+def supports_publish_batch(client):
+    """Checks if the SNS client is new enough to have PublishBatch."""
+    return 'PublishBatch' in client.meta.service_model.operation_names
+
+
+class SNSPublisher(BatchProducer):
+    """Publishes events to SNS.
+
+    Events are published with PublishBatch (same limits as SQS: 10 messages and 256KB per batch). If the installed
+    botocore doesn't have PublishBatch, then the events are published individually instead (still concurrently).
+    """
+
+    service = 'sns'
+
+    def send_entries(self, client, entries, destination):
+        return client.publish_batch(TopicArn=destination, PublishBatchRequestEntries=entries)
+
+    def publish_one(self, event, topic_arn):
+        """Publishes a single event (with retries)."""
+        _publish_sns_message(get_client('sns'), event, topic_arn)
+
+    def send(self, events, topic_arn):
+        """Publishes the events to the SNS topic.
+
+        :raises ProducerException: if any of the events could not be published (after all the batches are attempted).
+        """
+        if not supports_publish_batch(get_client('sns')):
+            LOG.debug('[~] SNS PublishBatch is not available. Publishing events individually.')
+            self.run(self.publish_one, events, topic_arn)
+            return
+
+        batches = list(pack_batches([make_sns_record(event) for event in events], max_entries=MAX_BATCH_ENTRIES,
+                                    max_bytes=MAX_BATCH_BYTES, body_field='Message'))
+        self.run(self.send_batch, batches, topic_arn)
+
+
+PUBLISHER = SNSPublisher(max_workers=SNS_PUBLISHER_WORKERS, max_retries=SNS_PUBLISHER_RETRIES)
+
+
+def publish_events(events, topic_arn):
+    """Efficiently publishes events to the SNS topic."""
+    PUBLISHER.send(events, topic_arn)
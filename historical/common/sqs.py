@@ -5,13 +5,16 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import hashlib
 import logging
+import threading
 import uuid
 import random
 
-import boto3
-
-from historical.constants import CURRENT_REGION
+from historical.common.batch import BatchProducer, MAX_BATCH_ENTRIES, pack_batches
+from historical.common.session import get_client
+from historical.common.util import COMPRESSION_THRESHOLD, compress_event
+from historical.constants import COMPRESS_EVENTS
 
 logging.basicConfig()
 LOG = logging.getLogger('historical')
@@ -24,16 +27,31 @@ def chunks(event_list, chunk_size):
         yield event_list[i:i + chunk_size]
 
 
-def get_queue_url(queue_name):
-    """Get the URL of the SQS queue to send events to."""
-    client = boto3.client("sqs", CURRENT_REGION)
-    queue = client.get_queue_url(QueueName=queue_name)
+def is_fifo_queue(queue_url):
+    """Checks if the SQS queue is a FIFO queue (the names of FIFO queues end in `.fifo`)."""
+    return queue_url.endswith('.fifo')
+
+
+def is_fifo_event(event):
+    """Checks if all of the records in an SQS triggered Lambda event came from a FIFO queue (by their queue ARNs)."""
+    return bool(event.get('Records')) and all(is_fifo_queue(record.get('eventSourceARN', ''))
+                                              for record in event['Records'])
 
-    return queue["QueueUrl"]
 
+def make_sqs_record(event, delay_seconds=0, group_id=None):
+    """Get a dict with the components required for SQS
+
+    For FIFO queues, provide the `group_id`. Messages in the same group are delivered in order. FIFO queues don't
+    support per-message delays, and the message is de-duplicated by its content.
+    """
+    if group_id:
+        return {
+            "Id": uuid.uuid4().hex,
+            "MessageBody": event,
+            "MessageGroupId": group_id,
+            "MessageDeduplicationId": hashlib.sha256(event.encode('utf-8')).hexdigest()
+        }
 
-def make_sqs_record(event, delay_seconds=0):
-    """Get a dict with the components required for SQS"""
     return {
         "Id": uuid.uuid4().hex,
         "DelaySeconds": delay_seconds,
@@ -52,25 +70,87 @@ def get_random_delay(max_seconds):
     return random.randint(0, max_seconds)  # nosec
 
 
-def produce_events(events, queue_url, batch_size=10, randomize_delay=0):
+class SQSProducer(BatchProducer):
+    """Sends events to SQS.
+
+    This lives at the module level so that the queue URLs (and the SQS client via `get_client`) are cached across
+    warm Lambda invocations.
+    """
+
+    service = 'sqs'
+
+    def __init__(self, **kwargs):
+        super(SQSProducer, self).__init__(**kwargs)
+
+        self.queue_urls = {}
+        self.lock = threading.Lock()
+
+    def get_queue_url(self, queue_name):
+        """Get the URL of the SQS queue to send events to. This only calls GetQueueUrl the first time."""
+        with self.lock:
+            if queue_name not in self.queue_urls:
+                self.queue_urls[queue_name] = get_client('sqs').get_queue_url(QueueName=queue_name)['QueueUrl']
+
+            return self.queue_urls[queue_name]
+
+    def clear(self):
+        """Empties out the cached queue URLs."""
+        with self.lock:
+            self.queue_urls.clear()
+
+    def send_entries(self, client, entries, destination):
+        return client.send_message_batch(Entries=entries, QueueUrl=destination)
+
+    def send(self, events, queue_url, batch_size=MAX_BATCH_ENTRIES, randomize_delay=0, group_ids=None):
+        """Sends the events to the SQS queue. The events are packed into as few batches as the SQS size limits allow,
+        with at most `batch_size` events in each.
+
+        For FIFO queues, `group_ids` are the message group IDs for each of the events (by default, all events are in
+        the same group). The batches are sent one at a time so that they stay in order.
+
+        :raises ProducerException: if any of the events could not be sent (after all the batches are attempted).
+        """
+        if COMPRESS_EVENTS:
+            events = [compress_event(event) if len(event.encode('utf-8')) > COMPRESSION_THRESHOLD else event
+                      for event in events]
+
+        if is_fifo_queue(queue_url):
+            group_ids = group_ids or ['historical'] * len(events)
+            records = [make_sqs_record(event, group_id=group_id) for event, group_id in zip(events, group_ids)]
+
+            self.run(self.send_batch, list(pack_batches(records, max_entries=min(batch_size, MAX_BATCH_ENTRIES))),
+                     queue_url, sequential=True)
+
+            return
+
+        records = [make_sqs_record(event, delay_seconds=get_random_delay(randomize_delay)) for event in events]
+        self.run(self.send_batch, list(pack_batches(records, max_entries=min(batch_size, MAX_BATCH_ENTRIES))),
+                 queue_url)
+
+
+PRODUCER = SQSProducer()
+
+
+def get_queue_url(queue_name):
+    """Get the URL of the SQS queue to send events to."""
+    return PRODUCER.get_queue_url(queue_name)
+
+
+def produce_events(events, queue_url, batch_size=MAX_BATCH_ENTRIES, randomize_delay=0, group_ids=None):
     """
     Efficiently sends events to the SQS event queue.
 
-    Note: SQS has a max size of 10 items.  Please be aware that this can make the messages go past size -- even
-    with shrinking messages!
+    Note: Batches are packed to stay under both the 10 item and the 256KB payload limits of SQS. Individual events
+    still need to be under 256KB. If `COMPRESS_EVENTS` is set, then large events are compressed.
 
     Events can get randomized delays, maximum of 900 seconds. Set that in `randomize_delay`
     :param events:
     :param queue_url:
     :param batch_size:
     :param randomize_delay:
+    :param group_ids: The message group IDs of the events for FIFO queues (ignored for standard queues).
     """
-    client = boto3.client('sqs', region_name=CURRENT_REGION)
-
-    for chunk in chunks(events, batch_size):
-        records = [make_sqs_record(event, delay_seconds=get_random_delay(randomize_delay)) for event in chunk]
-
-        client.send_message_batch(Entries=records, QueueUrl=queue_url)
+    PRODUCER.send(events, queue_url, batch_size=batch_size, randomize_delay=randomize_delay, group_ids=group_ids)
 
 
 def group_records_by_type(records, update_events):
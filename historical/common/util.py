@@ -5,35 +5,164 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Mike Grima <mgrima@netflix.com>
 """
+import base64
 import json
+import logging
+import zlib
+from contextlib import contextmanager
 
+from historical.common.claim_check import is_claim_check, redeem
+from historical.constants import COMPRESSED_EVENT_FIELD, LOGGING_LEVEL, POLLER_TIME_BUFFER, \
+    REPORT_BATCH_ITEM_FAILURES, SQS_MESSAGE_ID_FIELD
 
-def deserialize_records(records):
+logging.basicConfig()
+LOG = logging.getLogger('historical')
+LOG.setLevel(LOGGING_LEVEL)
+
+# When `COMPRESS_EVENTS` is set, events bigger than this (in bytes) are compressed before being sent:
+COMPRESSION_THRESHOLD = 32768
+
+
+def is_compressed(blob):
+    """Checks if the event blob is already in a compressed envelope."""
+    return blob.startswith('{"' + COMPRESSED_EVENT_FIELD + '"')
+
+
+def compress_event(blob):
+    """Wraps the event blob in a compressed (zlib + base64) envelope. This is still JSON, so it can be sent
+    through SNS and SQS. Use `load_event` to read it back.
+    """
+    if is_compressed(blob):
+        return blob
+
+    return json.dumps({COMPRESSED_EVENT_FIELD: base64.b64encode(zlib.compress(blob.encode('utf-8'))).decode('ascii')})
+
+
+def load_event(blob):
+    """Loads the JSON event blob -- transparently decompressing it if it is in a compressed envelope, and fetching
+    it from S3 if it is a claim check.
+    """
+    parsed = json.loads(blob)
+
+    if is_claim_check(parsed):
+        parsed = json.loads(redeem(parsed))
+
+    if isinstance(parsed, dict) and COMPRESSED_EVENT_FIELD in parsed:
+        parsed = json.loads(zlib.decompress(base64.b64decode(parsed[COMPRESSED_EVENT_FIELD])).decode('utf-8'))
+
+    return parsed
+
+
+def deserialize_record(record):
+    """Deserializes a single SQS record. Returns None if the record should be skipped."""
+    parsed = load_event(record['body'])
+
+    # Is this a DynamoDB stream event?
+    if isinstance(parsed, str):
+        native_record = load_event(parsed)
+
+    # Is this a subscription message from SNS? If so, skip it:
+    elif parsed.get('Type') == 'SubscriptionConfirmation':
+        return None
+
+    # Is this from SNS (cross-region request -- SNS messages wrapped in SQS message) -- or an SNS proxied message?
+    elif parsed.get('Message'):
+        native_record = load_event(parsed['Message'])
+
+    else:
+        native_record = parsed
+
+    if record.get('messageId'):
+        native_record[SQS_MESSAGE_ID_FIELD] = record['messageId']
+
+    return native_record
+
+
+def deserialize_records(records, failures=None):
     """
     This properly deserializes records depending on where they came from:
         - SQS
         - SNS
+
+    Compressed events are decompressed, and claim checks are redeemed. The ID of the SQS message that each record
+    came from is placed in the `SQS_MESSAGE_ID_FIELD` of the record.
+
+    If `failures` (see `BatchItemFailures`) is passed in, then each record is deserialized in isolation: records that
+    can't be deserialized (like a claim check for an event that no longer exists) are marked as failed and skipped.
+    Otherwise, the error is raised.
     """
     native_records = []
     for record in records:
-        parsed = json.loads(record['body'])
+        if failures is None:
+            native_record = deserialize_record(record)
 
-        # Is this a DynamoDB stream event?
-        if isinstance(parsed, str):
-            native_records.append(json.loads(parsed))
+        else:
+            # Failures are tracked by the SQS message ID -- which is all there is to go on for these records:
+            native_record = None
+            message = {SQS_MESSAGE_ID_FIELD: record['messageId']} if record.get('messageId') else {}
+            with failures.isolate(message):
+                native_record = deserialize_record(record)
 
-        # Is this a subscription message from SNS? If so, skip it:
-        elif parsed.get('Type') == 'SubscriptionConfirmation':
-            continue
+        if native_record is not None:
+            native_records.append(native_record)
 
-        # Is this from SNS (cross-region request -- SNS messages wrapped in SQS message) -- or an SNS proxied message?
-        elif parsed.get('Message'):
-            native_records.append(json.loads(parsed['Message']))
+    return native_records
 
-        else:
-            native_records.append(parsed)
 
-    return native_records
+class BatchItemFailures:
+    """Keeps track of the records in an SQS batch that failed to be processed.
+
+    Failures are isolated so that the rest of the batch can still be processed. If `REPORT_BATCH_ITEM_FAILURES` is
+    set, then only the SQS messages for the failed records are returned to SQS to be retried. Otherwise, the first
+    error is raised after the entire batch has been processed (which retries the entire batch).
+    """
+
+    def __init__(self):
+        self.failures = []
+
+    def add(self, exc, *records):
+        """Marks the given records as having failed with the given exception."""
+        LOG.error(f'[X] Unable to process {len(records)} record(s). Reason: {exc}')
+        self.failures.append((exc, records))
+
+    @contextmanager
+    def isolate(self, *records):
+        """Any exception raised in this context is marked as a failure for the given records."""
+        try:
+            yield
+
+        except Exception as exc:  # pylint: disable=W0703
+            self.add(exc, *records)
+
+    def get_message_ids(self):
+        """Gets the de-duplicated SQS message IDs of the records that failed."""
+        message_ids = []
+        for _, records in self.failures:
+            for record in records:
+                if record[SQS_MESSAGE_ID_FIELD] not in message_ids:
+                    message_ids.append(record[SQS_MESSAGE_ID_FIELD])
+
+        return message_ids
+
+    def raise_error(self):
+        """Raises the first error that was encountered (if any)."""
+        if self.failures:
+            raise self.failures[0][0]
+
+    def get_response(self):
+        """Gets the response for the Lambda handler to return -- or raises the first error."""
+        if not REPORT_BATCH_ITEM_FAILURES:
+            self.raise_error()
+            return None
+
+        # If a failed record is missing its message ID, then the entire batch needs to be retried:
+        try:
+            message_ids = self.get_message_ids()
+        except KeyError:
+            LOG.error('[X] Unable to determine the SQS message IDs for the failed records. Retrying the entire batch.')
+            self.raise_error()
+
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in message_ids]}
 
 
 def pull_tag_dict(data):
@@ -52,3 +181,8 @@ def pull_tag_dict(data):
         tags = proper_tags
 
     return tags
+
+
+def has_time_remaining(context):
+    """Checks if the Lambda function has enough time left to keep working (at least `POLLER_TIME_BUFFER` ms)."""
+    return context.get_remaining_time_in_millis() > POLLER_TIME_BUFFER
@@ -29,11 +29,71 @@ TTL_EXPIRY = int(os.environ.get('TTL_EXPIRY', 86400))
 # By default, don't randomize the pollers (tasker or collector -- same env var):
 RANDOMIZE_POLLER = int(os.environ.get('RANDOMIZE_POLLER', 0))
 
+# Pollers keep paginating within an invocation until the Lambda has less than this many milliseconds remaining:
+POLLER_TIME_BUFFER = int(os.environ.get('POLLER_TIME_BUFFER', 30000))
+
 CURRENT_REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
 HISTORICAL_ROLE = os.environ.get('HISTORICAL_ROLE', 'Historical')
 POLL_REGIONS = os.environ.get('POLL_REGIONS', 'us-east-1').split(",")
 PROXY_REGIONS = os.environ.get('PROXY_REGIONS', 'us-east-1').split(",")
 REGION_ATTR = os.environ.get('REGION_ATTR', 'Region')
 SIMPLE_DURABLE_PROXY = os.environ.get('SIMPLE_DURABLE_PROXY', False)
+
+# Have the (Current table) Proxy only forward the latest image for each ARN in a stream batch:
+PROXY_COALESCE_RECORDS = os.environ.get('PROXY_COALESCE_RECORDS', False)
+
+# The number of threads that the Differ uses to process the records for different ARNs concurrently (default is
+# serially):
+DIFFER_WORKERS = int(os.environ.get('DIFFER_WORKERS', 1))
+
+# Have the Differ diff against the OldImage in the Current table stream record (requires the NEW_AND_OLD_IMAGES stream
+# view type) instead of querying the Durable table for the previous revision:
+DIFFER_USE_OLD_IMAGE = os.environ.get('DIFFER_USE_OLD_IMAGE', False)
+
+# The number of ARNs that the Differ remembers the latest Durable table revision for across warm invocations (default is
+# disabled). This is only used for records from a FIFO Differ queue -- so that each ARN is only processed by one Differ
+# at a time:
+DIFFER_CACHE_SIZE = int(os.environ.get('DIFFER_CACHE_SIZE', 0))
+
+# The number of seconds that the Differ trusts a remembered revision for:
+DIFFER_CACHE_MAX_AGE = int(os.environ.get('DIFFER_CACHE_MAX_AGE', 300))
+
+# Store the Durable table revisions as deltas from a full "keyframe" revision that is stored every N revisions (default
+# is disabled -- every revision is stored in full):
+DURABLE_KEYFRAME_INTERVAL = int(os.environ.get('DURABLE_KEYFRAME_INTERVAL', 0))
+
+# The number of threads that collectors use to fetch resource details concurrently (default is serially):
+COLLECTOR_WORKERS = int(os.environ.get('COLLECTOR_WORKERS', 1))
+
+# Have the S3 Poller fetch the bucket details (with `COLLECTOR_WORKERS` threads) and embed them in the polling events
+# so that the Collector doesn't need to:
+S3_POLLER_COLLECT = os.environ.get('S3_POLLER_COLLECT', False)
+
+# Return the SQS message IDs of the records that failed to be processed instead of failing the entire batch.
+# This requires `ReportBatchItemFailures` to be enabled on the SQS event source mappings:
+REPORT_BATCH_ITEM_FAILURES = os.environ.get('REPORT_BATCH_ITEM_FAILURES', False)
+
+# The number of threads used to send batches of events to SQS concurrently, and the number of times that entries
+# which failed to send are retried:
+SQS_PRODUCER_WORKERS = int(os.environ.get('SQS_PRODUCER_WORKERS', 10))
+SQS_PRODUCER_RETRIES = int(os.environ.get('SQS_PRODUCER_RETRIES', 3))
+
+# The same -- but for publishing batches of events to SNS:
+SNS_PUBLISHER_WORKERS = int(os.environ.get('SNS_PUBLISHER_WORKERS', 10))
+SNS_PUBLISHER_RETRIES = int(os.environ.get('SNS_PUBLISHER_RETRIES', 3))
+
+# The maximum number of attempts that the boto3 clients make for each API call (default is botocore's own):
+CLIENT_MAX_ATTEMPTS = int(os.environ.get('CLIENT_MAX_ATTEMPTS', 0))
+
+# Send large events in a compressed (zlib + base64) envelope instead of shrinking them:
+COMPRESS_EVENTS = os.environ.get('COMPRESS_EVENTS', False)
+
+# Store events that are too big to send in this S3 bucket, and send a pointer to them (a claim check) instead:
+CLAIM_CHECK_BUCKET = os.environ.get('CLAIM_CHECK_BUCKET')
+CLAIM_CHECK_PREFIX = os.environ.get('CLAIM_CHECK_PREFIX', 'historical/events/')
+
 LOGGING_LEVEL = extract_log_level_from_environment('LOGGING_LEVEL', logging.INFO)
 EVENT_TOO_BIG_FLAG = 'event_too_big'
+SQS_MESSAGE_ID_FIELD = 'sqs_message_id'
+COMPRESSED_EVENT_FIELD = 'historical_compressed'
+CLAIM_CHECK_FIELD = 'historical_claim_check'
@@ -17,6 +17,10 @@ from historical.attributes import EventTimeAttribute, fix_decimals, HistoricalDe
 from historical.constants import TTL_EXPIRY
 
 
+# Paths to fields that change without the resource actually changing, which are ignored when diffing (for all
+# technologies). Paths are dotted (`*` matches every key or list item), like: `configuration.Rules.*.LastUpdated`.
+# Technology specific paths are defined once in the technology's models module, and are set on the `Meta` of both its
+# Durable and Current models as `ephemeral_paths`.
 EPHEMERAL_PATHS = []
 
 
@@ -40,10 +44,15 @@ class BaseHistoricalModel(Model):
         """
         for name, attr in self.get_attributes().items():
             try:
-                if isinstance(attr, MapAttribute):
+                if getattr(self, name) is None:
+                    yield name, None
+                elif isinstance(attr, MapAttribute):
                     name, obj = name, getattr(self, name).as_dict()
                     yield name, fix_decimals(obj)  # Don't forget to remove the stupid decimals :/
-                elif isinstance(attr, NumberAttribute) or isinstance(attr, HistoricalDecimalAttribute):
+                elif isinstance(attr, NumberAttribute):
+                    # (Numbers from DynamoDB stream images are Decimals):
+                    yield name, int(getattr(self, name))
+                elif isinstance(attr, HistoricalDecimalAttribute):
                     yield name, int(attr.serialize(getattr(self, name)))
                 elif isinstance(attr, ListAttribute):
                     name, obj = name, [el.as_dict() for el in getattr(self, name)]
@@ -61,6 +70,19 @@ class DurableHistoricalModel(BaseHistoricalModel):
 
     eventTime = EventTimeAttribute(range_key=True, default=default_event_time)
 
+    # A canonical hash of the parts of the revision that matter for diffing (see `get_revision_hash`):
+    configHash = UnicodeAttribute(null=True)
+
+    # Delta-encoded revisions (see `DURABLE_KEYFRAME_INTERVAL`) don't have a `configuration` -- so that they can't be
+    # mistaken for deletion markers (which have an empty one). Instead, they have the `eventTime` of the keyframe
+    # revision that has the full `configuration`, and the delta (JSON) from it:
+    configuration = MapAttribute(null=True)
+    keyframeEventTime = UnicodeAttribute(null=True)
+    configDelta = UnicodeAttribute(null=True)
+
+    # The number of revisions since the keyframe (0 for keyframes):
+    revisionSequence = NumberAttribute(null=True)
+
 
 class CurrentHistoricalModel(BaseHistoricalModel):
     """The base Historical Current Table model base class."""
@@ -68,6 +90,7 @@ class CurrentHistoricalModel(BaseHistoricalModel):
     eventTime = EventTimeAttribute(default=default_event_time)
     ttl = NumberAttribute(default=default_ttl())
     eventSource = UnicodeAttribute()
+    configFingerprint = UnicodeAttribute(null=True)
 
 
 class AWSHistoricalMixin(BaseHistoricalModel):
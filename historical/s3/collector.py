@@ -6,17 +6,19 @@
 .. author:: Mike Grima <mgrima@netflix.com>
 """
 import logging
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from itertools import groupby
 
 from botocore.exceptions import ClientError
-from pynamodb.exceptions import PynamoDBConnectionError
+from pynamodb.exceptions import PutError, PynamoDBConnectionError
 from raven_python_lambda import RavenLambdaWrapper
-from cloudaux.orchestration.aws.s3 import get_bucket
+from cloudaux.orchestration.aws.s3 import FLAGS, get_bucket
 
+from historical.common.dynamodb import save_current_revision
 from historical.common.sqs import group_records_by_type
-from historical.constants import CURRENT_REGION, HISTORICAL_ROLE, LOGGING_LEVEL
+from historical.constants import COLLECTOR_WORKERS, CURRENT_REGION, HISTORICAL_ROLE, LOGGING_LEVEL
 from historical.common import cloudwatch
-from historical.common.util import deserialize_records
+from historical.common.util import BatchItemFailures, deserialize_records
 from historical.s3.models import CurrentS3Model, VERSION
 
 logging.basicConfig()
@@ -51,6 +53,28 @@ DELETE_EVENTS = [
     'DeleteBucket',
 ]
 
+# The parts of the bucket (CloudAux `get_bucket` flags) that are modified by each update event. Only those parts are
+# fetched, and then merged into the bucket's existing configuration in the Current table. Events that are not listed
+# here (like `PollS3` and `CreateBucket`) fetch the entire bucket:
+EVENT_FLAGS = {
+    'DeleteBucketCors': FLAGS.CORS,
+    'DeleteBucketLifecycle': FLAGS.LIFECYCLE,
+    'DeleteBucketPolicy': FLAGS.POLICY,
+    'DeleteBucketReplication': FLAGS.REPLICATION,
+    'DeleteBucketTagging': FLAGS.TAGS,
+    'DeleteBucketWebsite': FLAGS.WEBSITE,
+    'PutBucketAcl': FLAGS.GRANTS | FLAGS.GRANT_REFERENCES | FLAGS.OWNER,
+    'PutBucketCors': FLAGS.CORS,
+    'PutBucketLifecycle': FLAGS.LIFECYCLE,
+    'PutBucketPolicy': FLAGS.POLICY,
+    'PutBucketLogging': FLAGS.LOGGING,
+    'PutBucketNotification': FLAGS.NOTIFICATIONS,
+    'PutBucketReplication': FLAGS.REPLICATION,
+    'PutBucketTagging': FLAGS.TAGS,
+    'PutBucketVersioning': FLAGS.VERSIONING,
+    'PutBucketWebsite': FLAGS.WEBSITE
+}
+
 
 def create_delete_model(record):
     """Create an S3 model from a record."""
@@ -74,30 +98,193 @@ def create_delete_model(record):
     return CurrentS3Model(**data)
 
 
-def process_delete_records(delete_records):
-    """Process the requests for S3 bucket deletions"""
+def process_delete_records(delete_records, failures=None):
+    """Process the requests for S3 bucket deletions
+
+    Failed records are tracked in `failures` (see `BatchItemFailures`). If that's not passed in, then the first
+    error is raised after all the records have been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
+
     for rec in delete_records:
-        arn = f"arn:aws:s3:::{rec['detail']['requestParameters']['bucketName']}"
-
-        # Need to check if the event is NEWER than the previous event in case
-        # events are out of order. This could *possibly* happen if something
-        # was deleted, and then quickly re-created. It could be *possible* for the
-        # deletion event to arrive after the creation event. Thus, this will check
-        # if the current event timestamp is newer and will only delete if the deletion
-        # event is newer.
-        try:
-            LOG.debug(f'[-] Deleting bucket: {arn}')
-            model = create_delete_model(rec)
-            model.save(condition=(CurrentS3Model.eventTime <= rec['detail']['eventTime']))
-            model.delete()
-
-        except PynamoDBConnectionError as pdce:
-            LOG.warning(f"[?] Unable to delete bucket: {arn}. Either it doesn't exist, or this deletion event is stale "
-                        f"(arrived before a NEWER creation/update). The specific exception is: {pdce}")
-
-
-def process_update_records(update_records):
-    """Process the requests for S3 bucket update requests"""
+        with batch_failures.isolate(rec):
+            arn = f"arn:aws:s3:::{rec['detail']['requestParameters']['bucketName']}"
+
+            # Need to check if the event is NEWER than the previous event in case
+            # events are out of order. This could *possibly* happen if something
+            # was deleted, and then quickly re-created. It could be *possible* for the
+            # deletion event to arrive after the creation event. Thus, this will check
+            # if the current event timestamp is newer and will only delete if the deletion
+            # event is newer.
+            try:
+                LOG.debug(f'[-] Deleting bucket: {arn}')
+                model = create_delete_model(rec)
+                model.save(condition=(CurrentS3Model.eventTime <= rec['detail']['eventTime']))
+                model.delete()
+
+            except PynamoDBConnectionError as pdce:
+                LOG.warning(f"[?] Unable to delete bucket: {arn}. Either it doesn't exist, or this deletion event is "
+                            f"stale (arrived before a NEWER creation/update). The specific exception is: {pdce}")
+
+    if failures is None:
+        batch_failures.raise_error()
+
+
+def get_event_flags(events):
+    """Gets the CloudAux `get_bucket` flags for the parts of a bucket that were modified by the given events.
+
+    Returns None if the entire bucket needs to be fetched.
+    """
+    flags = FLAGS.BASE
+    for event in events:
+        if event['detail']['eventName'] not in EVENT_FLAGS:
+            return None
+
+        flags |= EVENT_FLAGS[event['detail']['eventName']]
+
+    return flags
+
+
+def merge_bucket_details(existing, bucket_details):
+    """Merges the partially fetched details of a bucket into the bucket's existing Current table item.
+
+    The result looks like the output of a full `get_bucket`.
+    """
+    existing = dict(existing)
+    merged = existing['configuration']
+    merged['Region'] = existing['Region']
+    merged['Tags'] = existing['Tags']
+    merged.update(bucket_details)
+
+    return merged
+
+
+def fetch_bucket_details(b_name, account_id, item, flags=None, existing=None):
+    """Fetches the configuration details about a bucket from AWS.
+
+    If `flags` and the `existing` Current table item are passed in, then only the parts of the bucket specified by the
+    flags are fetched, and are merged into the existing item's configuration.
+
+    This returns None if the bucket's details could not be fetched (it was deleted, or access is denied).
+    """
+    LOG.debug(f'[~] Processing Create/Update for: {b_name}')
+    # If the bucket does not exist, then simply drop the request --
+    # If this happens, there is likely a Delete event that has occurred and will be processed soon.
+    try:
+        # Note: the get_bucket orchestration makes its own region specific clients (and a resource), so it can't be
+        # handed a single cached client. CloudAux caches the assumed role credentials for it.
+        if flags is not None and existing:
+            bucket_details = get_bucket(b_name,
+                                        account_number=account_id,
+                                        flags=flags,
+                                        assume_role=HISTORICAL_ROLE,
+                                        region=CURRENT_REGION)
+        else:
+            bucket_details = get_bucket(b_name,
+                                        account_number=account_id,
+                                        include_created=(item.get('creationDate') is None),
+                                        assume_role=HISTORICAL_ROLE,
+                                        region=CURRENT_REGION)
+
+        if bucket_details.get('Error'):
+            LOG.error(f"[X] Unable to fetch details about bucket: {b_name}. "
+                      f"The error details are: {bucket_details['Error']}")
+            return None
+
+    except ClientError as cerr:
+        if cerr.response['Error']['Code'] == 'NoSuchBucket':
+            LOG.warning(f'[?] Received update request for bucket: {b_name} that does not '
+                        'currently exist. Skipping.')
+            return None
+
+        # Catch Access Denied exceptions as well:
+        if cerr.response['Error']['Code'] == 'AccessDenied':
+            LOG.error(f'[X] Unable to fetch details for S3 Bucket: {b_name} in {account_id}. Access is Denied. '
+                      'Skipping...')
+            return None
+        raise Exception(cerr)
+
+    if flags is not None and existing:
+        bucket_details = merge_bucket_details(existing, bucket_details)
+
+    return bucket_details
+
+
+def save_bucket(b_name, account_id, item, bucket_details, existing=None):
+    """Saves the fetched bucket details to the Current table.
+
+    If the details were merged into the `existing` Current table item, then they are only saved if that item hasn't
+    been modified since it was read. Otherwise, a `PutError` is raised.
+    """
+    # Pull out the fields we want:
+    data = {
+        'arn': f'arn:aws:s3:::{b_name}',
+        'principalId': cloudwatch.get_principal(item['eventDetails']),
+        'userIdentity': cloudwatch.get_user_identity(item['eventDetails']),
+        'userAgent': item['eventDetails']['detail'].get('userAgent'),
+        'sourceIpAddress': item['eventDetails']['detail'].get('sourceIPAddress'),
+        'requestParameters': item['eventDetails']['detail'].get('requestParameters'),
+        'accountId': account_id,
+        'eventTime': item['eventDetails']['detail']['eventTime'],
+        'BucketName': b_name,
+        'Region': bucket_details.pop('Region'),
+        # Duplicated in top level and configuration for secondary index
+        'Tags': bucket_details.pop('Tags', {}) or {},
+        'eventSource': item['eventDetails']['detail']['eventSource'],
+        'eventName': item['eventDetails']['detail']['eventName'],
+        'version': VERSION
+    }
+
+    # Remove the fields we don't care about:
+    del bucket_details['Arn']
+    bucket_details.pop('GrantReferences', None)  # Not present for partial fetches that don't include the ACL
+    del bucket_details['_version']
+    del bucket_details['Name']
+
+    if not bucket_details.get('CreationDate'):
+        bucket_details['CreationDate'] = item['creationDate']
+
+    data['configuration'] = bucket_details
+
+    condition = None
+    if existing:
+        condition = CurrentS3Model.eventTime == existing.eventTime
+        if existing.configFingerprint:
+            condition &= CurrentS3Model.configFingerprint == existing.configFingerprint
+
+    save_current_revision(CurrentS3Model, data, condition=condition)
+
+
+def save_fetched_bucket(b_name, account_id, item, bucket_details, existing=None):
+    """Saves the fetched bucket details to the Current table.
+
+    If the details were merged into the `existing` Current table item, and that item was modified in the meantime
+    (by a concurrent Collector), then the entire bucket is fetched and saved instead -- so that the other changes
+    are not overwritten or lost.
+    """
+    try:
+        save_bucket(b_name, account_id, item, bucket_details, existing=existing)
+
+    except PutError as perr:
+        if not existing:
+            raise
+
+        LOG.warning(f'[?] Bucket: {b_name} was modified while its changed parts were being fetched. Fetching the '
+                    f'entire bucket instead. The specific exception is: {perr}')
+        bucket_details = fetch_bucket_details(b_name, account_id, item)
+        if bucket_details:
+            save_bucket(b_name, account_id, item, bucket_details)
+
+
+def process_update_records(update_records, failures=None):
+    """Process the requests for S3 bucket update requests
+
+    The bucket details are fetched concurrently (up to `COLLECTOR_WORKERS` at a time) for each account. A failure to
+    fetch one bucket does not prevent the other buckets from being saved. Failed records are tracked in `failures`
+    (see `BatchItemFailures`). If that's not passed in, then the first error is raised after all the buckets have
+    been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
     events = sorted(update_records, key=lambda x: x['account'])
 
     # Group records by account for more efficient processing
@@ -106,7 +293,10 @@ def process_update_records(update_records):
 
         # Grab the bucket names (de-dupe events):
         buckets = {}
+        bucket_events = {}
         for event in events:
+            bucket_events.setdefault(event['detail']['requestParameters']['bucketName'], []).append(event)
+
             # If the creation date is present, then use it:
             bucket_event = buckets.get(event['detail']['requestParameters']['bucketName'], {
                 'creationDate': event['detail']['requestParameters'].get('creationDate')
@@ -116,67 +306,42 @@ def process_update_records(update_records):
             buckets[event['detail']['requestParameters']['bucketName']] = bucket_event
             buckets[event['detail']['requestParameters']['bucketName']]['eventDetails'] = event
 
+        # Buckets that the Poller already collected the details for don't need to be fetched (as long as there were
+        # no other events for them in this batch):
+        collected = {b_name: cloudwatch.get_collected_details(b_events[-1])
+                     for b_name, b_events in bucket_events.items()
+                     if all(cloudwatch.get_collected_details(event) for event in b_events)}
+
+        # All the events for a bucket are coalesced -- so if the bucket fails, then all of them have failed:
+        for b_name, bucket_details in collected.items():
+            LOG.debug(f'[<--] Received already collected details for bucket: {b_name}')
+            with batch_failures.isolate(*bucket_events[b_name]):
+                save_bucket(b_name, account_id, buckets[b_name], bucket_details)
+
+        # Only the parts of the buckets that changed need to be fetched -- if the buckets are already in the
+        # Current table. These are read consistently, since the changes are merged into them:
+        bucket_flags = {b_name: get_event_flags(b_events) for b_name, b_events in bucket_events.items()}
+        partial = [f'arn:aws:s3:::{b_name}' for b_name, flags in bucket_flags.items() if flags is not None]
+        existing = {item.BucketName: item
+                    for item in (CurrentS3Model.batch_get(partial, consistent_read=True) if partial else [])
+                    if item.version == VERSION}
+
         # Query AWS for current configuration
-        for b_name, item in buckets.items():
-            LOG.debug(f'[~] Processing Create/Update for: {b_name}')
-            # If the bucket does not exist, then simply drop the request --
-            # If this happens, there is likely a Delete event that has occurred and will be processed soon.
-            try:
-                bucket_details = get_bucket(b_name,
-                                            account_number=account_id,
-                                            include_created=(item.get('creationDate') is None),
-                                            assume_role=HISTORICAL_ROLE,
-                                            region=CURRENT_REGION)
-                if bucket_details.get('Error'):
-                    LOG.error(f"[X] Unable to fetch details about bucket: {b_name}. "
-                              f"The error details are: {bucket_details['Error']}")
-                    continue
-
-            except ClientError as cerr:
-                if cerr.response['Error']['Code'] == 'NoSuchBucket':
-                    LOG.warning(f'[?] Received update request for bucket: {b_name} that does not '
-                                'currently exist. Skipping.')
-                    continue
-
-                # Catch Access Denied exceptions as well:
-                if cerr.response['Error']['Code'] == 'AccessDenied':
-                    LOG.error(f'[X] Unable to fetch details for S3 Bucket: {b_name} in {account_id}. Access is Denied. '
-                              'Skipping...')
-                    continue
-                raise Exception(cerr)
-
-            # Pull out the fields we want:
-            data = {
-                'arn': f'arn:aws:s3:::{b_name}',
-                'principalId': cloudwatch.get_principal(item['eventDetails']),
-                'userIdentity': cloudwatch.get_user_identity(item['eventDetails']),
-                'userAgent': item['eventDetails']['detail'].get('userAgent'),
-                'sourceIpAddress': item['eventDetails']['detail'].get('sourceIPAddress'),
-                'requestParameters': item['eventDetails']['detail'].get('requestParameters'),
-                'accountId': account_id,
-                'eventTime': item['eventDetails']['detail']['eventTime'],
-                'BucketName': b_name,
-                'Region': bucket_details.pop('Region'),
-                # Duplicated in top level and configuration for secondary index
-                'Tags': bucket_details.pop('Tags', {}) or {},
-                'eventSource': item['eventDetails']['detail']['eventSource'],
-                'eventName': item['eventDetails']['detail']['eventName'],
-                'version': VERSION
-            }
-
-            # Remove the fields we don't care about:
-            del bucket_details['Arn']
-            del bucket_details['GrantReferences']
-            del bucket_details['_version']
-            del bucket_details['Name']
-
-            if not bucket_details.get('CreationDate'):
-                bucket_details['CreationDate'] = item['creationDate']
-
-            data['configuration'] = bucket_details
-
-            current_revision = CurrentS3Model(**data)
-            current_revision.save()
+        with ThreadPoolExecutor(max_workers=COLLECTOR_WORKERS) as executor:
+            futures = {executor.submit(fetch_bucket_details, b_name, account_id, item, flags=bucket_flags[b_name],
+                                       existing=existing.get(b_name)): b_name
+                       for b_name, item in buckets.items() if b_name not in collected}
+
+            for future in as_completed(futures):
+                b_name = futures[future]
+                with batch_failures.isolate(*bucket_events[b_name]):
+                    bucket_details = future.result()
+                    if bucket_details:
+                        save_fetched_bucket(b_name, account_id, buckets[b_name], bucket_details,
+                                            existing=existing.get(b_name) if bucket_flags[b_name] else None)
+
+    if failures is None:
+        batch_failures.raise_error()
 
 
 @RavenLambdaWrapper()
@@ -186,18 +351,21 @@ def handler(event, context):  # pylint: disable=W0613
 
     This collector is responsible for processing CloudWatch events and polling events.
     """
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     # Split records into two groups, update and delete.
     # We don't want to query for deleted records.
     update_records, delete_records = group_records_by_type(records, UPDATE_EVENTS)
 
     LOG.debug('[@] Processing update records...')
-    process_update_records(update_records)
+    process_update_records(update_records, failures=failures)
     LOG.debug('[@] Completed processing of update records.')
 
     LOG.debug('[@] Processing delete records...')
-    process_delete_records(delete_records)
+    process_delete_records(delete_records, failures=failures)
     LOG.debug('[@] Completed processing of delete records.')
 
     LOG.debug('[@] Successfully updated current Historical table')
+
+    return failures.get_response()
@@ -9,18 +9,16 @@ import logging
 
 from raven_python_lambda import RavenLambdaWrapper
 
-from historical.common.util import deserialize_records
+from historical.common.sqs import is_fifo_event
+from historical.common.util import BatchItemFailures, deserialize_records
 from historical.constants import LOGGING_LEVEL
 from historical.s3.models import CurrentS3Model, DurableS3Model
-from historical.common.dynamodb import process_dynamodb_differ_record
+from historical.common.dynamodb import process_differ_records
 
 logging.basicConfig()
 LOG = logging.getLogger('historical')
 LOG.setLevel(LOGGING_LEVEL)
 
-# Path to where in the dict the ephemeral field is -- starting with "root['M'][PathInConfigDontForgetDataType]..."
-# EPHEMERAL_PATHS = []
-
 
 @RavenLambdaWrapper()
 def handler(event, context):  # pylint: disable=W0613
@@ -31,7 +29,9 @@ def handler(event, context):  # pylint: disable=W0613
     historical record.
     """
     # De-serialize the records:
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
+
+    process_differ_records(records, CurrentS3Model, DurableS3Model, failures, fifo=is_fifo_event(event))
 
-    for record in records:
-        process_dynamodb_differ_record(record, CurrentS3Model, DurableS3Model)
+    return failures.get_response()
@@ -16,6 +16,12 @@ from historical.models import AWSHistoricalMixin, CurrentHistoricalModel, Durabl
 # The schema version -- TODO: Get this from CloudAux
 VERSION = 9
 
+# Paths to fields that change without the bucket changing (see `historical.models.EPHEMERAL_PATHS`). The display names
+# of the logging grantees are their account names -- which aren't a part of the bucket:
+S3_EPHEMERAL_PATHS = [
+    'configuration.Logging.Grants.*.DisplayName',
+]
+
 
 class S3Model:
     """S3 specific fields for DynamoDB."""
@@ -33,6 +39,7 @@ class DurableS3Model(DurableHistoricalModel, AWSHistoricalMixin, S3Model):
         table_name = 'HistoricalS3DurableTable'
         region = CURRENT_REGION
         tech = 's3'
+        ephemeral_paths = S3_EPHEMERAL_PATHS
 
 
 class CurrentS3Model(CurrentHistoricalModel, AWSHistoricalMixin, S3Model):
@@ -44,6 +51,7 @@ class CurrentS3Model(CurrentHistoricalModel, AWSHistoricalMixin, S3Model):
         table_name = 'HistoricalS3CurrentTable'
         region = CURRENT_REGION
         tech = 's3'
+        ephemeral_paths = S3_EPHEMERAL_PATHS
 
 
 class S3PollingRequestParamsModel(Schema):
@@ -91,22 +99,28 @@ class S3PollingEventModel(HistoricalPollingBaseModel):
 
         return data
 
-    def serialize_me(self, account, bucket_details):
+    def serialize_me(self, account, bucket_details, collected=None):
         """Serializes the JSON for the Polling Event Model.
 
         :param account:
         :param bucket_details:
+        :param collected: The full bucket details (from CloudAux's `get_bucket`) if the Poller fetched them.
         :return:
         """
+        detail = {
+            "request_parameters": {
+                "bucket_name": bucket_details["Name"],
+                "creation_date": bucket_details["CreationDate"].replace(
+                    tzinfo=None, microsecond=0).isoformat() + "Z"
+            }
+        }
+
+        if collected:
+            detail["collected"] = collected
+
         return self.dumps({
             "account": account,
-            "detail": {
-                "request_parameters": {
-                    "bucket_name": bucket_details["Name"],
-                    "creation_date": bucket_details["CreationDate"].replace(
-                        tzinfo=None, microsecond=0).isoformat() + "Z"
-                }
-            }
+            "detail": detail
         }).data
 
 
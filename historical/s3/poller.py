@@ -7,6 +7,7 @@
 """
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
 
@@ -14,10 +15,15 @@ from cloudaux.aws.s3 import list_buckets
 
 from raven_python_lambda import RavenLambdaWrapper
 
+from historical.common.batch import MAX_MESSAGE_BYTES
+from historical.common.exceptions import ProducerException
+from historical.common.session import get_client, log_stats
 from historical.common.sqs import get_queue_url, produce_events
-from historical.common.util import deserialize_records
-from historical.constants import CURRENT_REGION, HISTORICAL_ROLE, LOGGING_LEVEL, RANDOMIZE_POLLER
+from historical.common.util import BatchItemFailures, deserialize_records, has_time_remaining
+from historical.constants import COLLECTOR_WORKERS, CURRENT_REGION, HISTORICAL_ROLE, LOGGING_LEVEL, RANDOMIZE_POLLER, \
+    S3_POLLER_COLLECT
 from historical.models import HistoricalPollerTaskEventModel
+from historical.s3.collector import fetch_bucket_details
 from historical.s3.models import S3_POLLING_SCHEMA
 from historical.common.accounts import get_historical_accounts
 
@@ -25,6 +31,11 @@ logging.basicConfig()
 LOG = logging.getLogger("historical")
 LOG.setLevel(LOGGING_LEVEL)
 
+# Events with collected details are sent as long as they fit in a single SQS message (with some room left over for the
+# message envelope). The events are packed into batches by size, so a big event just gets a batch of its own. Events
+# that are too big are sent without the details (the Collector will fetch them instead):
+MAX_COLLECTED_EVENT_SIZE = MAX_MESSAGE_BYTES - 1024
+
 
 @RavenLambdaWrapper()
 def poller_tasker_handler(event, context):  # pylint: disable=W0613
@@ -48,12 +59,52 @@ def poller_tasker_handler(event, context):  # pylint: disable=W0613
 
     try:
         produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
-    except ClientError as exc:
+    except (ClientError, ProducerException) as exc:
         LOG.error(f'[X] Unable to generate poller tasker events! Reason: {exc}')
 
     LOG.debug('[@] Finished tasking the pollers.')
 
 
+def collect_bucket(account_id, bucket, context=None):
+    """Fetches the details for a bucket from the list of buckets. Returns None if they couldn't be fetched -- or if
+    the Lambda function is running out of time (see `has_time_remaining`)."""
+    if context and not has_time_remaining(context):
+        LOG.debug(f"[?] Out of time. The Collector will fetch the details for bucket: {bucket['Name']} instead.")
+        return None
+
+    try:
+        return fetch_bucket_details(bucket['Name'], account_id, {'creationDate': bucket['CreationDate']})
+
+    except Exception as exc:  # pylint: disable=W0703
+        LOG.error(f"[X] Unable to collect details for bucket: {bucket['Name']} in {account_id}. The Collector will "
+                  f"fetch them instead. Reason: {exc}")
+
+    return None
+
+
+def make_collected_events(account_id, buckets, context=None):
+    """Makes the polling events for the buckets with the bucket details embedded in them.
+
+    The details are fetched concurrently (up to `COLLECTOR_WORKERS` at a time). If the details for a bucket can't be
+    fetched -- or are too big to send to SQS -- then the event is sent without them, and the Collector will fetch them.
+    The same goes for all the remaining buckets once the Lambda `context` is running out of time.
+    """
+    with ThreadPoolExecutor(max_workers=COLLECTOR_WORKERS) as executor:
+        collected = executor.map(lambda bucket: collect_bucket(account_id, bucket, context=context), buckets)
+
+    events = []
+    for bucket, details in zip(buckets, collected):
+        event = S3_POLLING_SCHEMA.serialize_me(account_id, bucket, collected=details)
+
+        if len(event.encode('utf-8')) > MAX_COLLECTED_EVENT_SIZE:
+            LOG.debug(f"[?] Collected details for bucket: {bucket['Name']} are too big to send. Omitting them.")
+            event = S3_POLLING_SCHEMA.serialize_me(account_id, bucket)
+
+        events.append(event)
+
+    return events
+
+
 @RavenLambdaWrapper()
 def poller_processor_handler(event, context):  # pylint: disable=W0613
     """
@@ -67,21 +118,29 @@ def poller_processor_handler(event, context):  # pylint: disable=W0613
 
     queue_url = get_queue_url(os.environ.get('POLLER_QUEUE_NAME', 'HistoricalS3Poller'))
 
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     for record in records:
-        # Skip accounts that have role assumption errors:
-        try:
-            # List all buckets in the account:
-            all_buckets = list_buckets(account_number=record['account_id'],
-                                       assume_role=HISTORICAL_ROLE,
-                                       session_name="historical-cloudwatch-s3list",
-                                       region=record['region'])["Buckets"]
-
-            events = [S3_POLLING_SCHEMA.serialize_me(record['account_id'], bucket) for bucket in all_buckets]
-            produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
-        except ClientError as exc:
-            LOG.error(f"[X] Unable to generate events for account. Account Id: {record['account_id']} Reason: {exc}")
-
-        LOG.debug(f"[@] Finished generating polling events for account: {record['account_id']}. Events Created:"
-                  f" {len(record['account_id'])}")
+        with failures.isolate(record):
+            # Skip accounts that have role assumption errors:
+            try:
+                # List all buckets in the account:
+                client = get_client('s3', account_number=record['account_id'], assume_role=HISTORICAL_ROLE,
+                                    region=record['region'])
+                all_buckets = list_buckets(force_client=client)["Buckets"]
+
+                if S3_POLLER_COLLECT:
+                    events = make_collected_events(record['account_id'], all_buckets, context=context)
+                else:
+                    events = [S3_POLLING_SCHEMA.serialize_me(record['account_id'], bucket) for bucket in all_buckets]
+                produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
+            except (ClientError, ProducerException) as exc:
+                LOG.error(f"[X] Unable to generate events for account. Account Id: {record['account_id']} "
+                          f"Reason: {exc}")
+
+            LOG.debug(f"[@] Finished generating polling events for account: {record['account_id']}. Events Created:"
+                      f" {len(record['account_id'])}")
+
+    log_stats()
+    return failures.get_response()
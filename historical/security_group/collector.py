@@ -5,7 +5,9 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Kevin Glisson <kglisson@netflix.com>
 """
+import copy
 import logging
+from itertools import groupby
 
 from botocore.exceptions import ClientError
 from pynamodb.exceptions import DeleteError
@@ -14,10 +16,12 @@ from raven_python_lambda import RavenLambdaWrapper
 
 from cloudaux.aws.ec2 import describe_security_groups
 
-from historical.common.sqs import group_records_by_type
+from historical.common.dynamodb import save_current_revision
+from historical.common.session import get_client, log_stats
+from historical.common.sqs import chunks, group_records_by_type
 from historical.constants import HISTORICAL_ROLE, LOGGING_LEVEL
 from historical.common import cloudwatch
-from historical.common.util import deserialize_records, pull_tag_dict
+from historical.common.util import BatchItemFailures, deserialize_records, pull_tag_dict
 from historical.security_group.models import CurrentSecurityGroupModel, VERSION
 
 logging.basicConfig()
@@ -38,39 +42,106 @@ DELETE_EVENTS = [
     'DeleteSecurityGroup'
 ]
 
+# The maximum number of Group IDs to describe in a single DescribeSecurityGroups call:
+DESCRIBE_BATCH_SIZE = 200
+
 
 def get_arn(group_id, region, account_id):
     """Creates a security group ARN."""
     return f'arn:aws:ec2:{region}:{account_id}:security-group/{group_id}'
 
 
-def describe_group(record, region):
-    """Attempts to  describe group ids."""
+def get_group_id(record):
+    """Gets the Group ID out of the event (if it's present)."""
+    return cloudwatch.filter_request_parameters('groupId', record, look_in_response=True)
+
+
+def get_update_key(record):
+    """Gets the key that identifies the security group that an update event refers to.
+
+    This is the Group ID if it's present -- otherwise it's the VPC ID/Group Name pair.
+    """
+    collected = cloudwatch.get_collected_details(record)
+    group_id = collected['GroupId'] if collected else get_group_id(record)
+    if group_id:
+        return record['account'], cloudwatch.get_region(record), group_id
+
+    return (record['account'], cloudwatch.get_region(record), cloudwatch.filter_request_parameters('vpcId', record),
+            cloudwatch.filter_request_parameters('groupName', record))
+
+
+def describe_groups_in_bulk(account_id, region, group_ids):
+    """Describes a list of security groups in an account/region with as few API calls as possible.
+
+    Returns a dict of Group ID -> the described security group. Groups that no longer exist are omitted.
+    """
+    client = get_client('ec2', account_number=account_id, assume_role=HISTORICAL_ROLE, region=region)
+    groups = {}
+    for chunk in chunks(group_ids, DESCRIBE_BATCH_SIZE):
+        try:
+            described = describe_security_groups(
+                force_client=client,
+                GroupIds=chunk
+            )['SecurityGroups']
+
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != 'InvalidGroup.NotFound':
+                raise exc
+
+            # At least one of the groups was deleted -- describe them one at a time to find the ones that remain:
+            LOG.debug(f'[?] Some groups in the batch were not found. Describing them individually. Groups: {chunk}')
+            described = []
+            for group_id in chunk:
+                try:
+                    described += describe_security_groups(
+                        force_client=client,
+                        GroupIds=[group_id]
+                    )['SecurityGroups']
+                except ClientError as exc:
+                    if exc.response['Error']['Code'] != 'InvalidGroup.NotFound':
+                        raise exc
+
+        for group in described:
+            groups[group['GroupId']] = group
+
+    return groups
+
+
+def describe_group(record, region, described_groups=None):
+    """Attempts to  describe group ids.
+
+    If `described_groups` is passed in, then groups with IDs will be looked up from there (see
+    `describe_groups_in_bulk`) instead of being described individually.
+    """
     account_id = record['account']
     group_name = cloudwatch.filter_request_parameters('groupName', record)
     vpc_id = cloudwatch.filter_request_parameters('vpcId', record)
-    group_id = cloudwatch.filter_request_parameters('groupId', record, look_in_response=True)
+    group_id = get_group_id(record)
 
     # Did this get collected already by the poller?
     if cloudwatch.get_collected_details(record):
         LOG.debug(f"[<--] Received already collected security group data: {record['detail']['collected']}")
         return [record['detail']['collected']]
 
+    # Was this already described in bulk? (Copy it, since the details get modified before saving)
+    if group_id and described_groups is not None:
+        if described_groups.get(group_id):
+            return [copy.deepcopy(described_groups[group_id])]
+
+        return []
+
+    client = get_client('ec2', account_number=account_id, assume_role=HISTORICAL_ROLE, region=region)
     try:
         # Always depend on Group ID first:
         if group_id:  # pylint: disable=R1705
             return describe_security_groups(
-                account_number=account_id,
-                assume_role=HISTORICAL_ROLE,
-                region=region,
+                force_client=client,
                 GroupIds=[group_id]
             )['SecurityGroups']
 
         elif vpc_id and group_name:
             return describe_security_groups(
-                account_number=account_id,
-                assume_role=HISTORICAL_ROLE,
-                region=region,
+                force_client=client,
                 Filters=[
                     {
                         'Name': 'group-name',
@@ -119,55 +190,105 @@ def create_delete_model(record):
     return None
 
 
-def capture_delete_records(records):
-    """Writes all of our delete events to DynamoDB."""
-    for rec in records:
-        model = create_delete_model(rec)
-        if model:
-            try:
-                model.delete(condition=(CurrentSecurityGroupModel.eventTime <= rec['detail']['eventTime']))
-            except DeleteError:
-                LOG.warning(f'[X] Unable to delete security group. Security group does not exist. Record: {rec}')
-        else:
-            LOG.warning(f'[?] Unable to delete security group. Security group does not exist. Record: {rec}')
+def capture_delete_records(records, failures=None):
+    """Writes all of our delete events to DynamoDB.
 
+    Failed records are tracked in `failures` (see `BatchItemFailures`). If that's not passed in, then the first
+    error is raised after all the records have been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
 
-def capture_update_records(records):
-    """Writes all updated configuration info to DynamoDB"""
     for rec in records:
-        data = cloudwatch.get_historical_base_info(rec)
-        group = describe_group(rec, cloudwatch.get_region(rec))
+        with batch_failures.isolate(rec):
+            model = create_delete_model(rec)
+            if model:
+                try:
+                    model.delete(condition=(CurrentSecurityGroupModel.eventTime <= rec['detail']['eventTime']))
+                except DeleteError:
+                    LOG.warning(f'[X] Unable to delete security group. Security group does not exist. Record: {rec}')
+            else:
+                LOG.warning(f'[?] Unable to delete security group. Security group does not exist. Record: {rec}')
+
+    if failures is None:
+        batch_failures.raise_error()
+
 
-        if len(group) > 1:
-            raise Exception(f'[X] Multiple groups found. Record: {rec}')
+def capture_update_records(records, failures=None):
+    """Writes all updated configuration info to DynamoDB
 
-        if not group:
-            LOG.warning(f'[?] No group information found. Record: {rec}')
+    Failed records are tracked in `failures` (see `BatchItemFailures`). If that's not passed in, then the first
+    error is raised after all the records have been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
+
+    # Only the newest event for each security group needs to be processed:
+    total = len(records)
+    coalesced = cloudwatch.group_records(records, get_update_key)
+    records = cloudwatch.coalesce_records(records, get_update_key)
+    LOG.debug(f'[@] Coalesced {total} update records into {len(records)} security group updates.')
+
+    # Group the records by account/region so that the security groups can be described in bulk:
+    def account_region(rec):
+        return rec['account'], cloudwatch.get_region(rec)
+
+    for (account_id, region), grouped_records in groupby(sorted(records, key=account_region), account_region):
+        grouped_records = list(grouped_records)
+
+        # Only the groups with IDs that the poller didn't already collect need to be described:
+        group_ids = {get_group_id(rec) for rec in grouped_records if not cloudwatch.get_collected_details(rec)}
+        group_ids.discard(None)
+
+        try:
+            described_groups = describe_groups_in_bulk(account_id, region, sorted(group_ids)) if group_ids else None
+        except Exception as exc:  # pylint: disable=W0703
+            # (All the events that were coalesced into these have failed too):
+            batch_failures.add(exc, *[coalesced_rec for rec in grouped_records
+                                      for coalesced_rec in coalesced[get_update_key(rec)]])
             continue
 
-        group = group[0]
+        for rec in grouped_records:
+            # All the events for a security group are coalesced -- so if it fails, then all of them have failed:
+            with batch_failures.isolate(*coalesced[get_update_key(rec)]):
+                capture_update_record(rec, described_groups=described_groups)
+
+    if failures is None:
+        batch_failures.raise_error()
+
+
+def capture_update_record(rec, described_groups=None):
+    """Writes the updated configuration info for a single record to DynamoDB."""
+    data = cloudwatch.get_historical_base_info(rec)
+    group = describe_group(rec, cloudwatch.get_region(rec), described_groups=described_groups)
 
-        # Determine event data for group - and pop off items that are going to the top-level:
-        LOG.debug(f'Processing group. Group: {group}')
-        data.update({
-            'GroupId': group['GroupId'],
-            'GroupName': group.pop('GroupName'),
-            'VpcId': group.pop('VpcId', None),
-            'arn': get_arn(group.pop('GroupId'), cloudwatch.get_region(rec), group.pop('OwnerId')),
-            'Region': cloudwatch.get_region(rec)
-        })
+    if len(group) > 1:
+        raise Exception(f'[X] Multiple groups found. Record: {rec}')
 
-        data['Tags'] = pull_tag_dict(group)
+    if not group:
+        LOG.warning(f'[?] No group information found. Record: {rec}')
+        return
 
-        # Set the remaining items to the configuration:
-        data['configuration'] = group
+    group = group[0]
 
-        # Set the version:
-        data['version'] = VERSION
+    # Determine event data for group - and pop off items that are going to the top-level:
+    LOG.debug(f'Processing group. Group: {group}')
+    data.update({
+        'GroupId': group['GroupId'],
+        'GroupName': group.pop('GroupName'),
+        'VpcId': group.pop('VpcId', None),
+        'arn': get_arn(group.pop('GroupId'), cloudwatch.get_region(rec), group.pop('OwnerId')),
+        'Region': cloudwatch.get_region(rec)
+    })
 
-        LOG.debug(f'[+] Writing Dynamodb Record. Records: {data}')
-        current_revision = CurrentSecurityGroupModel(**data)
-        current_revision.save()
+    data['Tags'] = pull_tag_dict(group)
+
+    # Set the remaining items to the configuration:
+    data['configuration'] = group
+
+    # Set the version:
+    data['version'] = VERSION
+
+    LOG.debug(f'[+] Writing Dynamodb Record. Records: {data}')
+    save_current_revision(CurrentSecurityGroupModel, data)
 
 
 @RavenLambdaWrapper()
@@ -176,12 +297,13 @@ def handler(event, context):  # pylint: disable=W0613
     Historical security group event collector.
     This collector is responsible for processing Cloudwatch events and polling events.
     """
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     # Split records into two groups, update and delete.
     # We don't want to query for deleted records.
     update_records, delete_records = group_records_by_type(records, UPDATE_EVENTS)
-    capture_delete_records(delete_records)
+    capture_delete_records(delete_records, failures=failures)
 
     # filter out error events
     update_records = [e for e in update_records if not e['detail'].get('errorCode')]
@@ -189,4 +311,7 @@ def handler(event, context):  # pylint: disable=W0613
     # group records by account for more efficient processing
     LOG.debug(f'[@] Update Records: {records}')
 
-    capture_update_records(update_records)
+    capture_update_records(update_records, failures=failures)
+
+    log_stats()
+    return failures.get_response()
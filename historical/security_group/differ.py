@@ -9,8 +9,9 @@ import logging
 
 from raven_python_lambda import RavenLambdaWrapper
 
-from historical.common.dynamodb import process_dynamodb_differ_record
-from historical.common.util import deserialize_records
+from historical.common.dynamodb import process_differ_records
+from historical.common.sqs import is_fifo_event
+from historical.common.util import BatchItemFailures, deserialize_records
 from historical.security_group.models import CurrentSecurityGroupModel, DurableSecurityGroupModel
 from historical.constants import LOGGING_LEVEL
 
@@ -28,7 +29,10 @@ def handler(event, context):  # pylint: disable=W0613
     historical record.
     """
     # De-serialize the records:
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
-    for record in records:
-        process_dynamodb_differ_record(record, CurrentSecurityGroupModel, DurableSecurityGroupModel)
+    process_differ_records(records, CurrentSecurityGroupModel, DurableSecurityGroupModel, failures,
+                           fifo=is_fifo_event(event))
+
+    return failures.get_response()
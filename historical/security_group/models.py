@@ -15,6 +15,13 @@ from historical.models import AWSHistoricalMixin, CurrentHistoricalModel, Durabl
 
 VERSION = 1
 
+# Paths to fields that change without the security group changing (see `historical.models.EPHEMERAL_PATHS`). The
+# status of the VPC peering connection that a rule references changes on its own:
+SECURITY_GROUP_EPHEMERAL_PATHS = [
+    'configuration.IpPermissions.*.UserIdGroupPairs.*.PeeringStatus',
+    'configuration.IpPermissionsEgress.*.UserIdGroupPairs.*.PeeringStatus',
+]
+
 
 class SecurityGroupModel:
     """Security Group specific fields for DynamoDB."""
@@ -34,6 +41,7 @@ class DurableSecurityGroupModel(DurableHistoricalModel, AWSHistoricalMixin, Secu
         table_name = 'HistoricalSecurityGroupDurableTable'
         region = CURRENT_REGION
         tech = 'securitygroup'
+        ephemeral_paths = SECURITY_GROUP_EPHEMERAL_PATHS
 
 
 class CurrentSecurityGroupModel(CurrentHistoricalModel, AWSHistoricalMixin, SecurityGroupModel):
@@ -45,6 +53,7 @@ class CurrentSecurityGroupModel(CurrentHistoricalModel, AWSHistoricalMixin, Secu
         table_name = 'HistoricalSecurityGroupCurrentTable'
         region = CURRENT_REGION
         tech = 'securitygroup'
+        ephemeral_paths = SECURITY_GROUP_EPHEMERAL_PATHS
 
 
 class SecurityGroupPollingEventDetail(HistoricalPollingEventDetail):
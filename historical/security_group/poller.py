@@ -14,8 +14,10 @@ from botocore.exceptions import ClientError
 from raven_python_lambda import RavenLambdaWrapper
 from cloudaux.aws.ec2 import describe_security_groups
 
+from historical.common.exceptions import ProducerException
+from historical.common.session import get_client, log_stats
 from historical.common.sqs import get_queue_url, produce_events
-from historical.common.util import deserialize_records
+from historical.common.util import BatchItemFailures, deserialize_records, has_time_remaining
 from historical.constants import HISTORICAL_ROLE, LOGGING_LEVEL, POLL_REGIONS, RANDOMIZE_POLLER
 from historical.models import HistoricalPollerTaskEventModel
 from historical.security_group.models import SECURITY_GROUP_POLLING_SCHEMA
@@ -51,14 +53,14 @@ def poller_tasker_handler(event, context):  # pylint: disable=W0613
 
     try:
         produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
-    except ClientError as exc:
+    except (ClientError, ProducerException) as exc:
         LOG.error(f'[X] Unable to generate poller tasker events! Reason: {exc}')
 
     LOG.debug('[@] Finished tasking the pollers.')
 
 
 @RavenLambdaWrapper()
-def poller_processor_handler(event, context):  # pylint: disable=W0613
+def poller_processor_handler(event, context):
     """
     Historical Security Group Poller Processor.
 
@@ -72,47 +74,55 @@ def poller_processor_handler(event, context):  # pylint: disable=W0613
     takser_queue_url = get_queue_url(os.environ.get('POLLER_TASKER_QUEUE_NAME', 'HistoricalSecurityGroupPollerTasker'))
 
     poller_task_schema = HistoricalPollerTaskEventModel()
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     for record in records:
-        # Skip accounts that have role assumption errors:
-        try:
-            # Did we get a NextToken?
-            if record.get('NextToken'):
-                LOG.debug(f"[@] Received pagination token: {record['NextToken']}")
-                groups = describe_security_groups(
-                    account_number=record['account_id'],
-                    assume_role=HISTORICAL_ROLE,
-                    region=record['region'],
-                    MaxResults=200,
-                    NextToken=record['NextToken']
-                )
-            else:
-                groups = describe_security_groups(
-                    account_number=record['account_id'],
-                    assume_role=HISTORICAL_ROLE,
-                    region=record['region'],
-                    MaxResults=200
-                )
-
-            # FIRST THINGS FIRST: Did we get a `NextToken`? If so, we need to enqueue that ASAP because
-            # 'NextToken`s expire in 60 seconds!
-            if groups.get('NextToken'):
-                logging.debug(f"[-->] Pagination required {groups['NextToken']}. Tasking continuation.")
-                produce_events(
-                    [poller_task_schema.serialize_me(record['account_id'], record['region'],
-                                                     next_token=groups['NextToken'])],
-                    takser_queue_url
-                )
-
-            # Task the collector to perform all the DDB logic -- this will pass in the collected data to the
-            # collector in very small batches.
-            events = [SECURITY_GROUP_POLLING_SCHEMA.serialize(record['account_id'], g, record['region'])
-                      for g in groups['SecurityGroups']]
-            produce_events(events, collector_poller_queue_url, batch_size=3)
-
-            LOG.debug(f"[@] Finished generating polling events. Account: {record['account_id']}/{record['region']} "
-                      f"Events Created: {len(events)}")
-        except ClientError as exc:
-            LOG.error(f"[X] Unable to generate events for account/region. Account Id/Region: {record['account_id']}"
-                      f"/{record['region']} Reason: {exc}")
+        with failures.isolate(record):
+            # Skip accounts that have role assumption errors:
+            try:
+                client = get_client('ec2', account_number=record['account_id'], assume_role=HISTORICAL_ROLE,
+                                    region=record['region'])
+
+                # Keep paginating for as long as there is time left in this invocation:
+                next_token = record.get('NextToken')
+                if next_token:
+                    LOG.debug(f"[@] Received pagination token: {next_token}")
+
+                while True:
+                    if next_token:
+                        groups = describe_security_groups(force_client=client, MaxResults=200, NextToken=next_token)
+                    else:
+                        groups = describe_security_groups(force_client=client, MaxResults=200)
+
+                    next_token = groups.get('NextToken')
+
+                    # FIRST THINGS FIRST: If there isn't enough time left to fetch the next page, then it needs to be
+                    # enqueued ASAP because `NextToken`s expire in 60 seconds!
+                    out_of_time = next_token and not has_time_remaining(context)
+                    if out_of_time:
+                        LOG.debug(f"[-->] Pagination required {next_token}. Out of time -- tasking continuation.")
+                        produce_events(
+                            [poller_task_schema.serialize_me(record['account_id'], record['region'],
+                                                             next_token=next_token)],
+                            takser_queue_url
+                        )
+
+                    # Task the collector to perform all the DDB logic -- this will pass in the collected data to the
+                    # collector.
+                    events = [SECURITY_GROUP_POLLING_SCHEMA.serialize(record['account_id'], g, record['region'])
+                              for g in groups['SecurityGroups']]
+                    produce_events(events, collector_poller_queue_url)
+
+                    LOG.debug(f"[@] Finished generating polling events. Account: {record['account_id']}/"
+                              f"{record['region']} Events Created: {len(events)}")
+
+                    if not next_token or out_of_time:
+                        break
+
+            except (ClientError, ProducerException) as exc:
+                LOG.error(f"[X] Unable to generate events for account/region. Account Id/Region: {record['account_id']}"
+                          f"/{record['region']} Reason: {exc}")
+
+    log_stats()
+    return failures.get_response()
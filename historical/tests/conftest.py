@@ -55,6 +55,18 @@ def dynamodb():
         yield boto3.client('dynamodb', region_name='us-east-1')
 
 
+@pytest.fixture(scope='function', autouse=True)
+def clear_client_cache():
+    """Empty out the cached credentials, clients, and queue URLs so that they don't leak between tests."""
+    from historical.common.session import clear
+    from historical.common.sqs import PRODUCER
+    clear()
+    PRODUCER.clear()
+    yield
+    clear()
+    PRODUCER.clear()
+
+
 # pylint: disable=W0621,W0613
 @pytest.fixture(scope='function')
 def retry():
@@ -7,6 +7,7 @@
 """
 import json
 import os
+import re
 
 from datetime import datetime
 
@@ -628,6 +629,218 @@ def test_default_diff():
     assert result['values_changed']["root['version']['N']"]['old_value'] == '9'
 
 
+def test_revision_hash():
+    """Tests that the revision hash is order-insensitive, ignores the non-important fields, and agrees with
+    default_diff."""
+    from historical.common.dynamodb import default_diff, get_revision_hash
+
+    def make_config(rules, **extra):
+        config = {
+            'configuration': {'M': {'Rules': {'L': [{'M': {'Port': {'N': str(port)}}} for port in rules]},
+                                    'Name': {'S': 'some-group'}}},
+            'Tags': {'M': {}},
+            'version': {'N': '1'}
+        }
+        config.update(extra)
+        return config
+
+    pairs = [
+        (make_config([22, 443]), make_config([443, 22])),
+        (make_config([22, 443]), make_config([22, 443, 22])),
+        (make_config([22]), make_config([22], eventName={'S': 'PutBucketPolicy'}, configHash={'S': 'abc'})),
+        (make_config([22, 443]), make_config([22, 80])),
+        (make_config([22]), make_config([22], version={'N': '2'})),
+        (make_config([22]), make_config([22], Tags={'M': {'some': {'S': 'tag'}}})),
+    ]
+
+    for latest, current in pairs:
+        same_hash = get_revision_hash(latest) == get_revision_hash(current)
+        assert same_hash == (not default_diff(latest, current))
+
+    # The attributes are not modified:
+    config = make_config([22], eventName={'S': 'PutBucketPolicy'})
+    get_revision_hash(config)
+    assert config['eventName'] == {'S': 'PutBucketPolicy'}
+
+
+def test_ephemeral_paths():
+    """Tests that ephemeral paths are stripped from serialized and plain attributes -- without modifying them."""
+    from historical.common.dynamodb import compile_paths, get_config_fingerprint, strip_paths
+
+    tree = compile_paths(('configuration.LastModified', 'configuration.Rules.*.Stats', 'Tags.*.Updated'))
+
+    typed = {
+        'configuration': {'M': {
+            'LastModified': {'S': 'today'},
+            'Name': {'S': 'thing'},
+            'Rules': {'L': [{'M': {'Port': {'N': '22'}, 'Stats': {'N': '5'}}}, {'M': {'Port': {'N': '443'}}}]}
+        }},
+        'Tags': {'M': {'some': {'M': {'Updated': {'S': 'today'}, 'Value': {'S': 'tag'}}}}},
+        'version': {'N': '1'}
+    }
+    original = json.loads(json.dumps(typed))
+
+    assert strip_paths(typed, tree) == {
+        'configuration': {'M': {
+            'Name': {'S': 'thing'},
+            'Rules': {'L': [{'M': {'Port': {'N': '22'}}}, {'M': {'Port': {'N': '443'}}}]}
+        }},
+        'Tags': {'M': {'some': {'M': {'Value': {'S': 'tag'}}}}},
+        'version': {'N': '1'}
+    }
+    assert typed == original
+
+    # Nothing is copied if there is nothing to strip:
+    assert strip_paths(typed['version'], tree) is typed['version']
+    assert strip_paths(typed, {}) is typed
+
+    plain = {
+        'configuration': {'LastModified': 'today', 'Name': 'thing', 'Rules': [{'Port': 22, 'Stats': 5}]},
+        'Tags': {'some': {'Updated': 'today', 'Value': 'tag'}},
+        'version': 1
+    }
+    assert strip_paths(plain, tree, typed=False) == {
+        'configuration': {'Name': 'thing', 'Rules': [{'Port': 22}]},
+        'Tags': {'some': {'Value': 'tag'}},
+        'version': 1
+    }
+
+    changed = json.loads(json.dumps(plain))
+    changed['configuration']['LastModified'] = 'tomorrow'
+    changed['configuration']['Rules'][0]['Stats'] = 6
+    assert get_config_fingerprint(plain, tree) == get_config_fingerprint(changed, tree)
+    assert get_config_fingerprint(plain) != get_config_fingerprint(changed)
+
+
+def get_changed_keys(result):
+    """Gets the top-level attributes that changed out of a DeepDiff or a `historical.common.diff` result."""
+    return {re.match(r"root\['([^']+)'\]", path).group(1) for paths in result.values() for path in paths}
+
+
+def test_diff_parity():
+    """Tests that the fast diff agrees with DeepDiff (with the default_diff options) on whether there is a difference,
+    and on which attributes changed."""
+    from deepdiff import DeepDiff
+    from historical.common.diff import diff
+    from historical.common.dynamodb import pop_no_diff_fields
+    from historical.s3.models import DurableS3Model
+
+    def serialize_bucket(**changes):
+        bucket = json.loads(json.dumps(S3_BUCKET))
+        bucket.pop('eventSource')
+        bucket['configuration'].update(changes.pop('configuration', {}))
+        bucket.update(changes)
+        return DurableS3Model(**bucket)._get_json()[1]['attributes']  # pylint: disable=W0212
+
+    rules = [{'ID': f'Rule {i}', 'Status': 'Enabled', 'Expiration': {'Days': i}} for i in range(10)]
+    grants = {'someone': ['READ', 'WRITE', 'READ_ACP']}
+    changes = [
+        {},
+        {'principalId': 'someone@example.com', 'eventName': 'PutBucketTagging'},
+        {'Tags': {'some': 'tag'}},
+        {'version': 2},
+        {'configuration': {'Policy': '{"Statement": []}'}},
+        {'configuration': {'Logging': {'Enabled': True}}},
+        {'configuration': {'Logging': None}},
+        {'configuration': {'Versioning': {'Status': 'Enabled'}, 'Cors': [{'AllowedMethods': ['GET']}]}},
+        {'configuration': {'LifecycleRules': rules}},
+        {'configuration': {'LifecycleRules': list(reversed(rules))}},
+        {'configuration': {'LifecycleRules': rules + rules[:3]}},
+        {'configuration': {'LifecycleRules': rules[1:] + [dict(rules[0], Status='Disabled')]}},
+        {'configuration': {'Grants': grants}},
+        {'configuration': {'Grants': {'someone': ['READ_ACP', 'READ', 'WRITE']}}},
+        {'configuration': {'Grants': {'someone': ['READ', 'WRITE_ACP']}}},
+    ]
+
+    for latest in changes:
+        for current in changes:
+            latest_config = serialize_bucket(**json.loads(json.dumps(latest)))
+            current_config = serialize_bucket(**json.loads(json.dumps(current)))
+
+            result = diff(latest_config, current_config)
+            assert 'principalId' in current_config or 'principalId' in latest_config  # The inputs are not modified
+
+            pop_no_diff_fields(latest_config, current_config)
+            expected = DeepDiff(latest_config, current_config, ignore_order=True)
+
+            assert bool(result) == bool(expected)
+            assert get_changed_keys(result) == get_changed_keys(expected)
+
+    # A value that changed type is a single change:
+    result = diff(serialize_bucket(), serialize_bucket(configuration={'Policy': '{"Statement": []}'}))
+    assert result == {'changed': {"root['configuration']['M']['Policy']": {
+        'old_value': {'NULL': True},
+        'new_value': {'S': '{"Statement": []}'}
+    }}}
+
+
+def make_rules_config(ports):
+    """Makes the serialized configuration of a security group with a rule for each of the ports."""
+    return {'configuration': {'M': {'IpPermissions': {'L': [
+        {'M': {'FromPort': {'N': str(port)}, 'ToPort': {'N': str(port)}, 'IpProtocol': {'S': 'tcp'},
+               'IpRanges': {'L': [{'M': {'CidrIp': {'S': f'10.{port % 256}.0.0/16'}}}]}}}
+        for port in ports
+    ]}}}}
+
+
+def test_diff_large_config():
+    """Tests that the fast diff agrees with DeepDiff on a security group with a lot of (re-ordered) rules."""
+    import random
+    from deepdiff import DeepDiff
+    from historical.common.diff import diff
+
+    latest = make_rules_config(range(2000))
+    ports = list(range(1, 2001))
+    random.shuffle(ports)
+    current = make_rules_config(ports)
+
+    assert get_changed_keys(diff(latest, current)) == get_changed_keys(DeepDiff(latest, current, ignore_order=True))
+    assert not diff(latest, make_rules_config(reversed(range(2000))))
+
+
+@pytest.mark.skipif(not os.environ.get('HISTORICAL_BENCHMARKS'), reason='Set HISTORICAL_BENCHMARKS to run benchmarks.')
+def test_diff_benchmark():
+    """Benchmarks the fast diff against DeepDiff on a security group with a lot of rules. This is timing based, so
+    it only runs when asked to."""
+    import timeit
+    from deepdiff import DeepDiff
+    from historical.common.diff import diff
+
+    latest = make_rules_config(range(2000))
+    current = make_rules_config(range(1, 2001))
+
+    fast = min(timeit.repeat(lambda: diff(latest, current), number=1, repeat=3))
+    deep = min(timeit.repeat(lambda: DeepDiff(latest, current, ignore_order=True), number=1, repeat=3))
+    assert fast < deep
+
+
+def test_config_delta():
+    """Tests that the configuration deltas rebuild the target configuration -- without modifying the base."""
+    from historical.common.diff import apply_delta, make_delta
+
+    base = json.loads(json.dumps(S3_BUCKET['configuration']))
+    targets = [
+        base,
+        dict(base, Policy='{"Statement": []}'),
+        dict(base, Logging={'Enabled': True}, Website=None),
+        dict(base, LifecycleRules=[]),
+        dict(base, Owner={'ID': 'someone', 'DisplayName': 'Someone'}),
+        {key: value for key, value in base.items() if key not in ['Grants', 'Cors']},
+        {},
+    ]
+
+    for target in targets:
+        delta = json.loads(json.dumps(make_delta(base, target)))
+        assert apply_delta(base, delta) == target
+        assert base == S3_BUCKET['configuration']
+
+    assert make_delta(base, base) == {'set': [], 'unset': []}
+    assert make_delta(base, targets[4]) == {
+        'set': [[['Owner', 'ID'], 'someone'], [['Owner', 'DisplayName'], 'Someone']],
+        'unset': []
+    }
+
+
 def test_get_accounts_with_env_var():
     """Tests that passing in a CSV of account IDs in for the ENABLED_ACCOUNTS variable works."""
     from historical.common.accounts import get_historical_accounts
@@ -641,3 +854,297 @@ def test_get_accounts_with_env_var():
         account_ids.remove(account['id'])
 
     assert not account_ids
+
+
+def test_client_cache(historical_role):
+    """Tests that assumed role credentials and clients are reused until the credentials are about to expire."""
+    import threading
+    from datetime import timedelta
+    from mock import patch
+    from dateutil.tz import tzutc
+    from historical.common import session
+
+    client = session.get_client('ec2', account_number='123456789012', assume_role='historicalrole',
+                                region='us-east-1')
+    # (The STS client that assumed the role is also cached):
+    assert session.get_stats() == {'credential_hits': 0, 'credential_misses': 1, 'client_hits': 0,
+                                   'client_misses': 2}
+
+    # Same account/role/region/service -- same client:
+    assert session.get_client('ec2', account_number='123456789012', assume_role='historicalrole',
+                              region='us-east-1') is client
+
+    # Different region -- new client, but the credentials are reused:
+    assert session.get_client('ec2', account_number='123456789012', assume_role='historicalrole',
+                              region='us-west-2') is not client
+    assert session.get_stats() == {'credential_hits': 2, 'credential_misses': 1, 'client_hits': 1,
+                                   'client_misses': 3}
+
+    # Credentials that are about to expire get refreshed, and the clients with them are remade:
+    credentials = session.CREDENTIALS[('123456789012', 'historicalrole', 'historical')]
+    credentials['Expiration'] = datetime.now(tzutc()) + timedelta(minutes=1)
+    assert session.get_client('ec2', account_number='123456789012', assume_role='historicalrole',
+                              region='us-east-1') is not client
+    assert session.get_stats() == {'credential_hits': 2, 'credential_misses': 2, 'client_hits': 2,
+                                   'client_misses': 4}
+
+    # A different session name gets its own credentials and client:
+    assert session.get_client('ec2', account_number='123456789012', assume_role='historicalrole', region='us-east-1',
+                              session_name='historical-cloudwatch-s3list') is not client
+    assert session.get_stats() == {'credential_hits': 2, 'credential_misses': 3, 'client_hits': 3,
+                                   'client_misses': 5}
+
+    # The account number is required when assuming a role:
+    with pytest.raises(ValueError):
+        session.get_client('ec2', assume_role='historicalrole')
+
+    # Assuming a role doesn't hold up the threads that use the cached clients:
+    sts = session.get_client('sts')
+    assume_role = sts.assume_role
+    started, release = threading.Event(), threading.Event()
+
+    def slow_assume_role(**kwargs):
+        started.set()
+        release.wait(10)
+        return assume_role(**kwargs)
+
+    with patch.object(sts, 'assume_role', slow_assume_role):
+        thread = threading.Thread(target=session.get_client, args=('ec2',),
+                                  kwargs={'account_number': '210987654321', 'assume_role': 'historicalrole'})
+        thread.start()
+        assert started.wait(10)
+
+        session.get_client('ec2', account_number='123456789012', assume_role='historicalrole', region='us-east-1')
+        assert thread.is_alive()
+
+        release.set()
+        thread.join()
+
+    assert session.CREDENTIALS[('210987654321', 'historicalrole', 'historical')]
+    session.log_stats()
+
+    session.clear()
+    assert not session.CLIENTS
+    assert not session.CREDENTIALS
+    assert not any(session.get_stats().values())
+
+
+def test_save_current_revision(current_s3_table):
+    """Tests that unchanged revisions are not re-written to the Current table."""
+    import time
+    from historical.common.dynamodb import get_config_fingerprint, save_current_revision
+    from historical.constants import TTL_EXPIRY
+    from historical.s3.models import CurrentS3Model
+
+    bucket = S3_BUCKET.copy()
+    bucket['eventSource'] = 'aws.s3'
+
+    # The fingerprint is stable regardless of key ordering:
+    reordered = dict(reversed(list(bucket.items())))
+    reordered['configuration'] = dict(reversed(list(bucket['configuration'].items())))
+    assert get_config_fingerprint(bucket) == get_config_fingerprint(reordered)
+
+    # New items are saved:
+    assert save_current_revision(CurrentS3Model, dict(bucket))
+    item = CurrentS3Model.get(bucket['arn'])
+    assert item.configFingerprint == get_config_fingerprint(bucket)
+
+    # Unchanged items are not:
+    unchanged = dict(bucket)
+    unchanged['eventTime'] = '2017-09-09T00:00:00Z'
+    assert not save_current_revision(CurrentS3Model, unchanged)
+    assert CurrentS3Model.get(bucket['arn']).eventTime == bucket['eventTime']
+
+    # ...unless the TTL is getting close to expiring. Then only the TTL and eventTime are refreshed:
+    item.update(actions=[CurrentS3Model.ttl.set(int(time.time() + TTL_EXPIRY / 4))])
+    assert save_current_revision(CurrentS3Model, unchanged)
+    item = CurrentS3Model.get(bucket['arn'])
+    assert item.eventTime == '2017-09-09T00:00:00Z'
+    assert item.ttl > time.time() + TTL_EXPIRY / 2
+
+    # Changed items are saved:
+    changed = dict(bucket)
+    changed['Tags'] = {'some': 'tag'}
+    changed['eventTime'] = '2017-09-10T00:00:00Z'
+    assert save_current_revision(CurrentS3Model, changed)
+    item = CurrentS3Model.get(bucket['arn'])
+    assert item.eventTime == '2017-09-10T00:00:00Z'
+    assert item.Tags.as_dict() == {'some': 'tag'}
+
+
+def test_sqs_producer(historical_sqs):
+    """Tests that queue URLs are cached, that events are sent concurrently, and that only failed entries are retried."""
+    from mock import MagicMock, patch
+    from historical.common.batch import BatchProducer
+    from historical.common.exceptions import ProducerException
+    from historical.common.sqs import SQSProducer, get_queue_url, produce_events
+
+    # Producers need to implement `send_entries`:
+    with pytest.raises(TypeError):
+        BatchProducer()
+
+    # Queue URLs are only looked up once:
+    queue_url = get_queue_url('eventqueue')
+    with patch('historical.common.sqs.get_client') as mock_get_client:
+        assert get_queue_url('eventqueue') == queue_url
+        assert not mock_get_client.called
+
+    # Send a bunch of batches concurrently:
+    produce_events([json.dumps({'event': i}) for i in range(25)], queue_url)
+    received = []
+    while True:
+        messages = historical_sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+        if not messages:
+            break
+
+        received.extend(json.loads(message['Body'])['event'] for message in messages)
+        historical_sqs.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': message['MessageId'], 'ReceiptHandle': message['ReceiptHandle']} for message in messages
+        ])
+    assert sorted(received) == list(range(25))
+
+    # Only the failed entries are retried:
+    client = MagicMock()
+    sent = []
+
+    def send_message_batch(Entries, QueueUrl):  # pylint: disable=C0103,W0613
+        sent.append([entry['MessageBody'] for entry in Entries])
+        if len(sent) == 1:
+            return {'Failed': [{'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'InternalError'}]}
+
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    client.send_message_batch = send_message_batch
+    producer = SQSProducer(backoff=0)
+    with patch('historical.common.batch.get_client', lambda service: client):
+        producer.send(['one', 'two', 'three'], queue_url)
+    assert sent == [['one', 'two', 'three'], ['one']]
+
+    # Sender faults are not retried, and entries that keep failing raise an exception:
+    client.send_message_batch = MagicMock(return_value={
+        'Failed': [{'Id': 'someid', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]
+    })
+    with patch('historical.common.batch.get_client', lambda service: client):
+        with pytest.raises(ProducerException):
+            producer.send(['one'], queue_url)
+    assert client.send_message_batch.call_count == 1
+
+    client.send_message_batch = MagicMock(side_effect=lambda Entries, QueueUrl: {
+        'Failed': [{'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'InternalError'}]
+    })
+    with patch('historical.common.batch.get_client', lambda service: client):
+        with pytest.raises(ProducerException):
+            producer.send(['one'], queue_url)
+    assert client.send_message_batch.call_count == producer.max_retries + 1
+
+    # The failures of all the batches are raised together once all of them have been attempted:
+    client.send_message_batch = MagicMock(side_effect=lambda Entries, QueueUrl: {
+        'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'} for entry in Entries]
+        if Entries[0]['MessageBody'] != 'x10' else []
+    })
+    with patch('historical.common.batch.get_client', lambda service: client):
+        with pytest.raises(ProducerException) as exc:
+            producer.send([f'x{i}' for i in range(30)], queue_url)
+    assert client.send_message_batch.call_count == 3
+    assert len(exc.value.failed) == 20
+
+
+def test_pack_batches():
+    """Tests that SQS batches are packed up to both the entry count and the total payload size limits."""
+    from historical.common.batch import MAX_BATCH_BYTES, pack_batches
+    from historical.common.sqs import make_sqs_record
+
+    # Small messages are only limited by the entry count:
+    records = [make_sqs_record('a') for _ in range(25)]
+    assert [len(batch) for batch in pack_batches(records)] == [10, 10, 5]
+    assert [len(batch) for batch in pack_batches(records, max_entries=3)] == [3] * 8 + [1]
+
+    # Big messages are limited by the total size -- which is measured in UTF-8 bytes:
+    big = 'x' * 100000
+    assert [len(batch) for batch in pack_batches([make_sqs_record(big) for _ in range(5)])] == [2, 2, 1]
+
+    multi_byte = 'é' * 60000   # 2 bytes per character
+    assert [len(batch) for batch in pack_batches([make_sqs_record(multi_byte) for _ in range(5)])] == [2, 2, 1]
+
+    # Exactly at the limit:
+    exact = [make_sqs_record('x' * (MAX_BATCH_BYTES // 2)) for _ in range(3)]
+    assert [len(batch) for batch in pack_batches(exact)] == [2, 1]
+
+    # Order is preserved:
+    records = [make_sqs_record(str(i) * i) for i in range(1, 30)]
+    assert [record for batch in pack_batches(records, max_bytes=50) for record in batch] == records
+
+
+def test_sns_publisher():
+    """Tests that events are published to SNS in size-aware batches, and that only failed entries are retried."""
+    from mock import MagicMock, patch
+    from historical.common.sns import SNSPublisher
+
+    client = MagicMock()
+    client.meta.service_model.operation_names = ['Publish', 'PublishBatch']
+    published = []
+
+    def publish_batch(TopicArn, PublishBatchRequestEntries):  # pylint: disable=C0103,W0613
+        published.append([entry['Message'] for entry in PublishBatchRequestEntries])
+        if len(published) == 1:
+            return {'Failed': [{'Id': PublishBatchRequestEntries[-1]['Id'], 'SenderFault': False}]}
+
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries]}
+
+    client.publish_batch = publish_batch
+    publisher = SNSPublisher(max_workers=1, backoff=0)
+    events = ['x' * 100000 for _ in range(3)] + [str(i) for i in range(12)]
+    with patch('historical.common.sns.get_client', lambda service: client), \
+            patch('historical.common.batch.get_client', lambda service: client):
+        publisher.send(events, 'thetopic')
+
+    # 2 big events fit in the first batch, and the failed entry was retried on its own:
+    assert [len(batch) for batch in published] == [2, 1, 10, 3]
+    assert published[1] == [events[1]]
+    assert [event for batch in published[:1] + published[2:] for event in batch] == events
+
+    # Without PublishBatch, the events are published individually:
+    client.meta.service_model.operation_names = ['Publish']
+    with patch('historical.common.sns.get_client', lambda service: client):
+        SNSPublisher(backoff=0).send(events, 'thetopic')
+    assert client.publish.call_count == len(events)
+
+
+def test_sqs_producer_fifo():
+    """Tests that events for FIFO queues are sent in order, in their message groups."""
+    from mock import MagicMock, patch
+    from historical.common.exceptions import ProducerException
+    from historical.common.sqs import make_sqs_record, SQSProducer
+
+    record = make_sqs_record('event', group_id='arn:aws:s3:::testbucket1')
+    assert record['MessageGroupId'] == 'arn:aws:s3:::testbucket1'
+    assert record['MessageDeduplicationId'] == make_sqs_record('event', group_id='another')['MessageDeduplicationId']
+    assert 'DelaySeconds' not in record
+
+    client = MagicMock()
+    client.send_message_batch.return_value = {}
+    events = [str(i) for i in range(25)]
+    with patch('historical.common.batch.get_client', lambda service: client):
+        SQSProducer().send(events, 'https://queue.amazonaws.com/123456789012/differ.fifo', randomize_delay=900,
+                           group_ids=[f'arn{i % 2}' for i in range(25)])
+
+    sent = [entry for call in client.send_message_batch.call_args_list for entry in call[1]['Entries']]
+    assert [entry['MessageBody'] for entry in sent] == events
+    assert [entry['MessageGroupId'] for entry in sent] == [f'arn{i % 2}' for i in range(25)]
+    assert not any('DelaySeconds' in entry for entry in sent)
+
+    # A batch that fails doesn't stop the rest from being sent. All the failures are raised together at the end:
+    def send_message_batch(Entries, QueueUrl):  # pylint: disable=C0103,W0613
+        if Entries[0]['MessageBody'] in ('0', '20'):
+            return {'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'}
+                               for entry in Entries]}
+
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    client.send_message_batch = MagicMock(side_effect=send_message_batch)
+    with patch('historical.common.batch.get_client', lambda service: client):
+        with pytest.raises(ProducerException) as exc:
+            SQSProducer().send(events, 'https://queue.amazonaws.com/123456789012/differ.fifo')
+
+    assert client.send_message_batch.call_count == 3
+    assert len(exc.value.failed) == 15
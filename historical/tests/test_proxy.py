@@ -14,7 +14,7 @@ from datetime import datetime
 
 import boto3
 import pytest  # pylint: disable=E0401
-from mock import MagicMock  # pylint: disable=E0401
+from mock import MagicMock, patch  # pylint: disable=E0401
 
 from historical.constants import EVENT_TOO_BIG_FLAG
 from historical.models import TTL_EXPIRY
@@ -167,7 +167,6 @@ def test_make_proper_dynamodb_record():
     """Tests that the Proxy can generate the proper DDB stream events."""
     import historical.common.proxy
 
-    old_publish_message = historical.common.proxy._publish_sns_message
     old_logger = historical.common.proxy.LOG
 
     mock_logger = MagicMock()
@@ -236,10 +235,304 @@ def test_make_proper_dynamodb_record():
     assert not item['dynamodb']['NewImage']['configuration']['M']
 
     # Unmock:
-    historical.common.proxy._publish_sns_message = old_publish_message
     historical.common.proxy.LOG = old_logger
 
 
+def test_compressed_events(historical_sqs):
+    """Tests that big events are sent in a compressed envelope that is transparently decompressed."""
+    from historical.common.proxy import make_proper_dynamodb_record
+    from historical.common.sqs import get_queue_url, produce_events
+    from historical.common.util import deserialize_records, is_compressed
+
+    new_bucket = S3_BUCKET.copy()
+    new_bucket['configuration'] = new_bucket['configuration'].copy()
+    new_bucket['configuration']['VeryLargeConfigItem'] = 'a' * 262144
+    ddb_record = DynamoDBRecordFactory(
+        dynamodb=DynamoDBDataFactory(
+            NewImage=new_bucket,
+            Keys={
+                'arn': new_bucket['arn']
+            },
+            OldImage=new_bucket),
+        eventName='INSERT')
+    data = json.loads(json.dumps(DynamoDBRecordsFactory(records=[ddb_record]), default=serialize))['Records'][0]
+
+    # Nothing is compressed by default:
+    assert not is_compressed(make_proper_dynamodb_record(data))
+
+    # The full record is sent compressed instead of being shrunk:
+    with patch('historical.common.proxy.COMPRESS_EVENTS', True):
+        blob = make_proper_dynamodb_record(data)
+    assert is_compressed(blob)
+    assert math.ceil(len(blob) / 1024) < 200
+
+    # Directly in SQS and through SNS:
+    for body in [blob, json.dumps(SnsDataFactory(Message=blob), default=serialize)]:
+        records = deserialize_records([{'body': body}])
+        assert records == [data]
+
+    # The producer compresses the big events:
+    queue_url = get_queue_url('eventqueue')
+    with patch('historical.common.sqs.COMPRESS_EVENTS', True):
+        produce_events([json.dumps(data), json.dumps({'small': 'event'})], queue_url)
+
+    messages = historical_sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    assert len(messages) == 2
+    assert len([message for message in messages if is_compressed(message['Body'])]) == 1
+
+    records = deserialize_records([{'body': message['Body']} for message in messages])
+    assert sorted(records, key=lambda record: 'small' in record) == [data, {'small': 'event'}]
+
+
+def test_claim_check_events(s3):
+    """Tests that big events can be stored in S3, with a claim check sent in their place."""
+    from historical.common import claim_check
+    from historical.common.proxy import make_proper_dynamodb_record, make_proper_simple_record
+    from historical.common.util import BatchItemFailures, deserialize_records
+
+    s3.create_bucket(Bucket='claimchecks')
+    claim_check.fetch_event.cache_clear()
+
+    new_bucket = S3_BUCKET.copy()
+    new_bucket.pop('eventSource')
+    new_bucket['configuration'] = new_bucket['configuration'].copy()
+    new_bucket['configuration']['VeryLargeConfigItem'] = 'a' * 262144
+    ddb_record = DynamoDBRecordFactory(
+        dynamodb=DynamoDBDataFactory(
+            NewImage=new_bucket,
+            Keys={
+                'arn': new_bucket['arn']
+            },
+            OldImage=new_bucket),
+        eventName='INSERT')
+    data = json.loads(json.dumps(DynamoDBRecordsFactory(records=[ddb_record]), default=serialize))['Records'][0]
+
+    with patch('historical.common.proxy.CLAIM_CHECK_BUCKET', 'claimchecks'):
+        with patch('historical.common.proxy.HISTORICAL_TECHNOLOGY', 's3'):
+            simple_blob = make_proper_simple_record(data)
+        blob = make_proper_dynamodb_record(data)
+
+    # The same event has the same key:
+    pointer = json.loads(blob)
+    assert claim_check.is_claim_check(pointer)
+    assert pointer == json.loads(claim_check.store_event(json.dumps(data), bucket='claimchecks'))
+    assert len(s3.list_objects_v2(Bucket='claimchecks')['Contents']) == 2
+
+    # Exactly the record that was emitted is received -- directly in SQS and through SNS:
+    for body in [blob, json.dumps(SnsDataFactory(Message=blob), default=serialize)]:
+        assert deserialize_records([{'body': body}]) == [data]
+
+    simple = deserialize_records([{'body': simple_blob}])[0]
+    assert simple['item']['configuration']['VeryLargeConfigItem'] == 'a' * 262144
+    assert not simple.get(EVENT_TOO_BIG_FLAG)
+
+    # The payloads are cached:
+    assert claim_check.fetch_event.cache_info().hits
+
+    # A claim check that can't be redeemed only fails its own record:
+    expired = claim_check.store_event(json.dumps(dict(data, expired=True)), bucket='claimchecks')
+    s3.delete_object(Bucket='claimchecks', Key=json.loads(expired)[claim_check.CLAIM_CHECK_FIELD]['key'])
+    failures = BatchItemFailures()
+    records = deserialize_records([{'body': expired, 'messageId': 'message1'},
+                                   {'body': blob, 'messageId': 'message2'}], failures=failures)
+    assert records == [dict(data, sqs_message_id='message2')]
+    assert failures.get_message_ids() == ['message1']
+
+
+def test_proxy_encoder():
+    """Tests that the Proxy encodes records exactly as `json.dumps` would -- including when shrinking them."""
+    import copy
+    from historical.common.proxy import encode_object, make_proper_dynamodb_record, shrink_blob
+
+    assert encode_object([]) == json.dumps({})
+    assert encode_object([('a', json.dumps([1, 'é'])), ('b', json.dumps({'c': None}))]) == \
+        json.dumps({'a': [1, 'é'], 'b': {'c': None}})
+
+    new_bucket = S3_BUCKET.copy()
+    new_bucket['configuration'] = dict(new_bucket['configuration'], Unicode='Ünïcödé')
+    ddb_record = DynamoDBRecordFactory(
+        dynamodb=DynamoDBDataFactory(
+            NewImage=new_bucket,
+            Keys={
+                'arn': new_bucket['arn']
+            },
+            OldImage=new_bucket),
+        eventName='MODIFY')
+    data = json.loads(json.dumps(DynamoDBRecordsFactory(records=[ddb_record]), default=serialize))['Records'][0]
+
+    assert make_proper_dynamodb_record(data) == json.dumps(data)
+    assert make_proper_dynamodb_record(data, force_shrink=True) == json.dumps(shrink_blob(copy.deepcopy(data), False))
+
+    # The record is not modified:
+    assert data['dynamodb']['NewImage'].get('configuration')
+
+
+def test_image_to_dict_parity():
+    """Tests that the direct DynamoDB image converter makes the same dicts as the PynamoDB models."""
+    import copy
+    from decimal import Decimal
+    from boto3.dynamodb.types import TypeSerializer
+    from historical.common.dynamodb import image_to_dict, strip_empty_placeholders
+    from historical.common.proxy import _get_durable_pynamo_obj
+    from historical.s3.models import DurableS3Model
+    from historical.security_group.models import DurableSecurityGroupModel
+    from historical.tests.test_security_group import SECURITY_GROUP
+    from historical.tests.test_vpc import VPC
+    from historical.vpc.models import DurableVPCModel
+
+    def to_decimals(value):
+        if isinstance(value, dict):
+            return {key: to_decimals(item) for key, item in value.items()}
+
+        if isinstance(value, list):
+            return [to_decimals(item) for item in value]
+
+        return Decimal(str(value)) if isinstance(value, float) else value
+
+    def to_image(item):
+        item = to_decimals(item)
+        item.pop('eventSource', None)
+        item.pop('ttl', None)
+        item.setdefault('eventTime', '2018-01-01T00:00:00Z')
+        return {key: TypeSerializer().serialize(value) for key, value in item.items()}
+
+    def model_dict(image, model):
+        return strip_empty_placeholders(dict(_get_durable_pynamo_obj(copy.deepcopy(image), model)))
+
+    edge_cases = {
+        'numbers': {'int': 1, 'negative': -12, 'float': 1.5, 'whole float': Decimal('2.0'), 'exp': Decimal('1E+2'),
+                    'big': 12345678901234567890, 'tiny': Decimal('0.000001')},
+        'empties': {'empty': '<empty>', 'inside': 'some<empty>thing', 'map': {}, 'list': [], 'null': None},
+        'nested': [{'a': [1, 'b', None, True, {'c': False}]}, [[]], 'é'],
+    }
+
+    for model, item in [(DurableS3Model, S3_BUCKET), (DurableSecurityGroupModel, SECURITY_GROUP),
+                        (DurableVPCModel, VPC)]:
+        image = to_image(item)
+        assert image_to_dict(image, model) == model_dict(image, model)
+
+        # Edge cases in the configuration:
+        image = to_image(dict(item, configuration=dict(item['configuration'], **edge_cases)))
+        assert image_to_dict(image, model) == model_dict(image, model)
+
+        # Missing and null optional fields, empty values, and global table fields:
+        image = to_image(item)
+        image.pop('userIdentity', None)
+        image.pop('userAgent', None)
+        image['requestParameters'] = {'NULL': True}
+        image['principalId'] = {'S': '<empty>'}
+        image['Tags'] = {'M': {}}
+        image['aws:rep:updateregion'] = {'S': 'us-east-1'}
+        assert image_to_dict(image, model) == model_dict(image, model)
+
+        # Things that aren't supported are left to the model:
+        for field, value in [('notafield', {'S': 'value'}), ('version', {'N': '9.5'}),
+                             ('configuration', {'M': {'set': {'SS': ['a', 'b']}}}), ('arn', {'N': '1'})]:
+            with pytest.raises(ValueError):
+                image_to_dict(dict(image, **{field: value}), model)
+
+        image.pop('eventTime')
+        with pytest.raises(ValueError):
+            image_to_dict(image, model)
+
+    # The simple proxy makes the same events either way:
+    from historical.common.proxy import make_proper_simple_record
+    image = to_image(dict(S3_BUCKET, configuration=dict(S3_BUCKET['configuration'], **edge_cases)))
+    record = {'dynamodb': {'Keys': {'arn': image['arn']}, 'NewImage': image}}
+
+    with patch('historical.common.proxy.HISTORICAL_TECHNOLOGY', 's3'):
+        blob = make_proper_simple_record(copy.deepcopy(record))
+
+        with patch('historical.common.proxy.image_to_dict', MagicMock(side_effect=ValueError)):
+            assert make_proper_simple_record(copy.deepcopy(record)) == blob
+
+
+def test_simple_record_keys():
+    """Tests that the simple durable schema only has the resource fields -- without the internal Durable table ones."""
+    import copy
+    from boto3.dynamodb.types import TypeSerializer
+    from historical.common.proxy import make_proper_simple_record
+
+    item = dict(S3_BUCKET, eventTime='2018-01-01T00:00:00Z', principalId='<empty>', configHash='somehash',
+                keyframeEventTime='2017-12-31T00:00:00Z', configDelta='{}', revisionSequence=3)
+    item['configuration'] = dict(S3_BUCKET['configuration'], Empty='<empty>', Inside='some<empty>thing')
+    item.pop('eventSource', None)
+    item.pop('ttl', None)
+    image = {key: TypeSerializer().serialize(value) for key, value in item.items()}
+    record = {'dynamodb': {'Keys': {'arn': image['arn']}, 'NewImage': image}}
+
+    with patch('historical.common.proxy.HISTORICAL_TECHNOLOGY', 's3'):
+        blobs = [make_proper_simple_record(copy.deepcopy(record))]
+
+        with patch('historical.common.proxy.image_to_dict', MagicMock(side_effect=ValueError)):
+            blobs.append(make_proper_simple_record(copy.deepcopy(record)))
+
+    for blob in blobs:
+        emitted = json.loads(blob)['item']
+        assert not {'configHash', 'keyframeEventTime', 'configDelta', 'revisionSequence'} & set(emitted)
+        assert set(emitted) == {'arn', 'accountId', 'Region', 'Tags', 'configuration', 'eventTime', 'principalId',
+                                'requestParameters', 'userIdentity', 'userAgent', 'version', 'BucketName', 'eventName',
+                                'sourceIpAddress'}
+
+        # The `<empty>` placeholders are stripped from each value:
+        assert emitted['principalId'] == ''
+        assert emitted['configuration']['Empty'] == ''
+        assert emitted['configuration']['Inside'] == 'something'
+
+
+def test_coalesce_stream_records(mock_lambda_environment):
+    """Tests that only the latest image for each ARN is forwarded -- without losing deletions."""
+    from historical.common.proxy import coalesce_stream_records, handler
+
+    def make_record(arn, event_name, name, config=True, durable=False):
+        image = {'arn': {'S': arn}, 'Region': {'S': 'us-east-1'}, 'name': {'S': name},
+                 'configuration': {'M': {'some': {'S': 'config'}} if config else {}}}
+        if not durable:
+            image['ttl'] = {'N': '1234567890'}
+
+        return {'eventName': event_name, 'dynamodb': {'Keys': {'arn': {'S': arn}}, 'NewImage': image,
+                                                      'OldImage': image}}
+
+    records = [
+        make_record('a', 'INSERT', 'a1'),
+        make_record('b', 'MODIFY', 'b1'),
+        make_record('a', 'MODIFY', 'a2'),
+        make_record('a', 'MODIFY', 'a3'),
+        make_record('b', 'MODIFY', 'b2', config=False),     # Deletion revision
+        make_record('b', 'INSERT', 'b3'),                   # Re-created
+        make_record('b', 'MODIFY', 'b4'),
+        {'eventName': 'REMOVE', 'dynamodb': {'Keys': {'arn': {'S': 'a'}}}},
+        make_record('a', 'INSERT', 'a4'),
+    ]
+
+    result = coalesce_stream_records(records)
+    assert [record['dynamodb']['NewImage']['name']['S'] if record['dynamodb'].get('NewImage') else 'REMOVE'
+            for record in result] == ['b1', 'a3', 'b2', 'b4', 'REMOVE', 'a4']
+
+    # The kept records get the OldImage from before the records they replaced (without modifying the originals):
+    assert result[1]['dynamodb']['OldImage']['name']['S'] == 'a1'
+    assert records[3]['dynamodb']['OldImage']['name']['S'] == 'a3'
+
+    # Durable table revisions are never collapsed:
+    durable = [make_record('a', 'INSERT', 'a1', durable=True), make_record('a', 'INSERT', 'a2', durable=True)]
+    assert coalesce_stream_records(durable) == durable
+
+    # The Proxy only coalesces if configured to:
+    shipped = []
+    os.environ['PROXY_QUEUE_URL'] = 'proxyqueue'
+    with patch('historical.common.proxy.produce_events', lambda events, *args, **kwargs: shipped.extend(events)):
+        with patch('historical.common.proxy.detect_global_table_updates', lambda record: False):
+            handler({'Records': json.loads(json.dumps(records[:4]))}, mock_lambda_environment)
+            assert len(shipped) == 4
+
+            shipped.clear()
+            with patch('historical.common.proxy.PROXY_COALESCE_RECORDS', True):
+                handler({'Records': json.loads(json.dumps(records[:4]))}, mock_lambda_environment)
+
+    del os.environ['PROXY_QUEUE_URL']
+    assert [json.loads(blob)['dynamodb']['NewImage']['name']['S'] for blob in shipped] == ['b1', 'a3']
+
+
 # pylint: disable=R0915
 def test_make_proper_simple_record():
     """Tests that the simple durable schema can be generated properly for all event types."""
@@ -248,6 +541,7 @@ def test_make_proper_simple_record():
     old_tech = historical.common.proxy.HISTORICAL_TECHNOLOGY
     historical.common.proxy.HISTORICAL_TECHNOLOGY = 's3'
 
+    from historical.common.dynamodb import remove_durable_specific_fields
     from historical.common.proxy import make_proper_simple_record, _get_durable_pynamo_obj
     from historical.s3.models import DurableS3Model
 
@@ -271,8 +565,8 @@ def test_make_proper_simple_record():
     assert test_blob['event_time'] == new_bucket['eventTime']
     assert test_blob['tech'] == 's3'
     assert not test_blob.get(EVENT_TOO_BIG_FLAG)
-    assert json.dumps(test_blob['item'], sort_keys=True) == \
-        json.dumps(dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model)), sort_keys=True)
+    assert json.dumps(test_blob['item'], sort_keys=True) == json.dumps(remove_durable_specific_fields(
+        dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model))), sort_keys=True)
 
     # With a big item...
     new_bucket['configuration'] = new_bucket['configuration'].copy()
@@ -316,8 +610,8 @@ def test_make_proper_simple_record():
     assert test_blob['arn'] == deleted_bucket['arn']
     assert test_blob['event_time'] == deleted_bucket['eventTime']
     assert test_blob['tech'] == 's3'
-    assert json.dumps(test_blob['item'], sort_keys=True) == \
-        json.dumps(dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model)), sort_keys=True)
+    assert json.dumps(test_blob['item'], sort_keys=True) == json.dumps(remove_durable_specific_fields(
+        dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model))), sort_keys=True)
 
     # For a creation event:
     new_bucket = S3_BUCKET.copy()
@@ -338,8 +632,8 @@ def test_make_proper_simple_record():
     assert test_blob['event_time'] == new_bucket['eventTime']
     assert test_blob['tech'] == 's3'
     assert not test_blob.get(EVENT_TOO_BIG_FLAG)
-    assert json.dumps(test_blob['item'], sort_keys=True) == \
-        json.dumps(dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model)), sort_keys=True)
+    assert json.dumps(test_blob['item'], sort_keys=True) == json.dumps(remove_durable_specific_fields(
+        dict(_get_durable_pynamo_obj(data['dynamodb']['NewImage'], DurableS3Model))), sort_keys=True)
 
     # Unmock:
     historical.common.proxy.HISTORICAL_TECHNOLOGY = old_tech
@@ -615,8 +909,8 @@ def test_proxy_lambda(historical_role, historical_sqs, mock_lambda_environment):
 
     # Send messages with SNS (need to mock out SNS since it's hard to mock it)
     mock_func = MagicMock()
-    old_publish = historical.common.proxy._publish_sns_message
-    historical.common.proxy._publish_sns_message = mock_func
+    old_publish = historical.common.proxy.publish_events
+    historical.common.proxy.publish_events = mock_func
     del os.environ['PROXY_QUEUE_URL']
 
     os.environ['PROXY_TOPIC_ARN'] = 'thetopic'
@@ -624,5 +918,5 @@ def test_proxy_lambda(historical_role, historical_sqs, mock_lambda_environment):
     assert mock_func.called
 
     # Clean-up:
-    historical.common.proxy._publish_sns_message = old_publish
+    historical.common.proxy.publish_events = old_publish
     del os.environ['PROXY_TOPIC_ARN']
@@ -12,6 +12,8 @@ from datetime import datetime
 
 import boto3
 from botocore.exceptions import ClientError
+from mock import patch
+import pytest  # pylint: disable=E0401
 
 from historical.common.sqs import get_queue_url
 from historical.models import HistoricalPollerTaskEventModel
@@ -178,6 +180,14 @@ def test_poller_tasker_handler(mock_lambda_environment, historical_sqs, swag_acc
     assert poller_events['account_id'] == all_historical_accounts[0]['id']
     assert poller_events['region'] == CURRENT_REGION
 
+    # Events that fail to send are logged (and not raised):
+    from historical.common.exceptions import ProducerException
+    from historical.s3.poller import poller_tasker_handler
+
+    error = ProducerException('somequeue', [{'Id': 'someid', 'SenderFault': False, 'Code': 'InternalError'}])
+    with patch('historical.s3.poller.produce_events', side_effect=error):
+        poller_tasker_handler({}, mock_lambda_environment)
+
 
 # pylint: disable=W0613,R0914
 def test_poller_processor_handler(historical_role, buckets, mock_lambda_environment, historical_sqs, swag_accounts):
@@ -231,6 +241,12 @@ def test_poller_processor_handler(historical_role, buckets, mock_lambda_environm
     historical.s3.poller.produce_events = old_method
     # ^^ No exception = pass
 
+    # The same goes for events that fail to send:
+    from historical.common.exceptions import ProducerException
+    error = ProducerException('somequeue', [{'Id': 'someid', 'SenderFault': False, 'Code': 'InternalError'}])
+    with patch('historical.s3.poller.produce_events', side_effect=error):
+        handler(event, None)
+
 
 # pylint: disable=W0613
 def test_collector(historical_role, buckets, mock_lambda_environment, swag_accounts, current_s3_table):
@@ -378,6 +394,7 @@ def test_differ(current_s3_table, durable_s3_table, mock_lambda_environment):
     assert len(results) == 2
     assert results[1].Tags["ANew"] == results[1].configuration.attribute_values["Tags"]["ANew"] == "Tag"
     assert results[1].eventTime == new_date
+    assert results[0].configHash and results[1].configHash and results[0].configHash != results[1].configHash
 
     # And deletion (ensure new record -- testing TTL): -- And with SNS for testing completion
     delete_bucket = S3_BUCKET.copy()
@@ -393,3 +410,504 @@ def test_differ(current_s3_table, durable_s3_table, mock_lambda_environment):
     data = json.loads(json.dumps(data, default=serialize))
     handler(data, mock_lambda_environment)
     assert DurableS3Model.count() == 3
+
+
+# pylint: disable=W0613
+def test_collector_concurrent_fetching(historical_role, buckets, mock_lambda_environment, swag_accounts,
+                                       current_s3_table):
+    """Test that the Collector fetches buckets concurrently, and that a failure for one bucket doesn't stop the rest."""
+    from cloudaux.orchestration.aws.s3 import get_bucket
+    from historical.s3.collector import process_update_records
+    from historical.s3.models import CurrentS3Model
+
+    def mock_get_bucket(b_name, **kwargs):
+        if b_name == 'testbucket3':
+            raise ClientError({'Error': {'Message': '', 'Code': 'InternalError'}}, 'GetBucketAcl')
+
+        return get_bucket(b_name, **kwargs)
+
+    events = []
+    for i in range(0, 10):
+        events.append(json.loads(json.dumps(CloudwatchEventFactory(
+            detail=DetailFactory(
+                requestParameters={"bucketName": f"testbucket{i}"},
+                eventSource="aws.s3",
+                eventName="PutBucketPolicy")), default=serialize)))
+
+    with patch('historical.s3.collector.get_bucket', mock_get_bucket), \
+            patch('historical.s3.collector.COLLECTOR_WORKERS', 5):
+        with pytest.raises(Exception):
+            process_update_records(events)
+
+    # All the other buckets should have been saved:
+    assert CurrentS3Model.count() == 9
+    assert not list(CurrentS3Model.query('arn:aws:s3:::testbucket3'))
+
+
+def test_collector_reports_batch_item_failures(historical_role, buckets, mock_lambda_environment, swag_accounts,
+                                               current_s3_table):
+    """Test that the Collector only reports the SQS messages that failed to be processed."""
+    from cloudaux.orchestration.aws.s3 import get_bucket
+    from historical.s3.collector import handler
+    from historical.s3.models import CurrentS3Model
+
+    def mock_get_bucket(b_name, **kwargs):
+        if b_name == 'testbucket3':
+            raise ClientError({'Error': {'Message': '', 'Code': 'InternalError'}}, 'GetBucketAcl')
+
+        return get_bucket(b_name, **kwargs)
+
+    events = []
+    for i in range(0, 5):
+        event = CloudwatchEventFactory(
+            detail=DetailFactory(
+                requestParameters={"bucketName": f"testbucket{i}"},
+                eventSource="aws.s3",
+                eventName="PutBucketPolicy"))
+        events.append(SQSDataFactory(messageId=f'message{i}', body=json.dumps(event, default=serialize)))
+
+    # Another event for the failing bucket -- which is coalesced with the first one:
+    event = CloudwatchEventFactory(
+        detail=DetailFactory(
+            requestParameters={"bucketName": "testbucket3"},
+            eventSource="aws.s3",
+            eventName="PutBucketTagging"))
+    events.append(SQSDataFactory(messageId='message5', body=json.dumps(event, default=serialize)))
+    data = json.loads(json.dumps(RecordsFactory(records=events), default=serialize))
+
+    with patch('historical.s3.collector.get_bucket', mock_get_bucket):
+        # Without reporting batch item failures, the error is raised after the other records are processed:
+        with pytest.raises(Exception):
+            handler(data, mock_lambda_environment)
+        assert CurrentS3Model.count() == 4
+
+        # With it, only the failed messages are returned (for all the events of the failed bucket):
+        with patch('historical.common.util.REPORT_BATCH_ITEM_FAILURES', True):
+            response = handler(data, mock_lambda_environment)
+        assert response == {'batchItemFailures': [{'itemIdentifier': 'message3'}, {'itemIdentifier': 'message5'}]}
+
+
+def test_differ_keeps_arns_in_order(mock_lambda_environment):
+    """Test that the Differ doesn't process the later records for an ARN once a record for it fails."""
+    from historical.s3.differ import handler
+
+    processed = []
+
+    def mock_process(record, *args, **kwargs):
+        if record['dynamodb']['NewImage']['name']['S'] == 'a1':
+            raise Exception('Failed to process a1.')
+
+        processed.append(record['dynamodb']['NewImage']['name']['S'])
+
+    records = []
+    for i, (arn, name) in enumerate([('a', 'a1'), ('b', 'b1'), ('a', 'a2'), ('b', 'b2')]):
+        record = {'eventName': 'MODIFY', 'dynamodb': {'Keys': {'arn': {'S': arn}}, 'NewImage': {'name': {'S': name}}}}
+        records.append(SQSDataFactory(messageId=f'message{i}', body=json.dumps(record)))
+    data = json.loads(json.dumps(RecordsFactory(records=records), default=serialize))
+
+    for workers in [1, 4]:
+        processed.clear()
+        with patch('historical.common.dynamodb.process_dynamodb_differ_record', mock_process), \
+                patch('historical.common.dynamodb.DIFFER_WORKERS', workers), \
+                patch('historical.common.util.REPORT_BATCH_ITEM_FAILURES', True):
+            assert handler(data, mock_lambda_environment) == {'batchItemFailures': [{'itemIdentifier': 'message0'},
+                                                                                    {'itemIdentifier': 'message2'}]}
+
+        assert processed == ['b1', 'b2']
+
+
+def test_differ_processes_arns_concurrently(mock_lambda_environment):
+    """Test that the Differ processes the records for different ARNs concurrently -- and in order for each ARN."""
+    import threading
+    from historical.common.dynamodb import process_differ_records
+    from historical.common.util import BatchItemFailures
+
+    # Both ARNs need to be in flight at the same time to get past this:
+    barrier = threading.Barrier(2, timeout=5)
+    processed = {'a': [], 'b': []}
+
+    def mock_process(record, *args, **kwargs):
+        arn = record['dynamodb']['Keys']['arn']['S']
+        if not processed[arn]:
+            barrier.wait()
+
+        processed[arn].append(record['dynamodb']['NewImage']['name']['S'])
+
+    records = [{'eventName': 'MODIFY', 'dynamodb': {'Keys': {'arn': {'S': arn}}, 'NewImage': {'name': {'S': name}}}}
+               for arn, name in [('a', 'a1'), ('a', 'a2'), ('b', 'b1'), ('a', 'a3'), ('b', 'b2')]]
+
+    failures = BatchItemFailures()
+    with patch('historical.common.dynamodb.process_dynamodb_differ_record', mock_process):
+        process_differ_records(records, None, None, failures, workers=2)
+
+    assert not failures.failures
+    assert processed == {'a': ['a1', 'a2', 'a3'], 'b': ['b1', 'b2']}
+
+
+def test_differ_uses_old_image(current_s3_table, durable_s3_table, mock_lambda_environment):
+    """Test that the Differ can diff against the stream record's OldImage instead of querying the Durable table."""
+    from historical.common.proxy import make_proper_dynamodb_record
+    from historical.constants import EVENT_TOO_BIG_FLAG
+    from historical.s3.models import DurableS3Model
+    from historical.s3.differ import handler
+    from historical.models import TTL_EXPIRY
+
+    def make_bucket(hour, **config):
+        bucket = json.loads(json.dumps(S3_BUCKET, default=serialize))
+        bucket['eventTime'] = datetime(year=2017, month=5, day=12, hour=hour, minute=30, second=0).isoformat() + 'Z'
+        bucket['ttl'] = int(time.time() + TTL_EXPIRY)
+        bucket['configuration'].update(config)
+        return bucket
+
+    def differ_event(event_name, new_image, old_image=None):
+        record = DynamoDBRecordFactory(
+            dynamodb=DynamoDBDataFactory(NewImage=new_image, OldImage=old_image or {}, Keys={'arn': new_image['arn']}),
+            eventName=event_name)
+        blob = make_proper_dynamodb_record(json.loads(json.dumps(record, default=serialize)))
+        return json.loads(json.dumps(RecordsFactory(records=[SQSDataFactory(body=blob)]), default=serialize))
+
+    def no_query(*args, **kwargs):
+        raise Exception('The Durable table should not have been queried.')
+
+    old_bucket = make_bucket(10)
+    handler(differ_event('INSERT', old_bucket), mock_lambda_environment)
+    assert DurableS3Model.count() == 1
+
+    with patch('historical.common.dynamodb.DIFFER_USE_OLD_IMAGE', True), \
+            patch('historical.common.proxy.DIFFER_USE_OLD_IMAGE', True):
+        # No changes -- and no query:
+        with patch.object(DurableS3Model, 'query', no_query):
+            handler(differ_event('MODIFY', make_bucket(11), old_bucket), mock_lambda_environment)
+        assert DurableS3Model.count() == 1
+
+        # A change -- and still no query:
+        with patch.object(DurableS3Model, 'query', no_query):
+            handler(differ_event('MODIFY', make_bucket(12, Changed='yes'), make_bucket(11)),
+                    mock_lambda_environment)
+        assert DurableS3Model.count() == 2
+
+        # If the OldImage is too big for SQS, then the Proxy only shrinks the OldImage:
+        big_bucket = make_bucket(11, Big='x' * 300 * 1024)
+        event = differ_event('MODIFY', make_bucket(13, Changed='yes'), big_bucket)
+        shipped = json.loads(event['Records'][0]['body'])
+        assert not shipped.get(EVENT_TOO_BIG_FLAG)
+        assert 'configuration' in shipped['dynamodb']['NewImage']
+        assert 'configuration' not in shipped['dynamodb']['OldImage']
+
+        # The shrunken OldImage can't be used, so the latest revision is fetched from the Durable table instead:
+        handler(event, mock_lambda_environment)
+        assert DurableS3Model.count() == 2
+
+        handler(differ_event('MODIFY', make_bucket(14), big_bucket), mock_lambda_environment)
+        assert DurableS3Model.count() == 3
+
+
+def test_collector_fetches_changed_parts(historical_role, buckets, mock_lambda_environment, swag_accounts,
+                                         current_s3_table):
+    """Test that the Collector only fetches the parts of an existing bucket that an event modified."""
+    from cloudaux.orchestration.aws.s3 import FLAGS, get_bucket
+    from pynamodb.exceptions import PutError
+    from historical.common.dynamodb import save_current_revision
+    from historical.s3.collector import process_update_records
+    from historical.s3.models import CurrentS3Model
+
+    fetched_flags = []
+
+    def mock_get_bucket(b_name, **kwargs):
+        fetched_flags.append(kwargs.get('flags'))
+        return get_bucket(b_name, **kwargs)
+
+    def make_event(event_name):
+        return json.loads(json.dumps(CloudwatchEventFactory(
+            detail=DetailFactory(
+                requestParameters={"bucketName": "testbucket1"},
+                eventSource="aws.s3",
+                eventName=event_name)), default=serialize))
+
+    with patch('historical.s3.collector.get_bucket', mock_get_bucket):
+        # The bucket isn't in the Current table yet -- so it's fully fetched:
+        process_update_records([make_event('PutBucketTagging')])
+        assert fetched_flags == [None]
+        original = CurrentS3Model.get('arn:aws:s3:::testbucket1')
+
+        # Now, only the tags are fetched and merged in:
+        fetched_flags.clear()
+        boto3.client('s3').put_bucket_tagging(Bucket='testbucket1', Tagging={'TagSet': [{'Key': 'a', 'Value': 'b'}]})
+        process_update_records([make_event('PutBucketTagging')])
+        assert fetched_flags == [FLAGS.BASE | FLAGS.TAGS]
+
+        item = CurrentS3Model.get('arn:aws:s3:::testbucket1')
+        assert item.Tags.as_dict() == {'a': 'b'}
+        assert item.Region == original.Region
+        assert dict(item)['configuration'] == dict(original)['configuration']
+
+        # Multiple events for the same bucket fetch all the parts they modified:
+        fetched_flags.clear()
+        process_update_records([make_event('PutBucketTagging'), make_event('DeleteBucketPolicy')])
+        assert fetched_flags == [FLAGS.BASE | FLAGS.TAGS | FLAGS.POLICY]
+
+        # Polling events always fetch the entire bucket:
+        fetched_flags.clear()
+        process_update_records([make_event('PutBucketTagging'), make_event('PollS3')])
+        assert fetched_flags == [None]
+
+        # If the item is modified while the changed parts are fetched, then the conditional save fails, and the entire
+        # bucket is fetched and saved instead (moto doesn't evaluate the condition -- so that's mocked):
+        def mock_save_current_revision(current_model, data, condition=None):
+            if condition is not None:
+                raise PutError('The conditional request failed')
+
+            return save_current_revision(current_model, data)
+
+        fetched_flags.clear()
+        boto3.client('s3').put_bucket_tagging(Bucket='testbucket1', Tagging={'TagSet': [{'Key': 'c', 'Value': 'd'}]})
+        with patch('historical.s3.collector.save_current_revision', mock_save_current_revision):
+            process_update_records([make_event('PutBucketTagging')])
+        assert fetched_flags == [FLAGS.BASE | FLAGS.TAGS, None]
+        assert CurrentS3Model.get('arn:aws:s3:::testbucket1').Tags.as_dict() == {'c': 'd'}
+
+
+def test_poller_collects_details(historical_role, buckets, mock_lambda_environment, historical_sqs, swag_accounts,
+                                 current_s3_table):
+    """Test that the Poller can collect the bucket details, and that the Collector then doesn't fetch them again."""
+    from historical.s3.collector import fetch_bucket_details, handler as collector
+    from historical.s3.models import CurrentS3Model
+    from historical.s3.poller import MAX_COLLECTED_EVENT_SIZE, poller_processor_handler as poller
+
+    # Have the Poller collect the details (only for 1 of the buckets to keep this fast -- the rest will be
+    # unavailable or too big to fit in an SQS message, so their events are sent without them):
+    def mock_fetch_bucket_details(b_name, account_id, item):
+        if b_name == 'testbucket2':
+            return {'Name': b_name, 'Policy': 'a' * MAX_COLLECTED_EVENT_SIZE}
+
+        return fetch_bucket_details(b_name, account_id, item) if b_name == 'testbucket1' else None
+
+    with patch('historical.s3.poller.S3_POLLER_COLLECT', True), \
+            patch('historical.s3.poller.fetch_bucket_details', mock_fetch_bucket_details):
+        poller(json.loads(json.dumps(RecordsFactory(records=make_poller_events()), default=serialize)),
+               mock_lambda_environment)
+
+    sqs = boto3.client("sqs", region_name="us-east-1")
+    queue_url = get_queue_url(os.environ['POLLER_QUEUE_NAME'])
+
+    messages = []
+    for _ in range(0, 6):
+        messages += sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+
+    assert len(messages) == 51
+    for msg in messages:
+        body = json.loads(msg['Body'])
+        if body['detail']['requestParameters']['bucketName'] == 'testbucket1':
+            assert body['detail']['collected']['Name'] == 'testbucket1'
+        else:
+            assert not body['detail'].get('collected')
+
+    # The Collector should save the collected details without fetching anything:
+    def mock_get_bucket(b_name, **kwargs):
+        raise Exception(f'Bucket: {b_name} should not have been fetched.')
+
+    with patch('historical.s3.collector.get_bucket', mock_get_bucket):
+        records = [SQSDataFactory(body=msg['Body']) for msg in messages if '"testbucket1"' in msg['Body']]
+        collector(json.loads(json.dumps(RecordsFactory(records=records), default=serialize)), mock_lambda_environment)
+
+    item = CurrentS3Model.get('arn:aws:s3:::testbucket1')
+    assert item.Tags.as_dict() == {'theBucketName': 'testbucket1'}
+    assert item.configuration['LifecycleRules']
+    assert item.configuration['CreationDate']
+
+
+def test_poller_collects_details_until_out_of_time(mock_lambda_environment):
+    """Test that the Poller stops collecting bucket details once it is running out of time."""
+    from historical.s3.poller import make_collected_events
+
+    buckets = [{'Name': f'testbucket{i}', 'CreationDate': datetime(2017, 1, 1)} for i in range(0, 5)]
+    remaining_times = [99999, 99999, 1000, 1000, 1000]
+
+    def mock_fetch_bucket_details(b_name, account_id, item):
+        return {'Name': b_name}
+
+    with patch('historical.s3.poller.fetch_bucket_details', mock_fetch_bucket_details), \
+            patch('historical.s3.poller.COLLECTOR_WORKERS', 1), \
+            patch.object(mock_lambda_environment, 'get_remaining_time_in_millis', lambda: remaining_times.pop(0)):
+        events = make_collected_events('123456789012', buckets, context=mock_lambda_environment)
+    events = [json.loads(event) for event in events]
+
+    # The remaining buckets are sent without their details (the Collector will fetch them instead):
+    assert len(events) == 5
+    assert [event['detail'].get('collected', {}).get('Name') for event in events] == \
+        ['testbucket0', 'testbucket1', None, None, None]
+    assert [event['detail']['requestParameters']['bucketName'] for event in events] == \
+        [bucket['Name'] for bucket in buckets]
+
+
+def test_differ_caches_latest_revisions(current_s3_table, durable_s3_table, mock_lambda_environment):
+    """Test that the Differ only queries the Durable table for revisions that it doesn't already know about."""
+    from historical.common.dynamodb import LatestRevisionCache
+    from historical.s3.models import DurableS3Model
+    from historical.s3.differ import handler
+    from historical.models import TTL_EXPIRY
+
+    def differ_event(event_name, hour, fifo=True, **config):
+        bucket = json.loads(json.dumps(S3_BUCKET, default=serialize))
+        bucket['eventTime'] = datetime(year=2017, month=5, day=12, hour=hour, minute=30, second=0).isoformat() + 'Z'
+        bucket['ttl'] = int(time.time() + TTL_EXPIRY)
+        bucket['configuration'].update(config)
+        record = DynamoDBRecordFactory(dynamodb=DynamoDBDataFactory(NewImage=bucket, Keys={'arn': bucket['arn']}),
+                                       eventName=event_name)
+        data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(record, default=serialize))])
+        data = json.loads(json.dumps(data, default=serialize))
+        queue_name = 'HistoricalS3Differ.fifo' if fifo else 'HistoricalS3Differ'
+        data['Records'][0]['eventSourceARN'] = f'arn:aws:sqs:us-east-1:123456789012:{queue_name}'
+        return data
+
+    queries = []
+    real_query = DurableS3Model.query
+
+    def count_query(*args, **kwargs):
+        queries.append(args[0])
+        return real_query(*args, **kwargs)
+
+    cache = LatestRevisionCache(max_size=1, max_age=300)
+    with patch('historical.common.dynamodb.LATEST_REVISIONS', cache), \
+            patch.object(DurableS3Model, 'query', count_query):
+        # The saved revision is remembered:
+        handler(differ_event('INSERT', 10), mock_lambda_environment)
+        handler(differ_event('MODIFY', 11), mock_lambda_environment)
+        assert DurableS3Model.count() == 1
+        assert not queries
+
+        handler(differ_event('MODIFY', 12, Changed='yes'), mock_lambda_environment)
+        handler(differ_event('MODIFY', 13, Changed='yes'), mock_lambda_environment)
+        assert DurableS3Model.count() == 2
+        assert not queries
+
+        # Events that are older than the remembered revision need the query:
+        handler(differ_event('MODIFY', 11, Changed='yes'), mock_lambda_environment)
+        assert DurableS3Model.count() == 3
+        assert len(queries) == 1
+
+        # The cache is not used for events from a standard (non-FIFO) queue:
+        handler(differ_event('MODIFY', 14, fifo=False, Changed='yes'), mock_lambda_environment)
+        assert DurableS3Model.count() == 3
+        assert len(queries) == 2
+
+        # The remembered revision doesn't go back in time:
+        assert cache.get(S3_BUCKET['arn'], '2017-05-12T12:30:00Z')
+
+        # Only the most recently used ARNs are kept:
+        cache.put('arn:aws:s3:::someotherbucket', '2017-05-12T12:30:00Z', 'somehash')
+        assert not cache.get(S3_BUCKET['arn'], '2017-05-12T12:30:00Z')
+
+        # ...and not for too long:
+        later = time.time() + 301
+        with patch('historical.common.dynamodb.time.time', lambda: later):
+            assert not cache.get('arn:aws:s3:::someotherbucket', '2017-05-12T12:30:00Z')
+
+
+def test_differ_ignores_ephemeral_paths(current_s3_table, durable_s3_table, mock_lambda_environment):
+    """Test that the Differ doesn't save new revisions for changes to the ephemeral paths on the model's Meta."""
+    from historical.s3.models import DurableS3Model, S3_EPHEMERAL_PATHS
+    from historical.s3.differ import handler
+    from historical.models import TTL_EXPIRY
+
+    def differ_event(event_name, hour, **config):
+        bucket = json.loads(json.dumps(S3_BUCKET, default=serialize))
+        bucket['eventTime'] = datetime(year=2017, month=5, day=12, hour=hour, minute=30, second=0).isoformat() + 'Z'
+        bucket['ttl'] = int(time.time() + TTL_EXPIRY)
+        bucket['configuration'].update(config)
+        record = DynamoDBRecordFactory(dynamodb=DynamoDBDataFactory(NewImage=bucket, Keys={'arn': bucket['arn']}),
+                                       eventName=event_name)
+        data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(record, default=serialize))])
+        return json.loads(json.dumps(data, default=serialize))
+
+    logging = {'Enabled': True, 'Target': 'logs', 'Prefix': '', 'Grants': [{'Type': 'CanonicalUser',
+                                                                            'DisplayName': 'someone'}]}
+    with patch.object(DurableS3Model.Meta, 'ephemeral_paths', S3_EPHEMERAL_PATHS + ['configuration.Metrics.*.Count']):
+        handler(differ_event('INSERT', 10, Metrics={'a': {'Count': 1}}, Logging=logging), mock_lambda_environment)
+        handler(differ_event('MODIFY', 11, Metrics={'a': {'Count': 2}}, Logging=logging), mock_lambda_environment)
+        assert DurableS3Model.count() == 1
+
+        # The S3 ephemeral paths are ignored too:
+        logging['Grants'][0]['DisplayName'] = 'someone-else'
+        handler(differ_event('MODIFY', 12, Metrics={'a': {'Count': 2}}, Logging=logging), mock_lambda_environment)
+        assert DurableS3Model.count() == 1
+
+        handler(differ_event('MODIFY', 13, Metrics={'a': {'Count': 3}, 'b': {}}), mock_lambda_environment)
+        assert DurableS3Model.count() == 2
+
+        # The revisions still have the ephemeral fields:
+        latest = list(DurableS3Model.query(S3_BUCKET['arn'], scan_index_forward=False, limit=1))[0]
+        assert latest.configuration.Metrics['a']['Count'] == 3
+
+    # The saved hashes are from when the ephemeral path was set -- so they are not trusted once it isn't:
+    handler(differ_event('MODIFY', 14, Metrics={'a': {'Count': 3}, 'b': {}}), mock_lambda_environment)
+    assert DurableS3Model.count() == 2
+
+    handler(differ_event('MODIFY', 15, Metrics={'a': {'Count': 4}, 'b': {}}), mock_lambda_environment)
+    assert DurableS3Model.count() == 3
+
+
+def test_differ_delta_encodes_revisions(current_s3_table, durable_s3_table, mock_lambda_environment):
+    """Test that the Differ stores deltas between keyframes, and that the full revisions can be rebuilt."""
+    from historical.common.dynamodb import deserialize_durable_record_to_durable_model, get_full_durable_object, \
+        reconstruct_revision
+    from historical.common.proxy import expand_delta_record
+    from historical.s3.models import DurableS3Model
+    from historical.s3.differ import handler
+    from historical.models import TTL_EXPIRY
+
+    def differ_event(event_name, hour, **config):
+        bucket = json.loads(json.dumps(S3_BUCKET, default=serialize))
+        bucket['eventTime'] = datetime(year=2017, month=5, day=12, hour=hour, minute=30, second=0).isoformat() + 'Z'
+        bucket['ttl'] = int(time.time() + TTL_EXPIRY)
+        bucket['configuration'].update(config)
+        record = DynamoDBRecordFactory(dynamodb=DynamoDBDataFactory(NewImage=bucket, Keys={'arn': bucket['arn']}),
+                                       eventName=event_name)
+        data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(record, default=serialize))])
+        return json.loads(json.dumps(data, default=serialize))
+
+    with patch('historical.common.dynamodb.DURABLE_KEYFRAME_INTERVAL', 3):
+        handler(differ_event('INSERT', 10), mock_lambda_environment)
+        handler(differ_event('MODIFY', 11, Changed='one'), mock_lambda_environment)
+        handler(differ_event('MODIFY', 12, Changed='two', Logging={'Enabled': True}), mock_lambda_environment)
+        handler(differ_event('MODIFY', 13, Changed='two', Logging={'Enabled': True}), mock_lambda_environment)
+        handler(differ_event('MODIFY', 14, Changed='three'), mock_lambda_environment)
+        handler(differ_event('MODIFY', 15, Changed='four'), mock_lambda_environment)
+        # Back to the same configuration as the keyframe:
+        handler(differ_event('MODIFY', 16, Changed='three'), mock_lambda_environment)
+
+    revisions = list(DurableS3Model.query(S3_BUCKET['arn']))
+    assert [(revision.revisionSequence, revision.keyframeEventTime and revision.keyframeEventTime[11:13])
+            for revision in revisions] == [(0, None), (1, '10'), (2, '10'), (0, None), (1, '14'), (2, '14')]
+
+    # The deltas don't have a configuration (so they can't be mistaken for deletion markers):
+    assert dict(revisions[1])['configuration'] is None
+    assert json.loads(revisions[1].configDelta) == {'set': [[['Changed'], 'one']], 'unset': []}
+
+    expected = [None, 'one', 'two', 'three', 'four', 'three']
+    for revision, changed in zip(revisions, expected):
+        full = dict(reconstruct_revision(revision))
+        assert full['configuration'].get('Changed') == changed
+        assert full['configuration']['CreationDate'] == S3_BUCKET['configuration']['CreationDate']
+        assert full['keyframeEventTime'] is None
+
+    assert dict(revisions[2])['configuration'] is None
+    assert dict(get_full_durable_object(S3_BUCKET['arn'], revisions[2].eventTime,
+                                        DurableS3Model))['configuration']['Logging'] == {'Enabled': True}
+
+    # The Durable table Proxy sends out full revisions:
+    record = {'eventName': 'INSERT', 'dynamodb': {
+        'Keys': {'arn': {'S': S3_BUCKET['arn']}},
+        'NewImage': revisions[4]._serialize(attr_map=True)['attributes']  # pylint: disable=W0212
+    }}
+    with patch('historical.common.proxy.HISTORICAL_TECHNOLOGY', 's3'):
+        expanded = expand_delta_record(record)
+
+    assert 'configDelta' not in expanded['dynamodb']['NewImage']
+    assert expanded['dynamodb']['NewImage']['configuration']['M']['Changed'] == {'S': 'four'}
+    assert 'configuration' not in record['dynamodb']['NewImage']
+    assert expand_delta_record(expanded) is expanded
+
+    # Records that weren't expanded are rebuilt when they are deserialized:
+    revision = deserialize_durable_record_to_durable_model(record, DurableS3Model)
+    assert dict(revision)['configuration']['Changed'] == 'four'
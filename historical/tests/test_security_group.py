@@ -168,18 +168,26 @@ def test_poller_tasker_handler(mock_lambda_environment, historical_sqs, swag_acc
     assert poller_events['account_id'] == all_historical_accounts[0]['id']
     assert poller_events['region'] == CURRENT_REGION
 
+    # Events that fail to send are logged (and not raised):
+    from historical.common.exceptions import ProducerException
+    from historical.security_group.poller import poller_tasker_handler
+
+    error = ProducerException('somequeue', [{'Id': 'someid', 'SenderFault': False, 'Code': 'InternalError'}])
+    with patch('historical.security_group.poller.produce_events', side_effect=error):
+        poller_tasker_handler({}, mock_lambda_environment)
+
 
 # pylint: disable=W0613
 def test_poller_processor_handler(historical_sqs, historical_role, mock_lambda_environment, security_groups, swag_accounts):
     """Test the Poller's processing component that tasks the collector."""
-    # Mock this so it returns a `NextToken`:
+    # Mock this so it returns a `NextToken` for the first page:
     def mock_describe_security_groups(**kwargs):
         from cloudaux.aws.ec2 import describe_security_groups
 
-        # Did we receive a NextToken? (this will happen on the second run through to verify that
-        # this logic is being reached:
+        # Did we receive a NextToken? (this will happen on the second page to verify that this logic is being reached):
         if kwargs.get('NextToken'):
             assert kwargs['NextToken'] == 'MOARRESULTS'
+            return describe_security_groups(**kwargs)
 
         result = describe_security_groups(**kwargs)
         result['NextToken'] = 'MOARRESULTS'
@@ -196,15 +204,16 @@ def test_poller_processor_handler(historical_sqs, historical_role, mock_lambda_e
     messages = make_poller_events()
     event = json.loads(json.dumps(RecordsFactory(records=messages), default=serialize))
 
-    # Run the poller handler:
+    # Run the poller handler -- with plenty of time left, both pages are fetched in this invocation:
     handler(event, mock_lambda_environment)
 
-    # Need to ensure that 3 total SGs were added into SQS:
+    # Need to ensure that 3 total SGs were added into SQS for each page:
     sqs = boto3.client("sqs", region_name="us-east-1")
     queue_url = get_queue_url(os.environ['POLLER_QUEUE_NAME'])
+    tasker_queue_url = get_queue_url(os.environ['POLLER_TASKER_QUEUE_NAME'])
 
     messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
-    assert len(messages) == 3
+    assert len(messages) == 6
 
     # Verify that the region is properly propagated through, and that we got the collected data:
     for msg in messages:
@@ -213,9 +222,21 @@ def test_poller_processor_handler(historical_sqs, historical_role, mock_lambda_e
         assert body['detail']['collected']['OwnerId'] == '123456789012'
         assert not body['detail']['collected'].get('ResponseMetadata')
 
-    # Now, verify that the pagination was sent in properly to SQS tasker queue:
-    queue_url = get_queue_url(os.environ['POLLER_TASKER_QUEUE_NAME'])
+    # Nothing should have been sent to the tasker queue:
+    assert not sqs.receive_message(QueueUrl=tasker_queue_url, MaxNumberOfMessages=10).get('Messages')
+
+    for msg in messages:
+        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=msg['ReceiptHandle'])
+
+    # Now run it without enough time left to fetch the next page:
+    with patch.object(mock_lambda_environment, 'get_remaining_time_in_millis', lambda: 1000):
+        handler(event, mock_lambda_environment)
+
     messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    assert len(messages) == 3
+
+    # Verify that the pagination was sent in properly to SQS tasker queue:
+    messages = sqs.receive_message(QueueUrl=tasker_queue_url, MaxNumberOfMessages=10)['Messages']
     assert len(messages) == 1
     assert json.loads(messages[0]['Body'])['NextToken'] == 'MOARRESULTS'
 
@@ -430,3 +451,128 @@ def test_collector(historical_role, mock_lambda_environment, historical_sqs, sec
     handler(data, mock_lambda_environment)
     group = list(CurrentSecurityGroupModel.query(f'arn:aws:ec2:eu-west-2:123456789012:security-group/{sg_id}'))
     assert len(group) == 1
+
+
+# pylint: disable=W0613
+def test_collector_describes_in_bulk(historical_role, mock_lambda_environment, historical_sqs, security_groups,
+                                     current_security_group_table):
+    """Tests that the Collector describes all the groups in an account/region with as few calls as possible."""
+    from cloudaux.aws.ec2 import describe_security_groups
+    from historical.security_group.models import CurrentSecurityGroupModel
+    from historical.security_group.collector import handler
+
+    client = boto3.client('ec2', region_name='us-east-1')
+    group_ids = [security_groups['GroupId']]
+    for i in range(0, 2):
+        group_ids.append(client.create_security_group(GroupName=f'bulk{i}', Description='bulk',
+                                                      VpcId='vpc-test')['GroupId'])
+
+    describe_calls = []
+
+    def mock_describe_security_groups(**kwargs):
+        describe_calls.append(kwargs['GroupIds'])
+        return describe_security_groups(**kwargs)
+
+    def make_event(group_ids):
+        events = [CloudwatchEventFactory(detail=DetailFactory(requestParameters={'groupId': group_id},
+                                                              eventName='AuthorizeSecurityGroupIngress'))
+                  for group_id in group_ids]
+        data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(event, default=serialize)) for event in events])
+        return json.loads(json.dumps(data, default=serialize))
+
+    with patch('historical.security_group.collector.describe_security_groups', mock_describe_security_groups):
+        # All the groups should be described in 1 call:
+        handler(make_event(group_ids), mock_lambda_environment)
+        assert len(describe_calls) == 1
+        assert sorted(describe_calls[0]) == sorted(group_ids)
+        assert CurrentSecurityGroupModel.count() == 3
+
+        # If a group is missing, then the groups are described individually:
+        describe_calls.clear()
+        handler(make_event(group_ids + ['sg-notreal']), mock_lambda_environment)
+        assert len(describe_calls) == 5
+        assert all(len(call) == 1 for call in describe_calls[1:])
+        assert CurrentSecurityGroupModel.count() == 3
+
+
+def test_collector_coalesces_updates(historical_role, mock_lambda_environment, historical_sqs, security_groups,
+                                     current_security_group_table):
+    """Tests that the Collector only describes and saves a security group once for a batch of updates to it."""
+    from cloudaux.aws.ec2 import describe_security_groups
+    from historical.security_group.models import CurrentSecurityGroupModel
+    from historical.security_group.collector import handler
+
+    describe_calls = []
+
+    def mock_describe_security_groups(**kwargs):
+        describe_calls.append(kwargs['GroupIds'])
+        return describe_security_groups(**kwargs)
+
+    saves = []
+    original_save = CurrentSecurityGroupModel.save
+
+    def mock_save(self, *args, **kwargs):
+        saves.append(self.arn)
+        return original_save(self, *args, **kwargs)
+
+    # 30 rule changes to the same group -- the newest is in the middle of the batch:
+    event_times = [f'2018-01-01T00:00:{i:02d}Z' for i in range(0, 30)]
+    event_times.insert(15, '2018-01-01T00:01:00Z')
+    events = [CloudwatchEventFactory(detail=DetailFactory(requestParameters={'groupId': security_groups['GroupId']},
+                                                          eventName='AuthorizeSecurityGroupIngress',
+                                                          eventTime=event_time))
+              for event_time in event_times]
+    data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(event, default=serialize)) for event in events])
+    data = json.loads(json.dumps(data, default=serialize))
+
+    with patch('historical.security_group.collector.describe_security_groups', mock_describe_security_groups), \
+            patch.object(CurrentSecurityGroupModel, 'save', mock_save):
+        handler(data, mock_lambda_environment)
+
+    assert describe_calls == [[security_groups['GroupId']]]
+    assert len(saves) == 1
+
+    items = list(CurrentSecurityGroupModel.scan())
+    assert len(items) == 1
+    assert items[0].eventTime == '2018-01-01T00:01:00Z'
+
+
+def test_collector_reports_coalesced_failures(historical_role, mock_lambda_environment, historical_sqs,
+                                              security_groups, current_security_group_table):
+    """Tests that all the coalesced events for a security group are reported when the group fails to be collected."""
+    from botocore.exceptions import ClientError
+    from historical.security_group import collector
+    from historical.security_group.collector import handler
+
+    client = boto3.client('ec2', region_name='us-east-1')
+    other_group_id = client.create_security_group(GroupName='other', Description='other',
+                                                  VpcId='vpc-test')['GroupId']
+
+    # 3 events for the failing group, and 1 for a group that is fine:
+    events = []
+    for i, group_id in enumerate([security_groups['GroupId']] * 3 + [other_group_id]):
+        event = CloudwatchEventFactory(detail=DetailFactory(requestParameters={'groupId': group_id},
+                                                            eventName='AuthorizeSecurityGroupIngress'))
+        events.append(SQSDataFactory(messageId=f'message{i}', body=json.dumps(event, default=serialize)))
+    data = json.loads(json.dumps(RecordsFactory(records=events), default=serialize))
+
+    original_capture = collector.capture_update_record
+
+    def mock_capture_update_record(rec, **kwargs):
+        if collector.get_group_id(rec) == security_groups['GroupId']:
+            raise Exception('Failed to collect the group.')
+
+        return original_capture(rec, **kwargs)
+
+    with patch('historical.common.util.REPORT_BATCH_ITEM_FAILURES', True):
+        with patch('historical.security_group.collector.capture_update_record', mock_capture_update_record):
+            response = handler(data, mock_lambda_environment)
+        assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == \
+            ['message0', 'message1', 'message2']
+
+        # If the bulk describe fails, then all of the events for the account/region have failed:
+        error = ClientError({'Error': {'Message': '', 'Code': 'InternalError'}}, 'DescribeSecurityGroups')
+        with patch('historical.security_group.collector.describe_groups_in_bulk', side_effect=error):
+            response = handler(data, mock_lambda_environment)
+        assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == \
+            ['message0', 'message1', 'message2', 'message3']
@@ -11,6 +11,7 @@ import time
 from datetime import datetime
 
 import boto3
+from mock import patch  # pylint: disable=E0401
 
 from historical.common.sqs import get_queue_url
 from historical.models import HistoricalPollerTaskEventModel
@@ -131,6 +132,14 @@ def test_poller_tasker_handler(mock_lambda_environment, historical_sqs, swag_acc
     assert poller_events['account_id'] == all_historical_accounts[0]['id']
     assert poller_events['region'] == CURRENT_REGION
 
+    # Events that fail to send are logged (and not raised):
+    from historical.common.exceptions import ProducerException
+    from historical.vpc.poller import poller_tasker_handler
+
+    error = ProducerException('somequeue', [{'Id': 'someid', 'SenderFault': False, 'Code': 'InternalError'}])
+    with patch('historical.vpc.poller.produce_events', side_effect=error):
+        poller_tasker_handler({}, mock_lambda_environment)
+
 
 def test_poller_processor_handler(historical_sqs, historical_role, mock_lambda_environment, vpcs, swag_accounts):
     """Test the Poller's processing component that tasks the collector."""
@@ -150,6 +159,12 @@ def test_poller_processor_handler(historical_sqs, historical_role, mock_lambda_e
     messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
     assert len(messages) == 2
 
+    # Verify that the region is properly propagated through, and that we got the collected data:
+    for msg in messages:
+        body = json.loads(msg['Body'])
+        assert body['detail']['awsRegion'] == 'us-east-1'
+        assert body['detail']['collected']['VpcId'] == body['detail']['requestParameters']['vpcId']
+
 
 # pylint: disable=R0915
 def test_differ(current_vpc_table, durable_vpc_table, mock_lambda_environment):
@@ -284,3 +299,87 @@ def test_collector(historical_role, mock_lambda_environment, vpcs, current_vpc_t
     handler(data, mock_lambda_environment)
 
     assert CurrentVPCModel.count() == 0
+
+
+# pylint: disable=W0613
+def test_collector_describes_in_bulk(historical_role, mock_lambda_environment, vpcs, current_vpc_table):
+    """Tests that the Collector describes all the VPCs in an account/region with as few calls as possible."""
+    from cloudaux.aws.ec2 import describe_vpcs
+    from historical.vpc.models import CurrentVPCModel
+    from historical.vpc.collector import handler
+
+    client = boto3.client('ec2', region_name='us-east-1')
+    vpc_ids = [vpcs['VpcId'], client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']]
+    client.create_tags(Resources=[vpc_ids[1]], Tags=[{'Key': 'Name', 'Value': 'bulkvpc'}])
+
+    describe_calls = []
+
+    def mock_describe_vpcs(**kwargs):
+        describe_calls.append(kwargs['VpcIds'])
+        return describe_vpcs(**kwargs)
+
+    def make_event(vpc_ids):
+        events = []
+        for vpc_id in vpc_ids:
+            # (The named VPC's event also has the `vpcName`):
+            params = {'vpcId': vpc_id, 'vpcName': 'bulkvpc'} if vpc_id == vpc_ids[1] else {'vpcId': vpc_id}
+            events.append(CloudwatchEventFactory(detail=DetailFactory(requestParameters=params,
+                                                                      eventName='ModifyVpcAttribute')))
+        data = RecordsFactory(records=[SQSDataFactory(body=json.dumps(event, default=serialize)) for event in events])
+        return json.loads(json.dumps(data, default=serialize))
+
+    with patch('historical.vpc.collector.describe_vpcs', mock_describe_vpcs):
+        # All the VPCs should be described in 1 call:
+        handler(make_event(vpc_ids), mock_lambda_environment)
+        assert len(describe_calls) == 1
+        assert sorted(describe_calls[0]) == sorted(vpc_ids)
+        assert CurrentVPCModel.count() == 2
+
+        # The VPC names are pulled from the Name tags of the VPCs that were described in bulk:
+        assert CurrentVPCModel.get(f'arn:aws:ec2:us-east-1:123456789012:vpc/{vpc_ids[1]}').Name == 'bulkvpc'
+        assert not CurrentVPCModel.get(f'arn:aws:ec2:us-east-1:123456789012:vpc/{vpc_ids[0]}').Name
+
+        # If a VPC is missing, then the VPCs are described individually:
+        describe_calls.clear()
+        handler(make_event(vpc_ids + ['vpc-notreal']), mock_lambda_environment)
+        assert len(describe_calls) == 4
+        assert CurrentVPCModel.count() == 2
+
+
+def test_collector_reports_coalesced_failures(historical_role, mock_lambda_environment, vpcs, current_vpc_table):
+    """Tests that all the coalesced events for a VPC are reported when the VPC fails to be collected."""
+    from botocore.exceptions import ClientError
+    from historical.vpc import collector
+    from historical.vpc.collector import handler
+
+    client = boto3.client('ec2', region_name='us-east-1')
+    other_vpc_id = client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+
+    # 3 events for the failing VPC, and 1 for a VPC that is fine:
+    events = []
+    for i, vpc_id in enumerate([vpcs['VpcId']] * 3 + [other_vpc_id]):
+        event = CloudwatchEventFactory(detail=DetailFactory(requestParameters={'vpcId': vpc_id},
+                                                            eventName='ModifyVpcAttribute'))
+        events.append(SQSDataFactory(messageId=f'message{i}', body=json.dumps(event, default=serialize)))
+    data = json.loads(json.dumps(RecordsFactory(records=events), default=serialize))
+
+    original_capture = collector.capture_update_record
+
+    def mock_capture_update_record(record, **kwargs):
+        if record['detail']['requestParameters']['vpcId'] == vpcs['VpcId']:
+            raise Exception('Failed to collect the VPC.')
+
+        return original_capture(record, **kwargs)
+
+    with patch('historical.common.util.REPORT_BATCH_ITEM_FAILURES', True):
+        with patch('historical.vpc.collector.capture_update_record', mock_capture_update_record):
+            response = handler(data, mock_lambda_environment)
+        assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == \
+            ['message0', 'message1', 'message2']
+
+        # If the bulk describe fails, then all of the events for the account/region have failed:
+        error = ClientError({'Error': {'Message': '', 'Code': 'InternalError'}}, 'DescribeVpcs')
+        with patch('historical.vpc.collector.describe_vpcs_in_bulk', side_effect=error):
+            response = handler(data, mock_lambda_environment)
+        assert sorted(item['itemIdentifier'] for item in response['batchItemFailures']) == \
+            ['message0', 'message1', 'message2', 'message3']
@@ -5,7 +5,9 @@
     :license: Apache, see LICENSE for more details.
 .. author:: Kevin Glisson <kglisson@netflix.com>
 """
+import copy
 import logging
+from itertools import groupby
 
 from botocore.exceptions import ClientError
 from pynamodb.exceptions import DeleteError
@@ -14,10 +16,12 @@ from raven_python_lambda import RavenLambdaWrapper
 
 from cloudaux.aws.ec2 import describe_vpcs
 
-from historical.common.sqs import group_records_by_type
-from historical.constants import CURRENT_REGION, HISTORICAL_ROLE, LOGGING_LEVEL
+from historical.common.dynamodb import save_current_revision
+from historical.common.session import get_client, log_stats
+from historical.common.sqs import chunks, group_records_by_type
+from historical.constants import HISTORICAL_ROLE, LOGGING_LEVEL
 from historical.common import cloudwatch
-from historical.common.util import deserialize_records, pull_tag_dict
+from historical.common.util import BatchItemFailures, deserialize_records, pull_tag_dict
 from historical.vpc.models import CurrentVPCModel, VERSION
 
 logging.basicConfig()
@@ -35,24 +39,88 @@ DELETE_EVENTS = [
     'DeleteVpc'
 ]
 
+# The maximum number of VPC IDs to describe in a single DescribeVpcs call:
+DESCRIBE_BATCH_SIZE = 200
+
+# The error codes returned when a VPC does not exist:
+VPC_NOT_FOUND_CODES = ['InvalidVpcID.NotFound', 'InvalidVpc.NotFound']
+
 
 def get_arn(vpc_id, region, account_id):
     """Creates a vpc ARN."""
     return f'arn:aws:ec2:{region}:{account_id}:vpc/{vpc_id}'
 
 
-def describe_vpc(record):
-    """Attempts to describe vpc ids."""
+def get_update_key(record):
+    """Gets the key that identifies the VPC that an update event refers to."""
+    return record['account'], cloudwatch.get_region(record), cloudwatch.filter_request_parameters('vpcId', record)
+
+
+def describe_vpcs_in_bulk(account_id, region, vpc_ids):
+    """Describes a list of VPCs in an account/region with as few API calls as possible.
+
+    Returns a dict of VPC ID -> the described VPC. VPCs that no longer exist are omitted.
+    """
+    client = get_client('ec2', account_number=account_id, assume_role=HISTORICAL_ROLE, region=region)
+    vpcs = {}
+    for chunk in chunks(vpc_ids, DESCRIBE_BATCH_SIZE):
+        try:
+            described = describe_vpcs(
+                force_client=client,
+                VpcIds=chunk
+            )
+
+        except ClientError as exc:
+            if exc.response['Error']['Code'] not in VPC_NOT_FOUND_CODES:
+                raise exc
+
+            # At least one of the VPCs was deleted -- describe them one at a time to find the ones that remain:
+            LOG.debug(f'[?] Some VPCs in the batch were not found. Describing them individually. VPCs: {chunk}')
+            described = []
+            for vpc_id in chunk:
+                try:
+                    described += describe_vpcs(
+                        force_client=client,
+                        VpcIds=[vpc_id]
+                    )
+                except ClientError as exc:
+                    if exc.response['Error']['Code'] not in VPC_NOT_FOUND_CODES:
+                        raise exc
+
+        for vpc in described:
+            vpcs[vpc['VpcId']] = vpc
+
+    return vpcs
+
+
+def describe_vpc(record, region, described_vpcs=None):
+    """Attempts to describe vpc ids.
+
+    If `described_vpcs` is passed in, then the VPC will be looked up from there (see `describe_vpcs_in_bulk`)
+    instead of being described individually.
+    """
     account_id = record['account']
     vpc_name = cloudwatch.filter_request_parameters('vpcName', record)
     vpc_id = cloudwatch.filter_request_parameters('vpcId', record)
 
+    # Did this get collected already by the poller?
+    if cloudwatch.get_collected_details(record):
+        LOG.debug(f"[<--] Received already collected VPC data: {record['detail']['collected']}")
+        return [record['detail']['collected']]
+
+    # Was this already described in bulk? (Copy it, since the details get modified before saving). The `vpcName` is
+    # not needed for this: the name always comes from the described VPC's Name tag (see `get_vpc_name`):
+    if vpc_id and described_vpcs is not None:
+        if described_vpcs.get(vpc_id):
+            return [copy.deepcopy(described_vpcs[vpc_id])]
+
+        return []
+
+    client = get_client('ec2', account_number=account_id, assume_role=HISTORICAL_ROLE, region=region)
     try:
         if vpc_id and vpc_name:  # pylint: disable=R1705
             return describe_vpcs(
-                account_number=account_id,
-                assume_role=HISTORICAL_ROLE,
-                region=CURRENT_REGION,
+                force_client=client,
                 Filters=[
                     {
                         'Name': 'vpc-id',
@@ -62,15 +130,13 @@ def describe_vpc(record):
             )
         elif vpc_id:
             return describe_vpcs(
-                account_number=account_id,
-                assume_role=HISTORICAL_ROLE,
-                region=CURRENT_REGION,
+                force_client=client,
                 VpcIds=[vpc_id]
             )
         else:
             raise Exception('[X] Describe requires VpcId.')
     except ClientError as exc:
-        if exc.response['Error']['Code'] == 'InvalidVpc.NotFound':
+        if exc.response['Error']['Code'] in VPC_NOT_FOUND_CODES:
             return []
         raise exc
 
@@ -102,17 +168,27 @@ def create_delete_model(record):
     return None
 
 
-def capture_delete_records(records):
-    """Writes all of our delete events to DynamoDB."""
+def capture_delete_records(records, failures=None):
+    """Writes all of our delete events to DynamoDB.
+
+    Failed records are tracked in `failures` (see `BatchItemFailures`). If that's not passed in, then the first
+    error is raised after all the records have been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
+
     for record in records:
-        model = create_delete_model(record)
-        if model:
-            try:
-                model.delete(condition=(CurrentVPCModel.eventTime <= record['detail']['eventTime']))
-            except DeleteError:
+        with batch_failures.isolate(record):
+            model = create_delete_model(record)
+            if model:
+                try:
+                    model.delete(condition=(CurrentVPCModel.eventTime <= record['detail']['eventTime']))
+                except DeleteError:
+                    LOG.warning(f'[?] Unable to delete VPC. VPC does not exist. Record: {record}')
+            else:
                 LOG.warning(f'[?] Unable to delete VPC. VPC does not exist. Record: {record}')
-        else:
-            LOG.warning(f'[?] Unable to delete VPC. VPC does not exist. Record: {record}')
+
+    if failures is None:
+        batch_failures.raise_error()
 
 
 def get_vpc_name(vpc):
@@ -124,41 +200,82 @@ def get_vpc_name(vpc):
     return None
 
 
-def capture_update_records(records):
-    """Writes all updated configuration info to DynamoDB"""
-    for record in records:
-        data = cloudwatch.get_historical_base_info(record)
-        vpc = describe_vpc(record)
-
-        if len(vpc) > 1:
-            raise Exception(f'[X] Multiple vpcs found. Record: {record}')
+def capture_update_records(records, failures=None):
+    """Writes all updated configuration info to DynamoDB
 
-        if not vpc:
-            LOG.warning(f'[?] No vpc information found. Record: {record}')
+    Failed records are tracked in `failures` (see `BatchItemFailures`). If that's not passed in, then the first
+    error is raised after all the records have been processed.
+    """
+    batch_failures = failures if failures is not None else BatchItemFailures()
+
+    # Only the newest event for each VPC needs to be processed:
+    total = len(records)
+    coalesced = cloudwatch.group_records(records, get_update_key)
+    records = cloudwatch.coalesce_records(records, get_update_key)
+    LOG.debug(f'[@] Coalesced {total} update records into {len(records)} VPC updates.')
+
+    # Group the records by account/region so that the VPCs can be described in bulk:
+    def account_region(record):
+        return record['account'], cloudwatch.get_region(record)
+
+    for (account_id, region), grouped_records in groupby(sorted(records, key=account_region), account_region):
+        grouped_records = list(grouped_records)
+
+        # Only the VPCs that the poller didn't already collect need to be described:
+        vpc_ids = {cloudwatch.filter_request_parameters('vpcId', record) for record in grouped_records
+                   if not cloudwatch.get_collected_details(record)}
+        vpc_ids.discard(None)
+
+        try:
+            described_vpcs = describe_vpcs_in_bulk(account_id, region, sorted(vpc_ids)) if vpc_ids else None
+        except Exception as exc:  # pylint: disable=W0703
+            # (All the events that were coalesced into these have failed too):
+            batch_failures.add(exc, *[coalesced_record for record in grouped_records
+                                      for coalesced_record in coalesced[get_update_key(record)]])
             continue
 
-        vpc = vpc[0]
+        for record in grouped_records:
+            # All the events for a VPC are coalesced -- so if it fails, then all of them have failed:
+            with batch_failures.isolate(*coalesced[get_update_key(record)]):
+                capture_update_record(record, described_vpcs=described_vpcs)
+
+    if failures is None:
+        batch_failures.raise_error()
 
-        # determine event data for vpc
-        LOG.debug(f'Processing vpc. VPC: {vpc}')
-        data.update({
-            'VpcId': vpc.get('VpcId'),
-            'arn': get_arn(vpc['VpcId'], cloudwatch.get_region(record), data['accountId']),
-            'configuration': vpc,
-            'State': vpc.get('State'),
-            'IsDefault': vpc.get('IsDefault'),
-            'CidrBlock': vpc.get('CidrBlock'),
-            'Name': get_vpc_name(vpc),
-            'Region': cloudwatch.get_region(record),
-            'version': VERSION
-        })
 
-        data['Tags'] = pull_tag_dict(vpc)
+def capture_update_record(record, described_vpcs=None):
+    """Writes the updated configuration info for a single record to DynamoDB."""
+    data = cloudwatch.get_historical_base_info(record)
+    vpc = describe_vpc(record, cloudwatch.get_region(record), described_vpcs=described_vpcs)
+
+    if len(vpc) > 1:
+        raise Exception(f'[X] Multiple vpcs found. Record: {record}')
+
+    if not vpc:
+        LOG.warning(f'[?] No vpc information found. Record: {record}')
+        return
 
-        LOG.debug(f'[+] Writing DynamoDB Record. Records: {data}')
+    vpc = vpc[0]
 
-        current_revision = CurrentVPCModel(**data)
-        current_revision.save()
+    # determine event data for vpc
+    LOG.debug(f'Processing vpc. VPC: {vpc}')
+    data.update({
+        'VpcId': vpc.get('VpcId'),
+        'arn': get_arn(vpc['VpcId'], cloudwatch.get_region(record), data['accountId']),
+        'configuration': vpc,
+        'State': vpc.get('State'),
+        'IsDefault': vpc.get('IsDefault'),
+        'CidrBlock': vpc.get('CidrBlock'),
+        'Name': get_vpc_name(vpc),
+        'Region': cloudwatch.get_region(record),
+        'version': VERSION
+    })
+
+    data['Tags'] = pull_tag_dict(vpc)
+
+    LOG.debug(f'[+] Writing DynamoDB Record. Records: {data}')
+
+    save_current_revision(CurrentVPCModel, data)
 
 
 @RavenLambdaWrapper()
@@ -167,12 +284,13 @@ def handler(event, context):  # pylint: disable=W0613
     Historical vpc event collector.
     This collector is responsible for processing Cloudwatch events and polling events.
     """
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     # Split records into two groups, update and delete.
     # We don't want to query for deleted records.
     update_records, delete_records = group_records_by_type(records, UPDATE_EVENTS)
-    capture_delete_records(delete_records)
+    capture_delete_records(delete_records, failures=failures)
 
     # filter out error events
     update_records = [e for e in update_records if not e['detail'].get('errorCode')]  # pylint: disable=C0103
@@ -180,4 +298,7 @@ def handler(event, context):  # pylint: disable=W0613
     # group records by account for more efficient processing
     LOG.debug(f'[@] Update Records: {records}')
 
-    capture_update_records(update_records)
+    capture_update_records(update_records, failures=failures)
+
+    log_stats()
+    return failures.get_response()
@@ -9,8 +9,9 @@ import logging
 
 from raven_python_lambda import RavenLambdaWrapper
 
-from historical.common.dynamodb import process_dynamodb_differ_record
-from historical.common.util import deserialize_records
+from historical.common.dynamodb import process_differ_records
+from historical.common.sqs import is_fifo_event
+from historical.common.util import BatchItemFailures, deserialize_records
 from historical.constants import LOGGING_LEVEL
 from historical.vpc.models import CurrentVPCModel, DurableVPCModel
 
@@ -28,7 +29,9 @@ def handler(event, context):  # pylint: disable=W0613
     historical record.
     """
     # De-serialize the records:
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
-    for record in records:
-        process_dynamodb_differ_record(record, CurrentVPCModel, DurableVPCModel)
+    process_differ_records(records, CurrentVPCModel, DurableVPCModel, failures, fifo=is_fifo_event(event))
+
+    return failures.get_response()
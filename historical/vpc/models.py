@@ -22,6 +22,13 @@ from historical.models import (
 
 VERSION = 1
 
+# Paths to fields that change without the VPC changing (see `historical.models.EPHEMERAL_PATHS`). The status messages
+# of the CIDR block associations change while the associations are being updated:
+VPC_EPHEMERAL_PATHS = [
+    'configuration.CidrBlockAssociationSet.*.CidrBlockState.StatusMessage',
+    'configuration.Ipv6CidrBlockAssociationSet.*.Ipv6CidrBlockState.StatusMessage',
+]
+
 
 class VPCModel:
     """VPC specific fields for DynamoDB."""
@@ -43,6 +50,7 @@ class DurableVPCModel(DurableHistoricalModel, AWSHistoricalMixin, VPCModel):
         table_name = 'HistoricalVPCDurableTable'
         region = CURRENT_REGION
         tech = 'vpc'
+        ephemeral_paths = VPC_EPHEMERAL_PATHS
 
 
 class CurrentVPCModel(CurrentHistoricalModel, AWSHistoricalMixin, VPCModel):
@@ -54,6 +62,7 @@ class CurrentVPCModel(CurrentHistoricalModel, AWSHistoricalMixin, VPCModel):
         table_name = 'HistoricalVPCCurrentTable'
         region = CURRENT_REGION
         tech = 'vpc'
+        ephemeral_paths = VPC_EPHEMERAL_PATHS
 
 
 class VPCPollingRequestParamsModel(Schema):
@@ -66,6 +75,8 @@ class VPCPollingRequestParamsModel(Schema):
 class VPCPollingEventDetail(HistoricalPollingEventDetail):
     """Schema that provides the required fields for mimicking the CloudWatch Event for Polling."""
 
+    region = fields.Str(required=True, load_from='awsRegion', dump_to='awsRegion')
+
     @post_dump
     def add_required_vpc_polling_data(self, data):
         """Adds the required data to the JSON.
@@ -93,19 +104,22 @@ class VPCPollingEventModel(HistoricalPollingBaseModel):
         data['version'] = '1'
         return data
 
-    def serialize(self, account, group):
+    def serialize(self, account, vpc, region):
         """Serializes the JSON for the Polling Event Model.
 
         :param account:
-        :param group:
+        :param vpc:
+        :param region:
         :return:
         """
         return self.dumps({
             'account': account,
             'detail': {
                 'request_parameters': {
-                    'vpcId': group['VpcId']
-                }
+                    'vpcId': vpc['VpcId']
+                },
+                'region': region,
+                'collected': vpc
             }
         }).data
 
@@ -15,10 +15,12 @@ from raven_python_lambda import RavenLambdaWrapper
 from cloudaux.aws.ec2 import describe_vpcs
 
 from historical.constants import HISTORICAL_ROLE, LOGGING_LEVEL, POLL_REGIONS, RANDOMIZE_POLLER
-from historical.common.util import deserialize_records
+from historical.common.util import BatchItemFailures, deserialize_records, has_time_remaining
 from historical.vpc.models import VPC_POLLING_SCHEMA
 from historical.models import HistoricalPollerTaskEventModel
 from historical.common.accounts import get_historical_accounts
+from historical.common.exceptions import ProducerException
+from historical.common.session import get_client, log_stats
 from historical.common.sqs import get_queue_url, produce_events
 
 logging.basicConfig()
@@ -51,14 +53,30 @@ def poller_tasker_handler(event, context):  # pylint: disable=W0613
 
     try:
         produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
-    except ClientError as exc:
+    except (ClientError, ProducerException) as exc:
         LOG.error(f'[X] Unable to generate poller tasker events! Reason: {exc}')
 
     LOG.debug('[@] Finished tasking the pollers.')
 
 
+def describe_vpc_page(client, next_token=None):
+    """Describes a page of VPCs. Returns the VPCs and the `NextToken` for the next page (if there is one).
+
+    Older versions of botocore don't support paginating `DescribeVpcs` -- for those, all the VPCs are fetched at once.
+    """
+    if not client.can_paginate('describe_vpcs'):
+        return describe_vpcs(force_client=client), None
+
+    kwargs = {'MaxResults': 200}
+    if next_token:
+        kwargs['NextToken'] = next_token
+
+    result = client.describe_vpcs(**kwargs)
+    return result['Vpcs'], result.get('NextToken')
+
+
 @RavenLambdaWrapper()
-def poller_processor_handler(event, context):  # pylint: disable=W0613
+def poller_processor_handler(event, context):
     """
     Historical Security Group Poller Processor.
 
@@ -69,22 +87,54 @@ def poller_processor_handler(event, context):  # pylint: disable=W0613
     LOG.debug('[@] Running Poller...')
 
     queue_url = get_queue_url(os.environ.get('POLLER_QUEUE_NAME', 'HistoricalVPCPoller'))
+    tasker_queue_url = None
+
+    poller_task_schema = HistoricalPollerTaskEventModel()
 
-    records = deserialize_records(event['Records'])
+    failures = BatchItemFailures()
+    records = deserialize_records(event['Records'], failures=failures)
 
     for record in records:
-        # Skip accounts that have role assumption errors:
-        try:
-            vpcs = describe_vpcs(
-                account_number=record['account_id'],
-                assume_role=HISTORICAL_ROLE,
-                region=record['region']
-            )
-
-            events = [VPC_POLLING_SCHEMA.serialize(record['account_id'], v) for v in vpcs]
-            produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
-            LOG.debug(f"[@] Finished generating polling events. Account: {record['account_id']}/{record['region']} "
-                      f"Events Created: {len(events)}")
-        except ClientError as exc:
-            LOG.error(f"[X] Unable to generate events for account/region. Account Id/Region: {record['account_id']}"
-                      f"/{record['region']} Reason: {exc}")
+        with failures.isolate(record):
+            # Skip accounts that have role assumption errors:
+            try:
+                client = get_client('ec2', account_number=record['account_id'], assume_role=HISTORICAL_ROLE,
+                                    region=record['region'])
+
+                # Keep paginating for as long as there is time left in this invocation:
+                next_token = record.get('NextToken')
+                if next_token:
+                    LOG.debug(f"[@] Received pagination token: {next_token}")
+
+                while True:
+                    vpcs, next_token = describe_vpc_page(client, next_token=next_token)
+
+                    # If there isn't enough time left to fetch the next page, then it needs to be enqueued ASAP
+                    # because `NextToken`s expire in 60 seconds!
+                    out_of_time = next_token and not has_time_remaining(context)
+                    if out_of_time:
+                        LOG.debug(f"[-->] Pagination required {next_token}. Out of time -- tasking continuation.")
+                        if not tasker_queue_url:
+                            tasker_queue_url = get_queue_url(os.environ.get('POLLER_TASKER_QUEUE_NAME',
+                                                                            'HistoricalVPCPollerTasker'))
+
+                        produce_events(
+                            [poller_task_schema.serialize_me(record['account_id'], record['region'],
+                                                             next_token=next_token)],
+                            tasker_queue_url
+                        )
+
+                    events = [VPC_POLLING_SCHEMA.serialize(record['account_id'], v, record['region']) for v in vpcs]
+                    produce_events(events, queue_url, randomize_delay=RANDOMIZE_POLLER)
+                    LOG.debug(f"[@] Finished generating polling events. Account: {record['account_id']}/"
+                              f"{record['region']} Events Created: {len(events)}")
+
+                    if not next_token or out_of_time:
+                        break
+
+            except (ClientError, ProducerException) as exc:
+                LOG.error(f"[X] Unable to generate events for account/region. Account Id/Region: {record['account_id']}"
+                          f"/{record['region']} Reason: {exc}")
+
+    log_stats()
+    return failures.get_response()